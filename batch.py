@@ -0,0 +1,263 @@
+import numpy as np
+
+from linear_solver import solve_linear_system_batch
+from model_functions import (assemble_A_diagonals, forcing_at, mpfd_iteration_residual, picard_workspace,
+                             step_transpiration)
+from simulation import Simulation, read_forcing
+
+###############################################################################
+#BATCHED PICARD SOLVER
+###############################################################################
+#Integrates several members (parameter sets on the same grid, forcing and time step)
+#in lockstep: the state is a (members, nz) array, C, K and the residual are evaluated
+#for all members at once with the nodal functions of model_functions, and the linear
+#systems of the members still iterating are solved in a single banded factorization
+#(linear_solver.solve_linear_system_batch). Members that have converged keep their
+#solution while the others iterate, and a member that diverges is stopped without
+#stopping the batch.
+#
+#    outputs = run_batch([RunConfig(Ksat_1=1e-7), RunConfig(Ksat_1=2e-7)])
+#    output_vars, df_waterbal, df_EP = Simulation(config).format_output(outputs[0])
+
+#model_config parameters that can differ between the members of a batch,
+#all other values have to be the same
+BATCH_PARAMETERS = ('theta_S1', 'theta_R1', 'alpha_1', 'n_1', 'm_1', 'Ksat_1',
+                    'theta_S2', 'theta_R2', 'alpha_2', 'n_2', 'm_2', 'Ksat_2',
+                    'theta_1_clay', 'theta_2_clay', 'theta_1_sand', 'theta_2_sand',
+                    'Kr', 'qz', 'Ksax', 'Aind_r',
+                    'kmax', 'ap', 'bp', 'Aind_x', 'p', 'sat_xylem', 'Phi_0',
+                    'gsmax', 'hx50', 'nl', 'Emax', 'gb', 'ga')
+
+def batch_config(configs):
+    """
+    Configuration of a batch: the values shared by the members, and the
+    BATCH_PARAMETERS of the members as (members, 1) arrays, which broadcast
+    against the (members, nodes) arrays of the solver
+
+    Parameters
+    ----------
+    configs : list of RunConfig
+
+    Returns
+    -------
+    RunConfig
+    """
+    base = configs[0]
+    for config in configs[1:]:
+        different = [key for key, value in vars(base).items()
+                     if key not in BATCH_PARAMETERS and repr(getattr(config, key)) != repr(value)]
+        if different:
+            raise ValueError("The members of a batch can only differ in BATCH_PARAMETERS, not in: " + ", ".join(different))
+    if base.adaptive_dt or base.nonlinear_solver != 'picard':
+        raise ValueError("Batches are integrated with the Picard solver and the fixed time step dt0")
+    return base.replace(**{key: np.array([[getattr(config, key)] for config in configs], dtype=float)
+                           for key in BATCH_PARAMETERS})
+
+def batch_picard_step(hn, dt, q_rain_t, Pt, Head_bottom_t, ws, members, max_iter=np.inf):
+    """
+    picard_step for a batch of members
+
+    Parameters
+    ----------
+    hn : array (members, nz) [Pa]
+        water potentials at the beginning of the time step
+    dt, q_rain_t :
+        see picard_step (shared by the members)
+    Pt : array (members, nz-nz_r) [1/s]
+        canopy-distributed transpiration over the time step
+    Head_bottom_t : array (members) [Pa]
+        soil bottom potentials at the end of the time step (BottomBC = 0)
+    ws : dict
+        workspace from picard_workspace(sim, members)
+    members : array (members) of bool
+        members to integrate, the others are left unchanged
+    max_iter : int
+        maximum number of Picard iterations
+
+    Returns
+    -------
+    hnp1mp1 : array (members, nz) [Pa]
+        water potentials at the end of the time step (hn for the members not converged)
+    m : array (members) of int
+        number of Picard iterations of each member
+    converged : array (members) of bool
+    """
+    cfg = ws['sim'].cfg
+    hnp1m = hn.copy()
+    hnp1mp1 = hn.copy()
+    m = np.zeros(len(hn), dtype=int)
+    converged = np.zeros(len(hn), dtype=bool)
+    active = members.copy()
+    iteration = 0
+
+    while active.any() and iteration < max_iter:
+        iteration = iteration + 1
+        m[active] = iteration
+
+        #C, K and residual of MPFD at iteration level m, for all members: those that have
+        #converged are evaluated at their last iterate, so the workspace keeps their values
+        R_MPFD = mpfd_iteration_residual(hnp1m, hn, dt, q_rain_t, Pt, ws)
+        lower, diag, upper, coupling, nr = assemble_A_diagonals(ws['cnp1m'], ws['kbarplus'], ws['kbarminus'], ws['Kr'],
+                                                                ws['uptake'], dt, cfg.dz, cfg.BottomBC)
+
+        #members with non-finite entries diverged, they are left out of the stacked system
+        index = np.flatnonzero(active)
+        finite = np.isfinite(R_MPFD[index]).all(axis=1) & np.isfinite(diag[index]).all(axis=1)
+        active[index[~finite]] = False
+        index = index[finite]
+        if len(index) == 0:
+            break
+
+        deltam = solve_linear_system_batch(lower[index], diag[index], upper[index], coupling[index], nr, R_MPFD[index],
+                                           ws['sim'].nz_s)
+        delta_max = np.max(np.abs(deltam), axis=1)
+        hnext = hnp1m[index] + deltam
+
+        done = delta_max < cfg.stop_tol  #equation S.42
+        diverged = ~np.isfinite(delta_max)
+        hnp1mp1[index[done]] = hnext[done]
+        converged[index[done]] = True
+        active[index[done | diverged]] = False
+        hnp1m[index[~done & ~diverged]] = hnext[~done & ~diverged]
+
+    #Bottom boundary condition at bottom of the soil
+    if cfg.BottomBC==0:
+        hnp1mp1[converged, 0] = Head_bottom_t[converged]
+
+    return hnp1mp1, m, converged
+
+def Picard_batch(H_initial, Head_bottom_H, sim):
+    """
+    Picard for a batch of members, with the fixed time step dt0
+
+    Parameters
+    ----------
+    H_initial : array (members, nz) [Pa]
+        initial water potentials
+    Head_bottom_H : array (members, nt) [Pa]
+        soil bottom potentials
+    sim : simulation.Simulation
+        simulation of the batch, with the configuration of batch_config
+
+    Returns
+    -------
+    outputs : list
+        outputs of Picard for each member, None for the members that did not converge
+    """
+    cfg, nz_s, nz_r, nz, z_upper = sim.cfg, sim.nz_s, sim.nz_r, sim.nz, sim.z_upper
+    t_num, nt, q_rain = sim.t_num, sim.nt, sim.q_rain
+    n_members = len(H_initial)
+
+    #only saving variables every save_freq seconds
+    if cfg.save_freq % cfg.dt0 != 0:
+        raise ValueError("save_freq (" + str(cfg.save_freq) + " s) must be a multiple of dt0 (" + str(cfg.dt0) + " s)")
+    #format_model_output accumulates the saved transpiration over each hour (trans_h), or over each
+    #save_freq interval when longer: a shorter save_freq has to divide the hour
+    if cfg.save_freq < 3600 and 3600 % cfg.save_freq != 0:
+        raise ValueError("save_freq (" + str(cfg.save_freq) + " s) must divide 3600 s or be longer than 3600 s")
+    dim = int(np.sum(np.mod(t_num, cfg.save_freq) == 0))
+
+    H = np.zeros(shape=(n_members, nz, dim))
+    trans_2d = np.zeros(shape=(n_members, len(z_upper), dim))
+    K = np.zeros(shape=(n_members, nz, dim))
+    Capac = np.zeros(shape=(n_members, nz, dim))
+    S_kx = np.zeros(shape=(n_members, nz-nz_r, dim))
+    S_kr = np.zeros(shape=(n_members, nz_r-nz_s, dim))
+    S_sink = np.zeros(shape=(n_members, nz_r-nz_s, dim))
+    Kr_sink = np.zeros(shape=(n_members, nz_r-nz_s, dim))
+    THETA = np.zeros(shape=(n_members, nz_s, dim))
+    EVsink_ts = np.zeros(shape=(n_members, nz_r-nz_s, dim))
+    infiltration = np.zeros(shape=(n_members, dim))
+
+    H[:, :, 0] = H_initial
+    ws = picard_workspace(sim, n_members)
+
+    running = np.ones(n_members, dtype=bool)  #members that have not diverged
+    hn = H[:, :, 0].copy()
+    sav = 0
+
+    for i in range(nt-1):
+        t = t_num[i+1]
+
+        ##########TRANSPIRATION FORMULATION #################
+        if cfg.transpiration_scheme == 0: #the PM transpiration broadcasts over the members
+            Pt = step_transpiration(t, hn, sim)
+        else:
+            Pt = np.array([step_transpiration(t, hn[b], sim) for b in range(n_members)])
+
+        hnp1mp1, m, converged = batch_picard_step(hn, cfg.dt0, forcing_at(q_rain, t, cfg.dt0), Pt,
+                                                  forcing_at(Head_bottom_H, t, cfg.dt0), ws, running)
+
+        failed = running & ~converged
+        if failed.any():
+            if cfg.print_run_progress:
+                print("members", np.flatnonzero(failed), "did not converge at t =", t, "s")
+            running = running & converged
+
+        #saving output variables only every save_freq seconds
+        if np.mod(t, cfg.save_freq)==0:
+            sav = sav + 1
+
+            H[:, :, sav] = hnp1mp1
+            trans_2d[:, :, sav] = Pt
+            EVsink_ts[:, :, sav] = -ws['Kr']*(hnp1mp1[:, nz_s-(nz_r-nz_s):nz_s] - hnp1mp1[:, nz_s:nz_r])
+            K[:, :, sav] = ws['knp1m']
+            THETA[:, :, sav] = ws['theta']
+            Capac[:, :, sav] = ws['cnp1m']
+            S_kx[:, :, sav] = ws['stress_kx']
+            S_kr[:, :, sav] = ws['stress_kr']
+            S_sink[:, :, sav] = ws['stress_roots']
+            Kr_sink[:, :, sav] = ws['Kr']
+
+            if cfg.UpperBC==0 and forcing_at(q_rain, t, cfg.dt0)>0:
+                infiltration[:, sav] = ws['q_inf']
+
+        if cfg.print_run_progress and ((i+1) % cfg.print_freq) == 0:
+            print("calculated time steps", i+1)
+
+        hn = hnp1mp1
+
+    #S_stomata is not computed by Picard, it is returned as zeros with the same shape
+    S_stomata = np.zeros(shape=(nz-nz_r, dim if cfg.bounded_memory else nt))
+
+    outputs = []
+    for b in range(n_members):
+        if not running[b]:
+            outputs.append(None)
+            continue
+        outputs.append((H[b]*(10**(-6)), K[b], S_stomata, ws['theta'][b].copy(), S_kx[b], S_kr[b], np.diagflat(ws['cnp1m'][b]),
+                        Kr_sink[b], Capac[b], S_sink[b], EVsink_ts[b], THETA[b], infiltration[b], trans_2d[b]))
+    return outputs
+
+def run_batch(configs, working_dir=None, forcing=None, transpiration=None):
+    """
+    Runs the initial conditions and Picard_batch for the configurations of a batch
+
+    Parameters
+    ----------
+    configs : list of RunConfig
+        configurations of the members, differing only in BATCH_PARAMETERS
+    working_dir : str or Path
+        directory with the data/ inputs (current directory if not given)
+    forcing : dict
+        processed forcing shared by the members (read from the input file if not given)
+    transpiration : dict
+        transpiration inputs shared by the members (see Simulation, computed if not given)
+
+    Returns
+    -------
+    list
+        outputs of Picard for each member (see Simulation.format_output), None for
+        the members that did not converge
+    """
+    config = batch_config(configs)
+    if forcing is None:
+        forcing = read_forcing(config, working_dir)
+
+    #initial conditions of each member (they depend on the soil parameters)
+    initial = [Simulation(member, working_dir, forcing=forcing).initial_conditions() for member in configs]
+    H_initial = np.array([H for H, _ in initial])
+    Head_bottom_H = np.array([Head_bottom for _, Head_bottom in initial])
+
+    return Picard_batch(H_initial, Head_bottom_H, Simulation(config, working_dir, forcing=forcing,
+                                                             transpiration=transpiration))
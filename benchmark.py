@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the hydraulic solver
+
+Runs initial_conditions + Picard + format_model_output for a matrix of grid sizes,
+time steps, tree heights, soil depths and run lengths, with the bundled
+Derek_data_up.csv forcing or a synthetic one, and records for each case:
+    steps_per_s      : accepted time steps per second of Picard wall time
+    iter_per_step    : nonlinear iterations per accepted time step
+    run_time_s       : wall time of initial conditions + Picard + outputs
+    peak_memory_mb   : peak resident memory of the process running the case
+
+Each case is a simulation.Simulation run in a fresh process, so that the peak
+memory of the case is not mixed with that of the previous ones.
+
+The results are written to output/benchmark_results.csv. The baseline they are
+compared with is benchmark_baseline.json, kept in the repository with the machine it
+was measured on: steps_per_s, run_time_s and peak_memory_mb only compare on the same
+machine, iter_per_step on any. Regenerate it with --save-baseline after a change of
+the solver that is meant to change the timings, or to compare on another machine.
+
+Usage
+-----
+python benchmark.py                      #run all cases and compare with benchmark_baseline.json
+python benchmark.py --quick              #shortest run length only
+python benchmark.py --save-baseline      #store the results as the new baseline
+python benchmark.py --set linear_solver="'sparse'" --set numba_kernel=True
+                                         #model_config overrides applied to every case
+"""
+import argparse
+import ast
+import json
+import multiprocessing
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+repo_dir = Path(__file__).resolve().parent
+
+#model_config values of the reference case, each entry of CASES changes some of them
+BASE_CASE = {'dz': 0.1, 'dt0': 20, 'Hspec': 22, 'Soil_depth': 5}
+
+#name : (forcing, run length [days], model_config overrides)
+CASES = {'derek_base': ('derek', 1, {}),
+         'synthetic_base': ('synthetic', 1, {}),
+         'derek_dz0.05': ('derek', 1, {'dz': 0.05}),
+         'derek_dz0.2': ('derek', 1, {'dz': 0.2}),
+         'derek_dt0_60': ('derek', 1, {'dt0': 60}),
+         'derek_dt0_10': ('derek', 1, {'dt0': 10}),
+         'derek_Hspec35': ('derek', 1, {'Hspec': 35}),
+         'derek_soil8': ('derek', 1, {'Soil_depth': 8, 'sand_d': 8.0, 'clay_d': 7.2}),
+         'derek_3days': ('derek', 3, {}),
+         'synthetic_10days': ('synthetic', 10, {})}
+QUICK_RUN_DAYS = 1
+
+BASELINE_FILE = repo_dir / 'benchmark_baseline.json'
+RESULTS_FILE = repo_dir / 'output' / 'benchmark_results.csv'
+
+def synthetic_forcing(n_days, dt=1800):
+    """
+    Half-hourly forcing with the columns read by met_data: clear-sky diurnal
+    radiation, temperature and VPD cycles, and a 10 mm rain event every 4 days
+
+    Parameters
+    ----------
+    n_days : int
+        number of days
+    dt : [s]
+        input data resolution
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    t = np.arange(0, n_days*86400 + dt, dt)
+    hour = (t % 86400)/3600
+    day = np.sin(np.pi*(hour - 6)/12)  #positive between 6 and 18 h
+
+    rain = np.zeros(len(t))
+    rain[((t % (4*86400)) >= 86400) & ((t % (4*86400)) < 86400 + 5*dt)] = 2  #mm per half hour
+
+    return pd.DataFrame({'Radiation (W/m2)': 900*np.clip(day, 0, None),
+                         'T(degC)': 22 + 6*day,
+                         'VPD (kPa)': 1.2 + 0.9*day,
+                         'Rain (mm)': rain})
+
+def run_case(forcing, n_days, overrides, workdir, queue):
+    #runs one case inside a fresh process, so that its peak memory can be measured, the results are put in queue
+
+    sys.path.insert(0, str(repo_dir))
+    from simulation import RunConfig, Simulation
+    from model_functions import Picard, solver_telemetry
+
+    start = time.perf_counter()
+    config = RunConfig(**{**BASE_CASE, **overrides}, print_run_progress=False,
+                       input_fname='Derek_data_up.csv' if forcing == 'derek' else 'synthetic.csv')
+    config = config.replace(end_time=str(pd.to_datetime(config.start_time) + pd.Timedelta(days=n_days)))
+    sim = Simulation(config, working_dir=workdir)
+
+    H_initial, Head_bottom_H = sim.initial_conditions()
+
+    telemetry = solver_telemetry()
+    start_picard = time.perf_counter()
+    outputs = Picard(H_initial, Head_bottom_H, telemetry, sim)
+    picard_time = time.perf_counter() - start_picard
+
+    sim.format_output(outputs)
+    run_time = time.perf_counter() - start
+
+    steps = int(telemetry['converged'].sum())
+    queue.put({'nodes': sim.nz,
+               'steps': steps,
+               'steps_per_s': steps/picard_time,
+               'iter_per_step': telemetry['iterations'].sum()/max(steps, 1),
+               'run_time_s': run_time,
+               'peak_memory_mb': peak_memory_mb()})
+
+def peak_memory_mb():
+    #peak resident memory of this process [MB], nan where the resource module is not available (Windows)
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss/2**20 if sys.platform == 'darwin' else maxrss/2**10  #bytes on macOS, kB on Linux
+
+def run_benchmarks(cases, config_overrides):
+    """
+    Runs the benchmark cases, each in a new process
+
+    Parameters
+    ----------
+    cases : dict
+        name : (forcing, run length [days], model_config overrides), as CASES
+    config_overrides : dict
+        model_config values applied to every case (e.g. the solver backend)
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per case
+    """
+    ctx = multiprocessing.get_context('spawn')
+    rows = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        (Path(workdir) / 'data').mkdir()
+        shutil.copy(repo_dir / 'data' / 'Derek_data_up.csv', Path(workdir) / 'data')
+        n_days = max(case[1] for case in cases.values())
+        synthetic_forcing(n_days).to_csv(Path(workdir) / 'data' / 'synthetic.csv', index=False)
+
+        for name, (forcing, days, overrides) in cases.items():
+            queue = ctx.Queue()
+            process = ctx.Process(target=run_case, args=(forcing, days, {**overrides, **config_overrides}, workdir, queue))
+            process.start()
+            process.join()
+            result = queue.get() if process.exitcode == 0 else None
+            if result is None:
+                print(name, "failed with exit code", process.exitcode)
+                continue
+            rows.append({'case': name, 'forcing': forcing, 'days': days, **{**BASE_CASE, **overrides}, **result})
+            print(name, "-", round(result['steps_per_s'], 1), "steps/s,", round(result['iter_per_step'], 2), "iterations/step")
+
+    return pd.DataFrame(rows)
+
+def save_baseline(results, path):
+    """
+    Writes the results of run_benchmarks as a baseline, with the machine they were measured on
+
+    Parameters
+    ----------
+    results : pandas.DataFrame
+        output of run_benchmarks
+    path : Path
+        json file
+    """
+    import numpy
+    machine = {'platform': platform.platform(), 'processor': platform.processor() or platform.machine(),
+               'python': platform.python_version(), 'numpy': numpy.__version__}
+    with open(path, 'w') as f:
+        json.dump({'machine': machine, 'cases': json.loads(results.to_json(orient='records'))}, f, indent=1)
+
+def load_baseline(path):
+    """
+    Reads a baseline written by save_baseline
+
+    Returns
+    -------
+    baseline : pandas.DataFrame
+        one row per case, as run_benchmarks
+    machine : dict
+        platform, processor, python and numpy versions of the baseline
+    """
+    with open(path) as f:
+        data = json.load(f)
+    return pd.DataFrame(data['cases']), data['machine']
+
+def compare_with_baseline(results, baseline, tolerance=0.1):
+    """
+    Relative change of each metric with respect to the stored baseline
+
+    Parameters
+    ----------
+    results, baseline : pandas.DataFrame
+        outputs of run_benchmarks
+    tolerance : float
+        relative loss of steps/s above which a case is flagged as a regression
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    metrics = ['steps_per_s', 'iter_per_step', 'run_time_s', 'peak_memory_mb']
+    merged = results[['case'] + metrics].merge(baseline[['case'] + metrics], on='case', suffixes=('', '_baseline'))
+    for metric in metrics:
+        merged[metric + '_ratio'] = merged[metric]/merged[metric + '_baseline']
+    merged['regression'] = merged['steps_per_s_ratio'] < 1 - tolerance
+    return merged[['case'] + [metric + '_ratio' for metric in metrics] + ['regression']]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='run only the shortest cases')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--baseline', default=str(BASELINE_FILE), help='baseline json file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown flagged as a regression')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='model_config override for every case, VALUE is a Python literal')
+    args = parser.parse_args()
+
+    config_overrides = {}
+    for item in args.set:
+        key, value = item.split('=', 1)
+        config_overrides[key] = ast.literal_eval(value)
+
+    cases = {name: case for name, case in CASES.items() if not args.quick or case[1] <= QUICK_RUN_DAYS}
+    results = run_benchmarks(cases, config_overrides)
+    RESULTS_FILE.parent.mkdir(exist_ok=True)
+    results.to_csv(RESULTS_FILE, index=False)
+    print(results.to_string(index=False))
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print("baseline saved to", args.baseline)
+    elif Path(args.baseline).exists():
+        baseline, machine = load_baseline(args.baseline)
+        print("baseline measured on", machine['processor'] + ",", machine['platform'])
+        print(compare_with_baseline(results, baseline, args.tolerance).to_string(index=False))
+    else:
+        print("no baseline found at", args.baseline, "- run with --save-baseline to create one")
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration against the observations of the input file
+
+Wraps the model in an objective function: the weighted RMSE of the hourly
+transpiration (trans_h of format_model_output) against the observed stand
+transpiration and, optionally, of the soil water content against the observed
+volumetric water content of data/input_fname. The forcing is read once, the
+grid, forcing and transpiration inputs are shared by all the runs
+(Simulation.with_config), and a candidate run is stopped as soon as its partial
+error exceeds the best objective found so far. Candidates are evaluated in a
+process pool.
+
+Usage
+-----
+python calibration.py candidates.csv            #one column per model_config parameter, one row per candidate
+python calibration.py --bounds Ksat_1=1e-7:1e-5:log n_1=1.3:2.0 --samples 64 --processes 4
+python calibration.py candidates.csv --weights trans=1 theta=10 --theta-depth 0.3
+
+or from Python:
+
+    objective = Objective(['n_1', 'alpha_1'])
+    objective([1.5, 2e-4])                         #objective of one candidate
+    results = calibrate(sample_candidates({'Ksat_1': (1e-7, 1e-5, 'log')}, 32), processes=4)
+"""
+import argparse
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ensemble import attach_forcing, member_config, share_forcing
+from simulation import RunConfig, Simulation, read_forcing
+
+#columns of the input file compared with the model: objective term : column
+OBSERVATIONS = {'trans': 'Stand transpiration (mm/h)',         #hourly mean, compared with trans_h [mm/h]
+                'theta': 'Volumetric water content (m3/m3)'}   #compared with THETA at the saving times
+
+class CandidateRejected(Exception):
+    """Raised in a run whose partial error already exceeds the best objective"""
+
+class Objective:
+    """
+    Objective function of the calibration: sum over the terms of weight * RMSE
+
+    Parameters
+    ----------
+    names : list
+        model_config parameters of the candidates, in the order of the vectors
+        passed to __call__ (m_1 and m_2 follow n_1 and n_2, see ensemble.member_config)
+    config : RunConfig
+        configuration shared by all candidates (model_config if not given)
+    working_dir : str or Path
+        directory with the data/ inputs (current directory if not given)
+    weights : dict
+        term of OBSERVATIONS : weight ({'trans': 1} if not given)
+    theta_depth : float
+        depth below the soil surface of the water content sensor [m], mean water
+        content of the soil column if not given
+    forcing : dict
+        processed forcing (simulation.read_forcing), read from the input file if not given
+    early_stop : bool
+        stops a run when its partial error exceeds the best objective so far; the
+        objective of a stopped candidate is inf, so optimizers that compare candidates
+        worse than the best (e.g. Nelder-Mead) need early_stop = False
+    best : multiprocessing.Value
+        best objective so far, shared by the workers of calibrate (kept by this object if not given)
+    """
+    def __init__(self, names, config=None, working_dir=None, weights=None, theta_depth=None, forcing=None,
+                 early_stop=True, best=None):
+        config = (config if config is not None else RunConfig()).replace(
+            print_run_progress=False, stream_output=False, checkpoint=False, restart=False, save_telemetry=False)
+        forcing = forcing if forcing is not None else read_forcing(config, working_dir)
+
+        self.names = list(names)
+        self.weights = dict(weights) if weights is not None else {'trans': 1.0}
+        self.early_stop = early_stop
+        self.best = best if best is not None else multiprocessing.Value('d', np.inf)
+        self.history = []
+
+        unknown = set(self.weights) - set(OBSERVATIONS)
+        if unknown:
+            raise ValueError("Unknown objective terms: " + ", ".join(sorted(unknown)) + ", options: " + ", ".join(OBSERVATIONS))
+
+        #inputs built once, shared by the simulations of the candidates
+        self.base = Simulation(config, working_dir, forcing=forcing)
+        for group in ('grid', 'met', 'transpiration'):
+            getattr(self.base, group)
+        self.terms = observation_terms(self.base, self.weights, theta_depth)
+
+    def __call__(self, x):
+        """
+        Objective of one candidate
+
+        Parameters
+        ----------
+        x : dict or sequence
+            parameter : value, or the values of the parameters in names
+
+        Returns
+        -------
+        float
+            objective, inf for the candidates stopped early or failed
+        """
+        parameters = dict(x) if isinstance(x, dict) else dict(zip(self.names, np.atleast_1d(x)))
+        return self.evaluate(parameters)['objective']
+
+    def value(self, sse):
+        #objective from the sums of squared errors of the terms (a lower bound of the
+        #objective while a run is in progress, since the sums only grow)
+        return sum(self.weights[term]*np.sqrt(sse[term]/len(obs['observed'])) for term, obs in self.terms.items())
+
+    def evaluate(self, parameters):
+        """
+        Runs one candidate
+
+        Parameters
+        ----------
+        parameters : dict
+            model_config name : value
+
+        Returns
+        -------
+        dict
+            parameters, objective, RMSE of each term, status ('ok', 'rejected' when stopped
+            early, 'failed'), error message and fraction of the period simulated
+        """
+        sim = self.base.with_config(member_config(self.base.cfg, parameters))
+        sse = {term: 0.0 for term in self.terms}
+        compared = {term: 0 for term in self.terms}
+        progress = {'t': 0.0}
+
+        def monitor(t, sav, saved):
+            #adds the errors of the observations completed by snapshot sav
+            for term, obs in self.terms.items():
+                k = compared[term]
+                while k < len(obs['complete']) and obs['complete'][k] <= sav:
+                    start, stop = obs['columns'][k]
+                    sse[term] = sse[term] + (simulated_value(term, sim, saved, start, stop, obs) - obs['observed'][k])**2
+                    k = k + 1
+                compared[term] = k
+            progress['t'] = t
+            if self.early_stop and self.value(sse) > self.best.value:
+                raise CandidateRejected("partial objective " + str(self.value(sse)) + " at t = " + str(t) + " s")
+
+        row = dict(parameters)
+        try:
+            sim.run(monitor=monitor)
+            objective = self.value(sse)
+            row.update(objective=objective, status='ok', error='')
+            with self.best.get_lock():
+                if objective < self.best.value:
+                    self.best.value = objective
+        except CandidateRejected as e:
+            row.update(objective=np.inf, status='rejected', error=str(e))
+        except Exception:
+            row.update(objective=np.inf, status='failed', error=traceback.format_exc(limit=1).strip().splitlines()[-1])
+
+        for term, obs in self.terms.items():
+            row['rmse_' + term] = np.sqrt(sse[term]/len(obs['observed'])) if row['status'] == 'ok' else np.nan
+        row['simulated'] = progress['t']/sim.t_num[-1]
+        self.history.append(row)
+        return row
+
+def observation_terms(sim, weights, theta_depth=None):
+    """
+    Observations of the objective terms and the saved outputs they are compared with
+
+    Parameters
+    ----------
+    sim : simulation.Simulation
+    weights : dict
+        terms of OBSERVATIONS to compare
+    theta_depth : float
+        depth of the water content sensor [m] (mean of the soil column if not given)
+
+    Returns
+    -------
+    dict
+        term : dict with
+            'observed' : array of the observations (missing values removed)
+            'columns'  : (start, stop) of the saved columns each observation is compared with
+            'complete' : saved column after which each simulated value is known, in increasing order
+            'nodes'    : soil nodes of the water content ('theta')
+    """
+    cfg = sim.cfg
+    df = pd.read_csv(sim.working_dir / 'data' / cfg.input_fname)
+    missing = [OBSERVATIONS[term] for term in weights if OBSERVATIONS[term] not in df.columns]
+    if missing:
+        raise ValueError("Observations not found in " + cfg.input_fname + ": " + ", ".join(missing))
+
+    #times of the observations (rows of the period, as in read_met_data) and of the saved outputs [s]
+    nrows = int(round(sim.tmax/cfg.dt))
+    t_obs = np.arange(nrows)*cfg.dt
+    t_save = sim.t_num[np.mod(sim.t_num, cfg.save_freq) == 0]
+    offset = (sim.start_time - sim.start_time.floor('h')).total_seconds()
+
+    terms = {}
+    if 'trans' in weights:
+        #hours of the clock, as in the resample of trans_h; the hours after the last observation are left out
+        hour_save = ((offset + t_save)//3600).astype(int)
+        observed = pd.Series(df[OBSERVATIONS['trans']].values[:nrows]).groupby((offset + t_obs)//3600).mean().dropna()
+        hours = np.array([hour for hour in observed.index.astype(int) if hour in hour_save])
+        start = np.searchsorted(hour_save, hours, side='left')
+        stop = np.searchsorted(hour_save, hours, side='right')
+        terms['trans'] = {'observed': observed.loc[hours].values, 'columns': list(zip(start, stop)),
+                          'complete': np.maximum(stop - 1, 1)}
+
+    if 'theta' in weights:
+        if cfg.dt % cfg.save_freq != 0:
+            raise ValueError("The water content term needs save_freq (" + str(cfg.save_freq) + " s) to divide dt (" + str(cfg.dt) + " s)")
+        #THETA is not stored at t = 0, the first observation is left out
+        observed = df[OBSERVATIONS['theta']].values[1:nrows]
+        column = (t_obs[1:]//cfg.save_freq).astype(int)
+        valid = np.isfinite(observed)
+        if theta_depth is None:
+            nodes = slice(0, sim.nz_s)
+        else:
+            node = int(np.argmin(np.abs((sim.z_soil[-1] - sim.z_soil) - theta_depth)))
+            nodes = slice(node, node + 1)
+        terms['theta'] = {'observed': observed[valid], 'columns': list(zip(column[valid], column[valid] + 1)),
+                          'complete': column[valid], 'nodes': nodes}
+
+    for term, obs in terms.items():
+        if len(obs['observed']) == 0:
+            raise ValueError("No observations of '" + term + "' in the simulated period")
+    return terms
+
+def simulated_value(term, sim, saved, start, stop, obs):
+    #simulated value compared with one observation, from the saved columns start:stop
+    if term == 'trans':
+        #hourly sum of the transpiration rate, as trans_h [mm]
+        return sim.cfg.save_freq*np.sum(saved['trans_2d'][:, start:stop])*sim.cfg.dz*1000
+    return np.mean(saved['THETA'][obs['nodes'], start])
+
+def sample_candidates(bounds, n, seed=None):
+    """
+    Latin hypercube sample of candidates
+
+    Parameters
+    ----------
+    bounds : dict
+        model_config parameter : (low, high), or (low, high, 'log') for a log-uniform distribution
+    n : int
+        number of candidates
+    seed : int
+        seed of the random generator
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per candidate, one column per parameter
+    """
+    rng = np.random.default_rng(seed)
+    values = {}
+    for name, bound in bounds.items():
+        low, high = bound[0], bound[1]
+        u = (rng.permutation(n) + rng.random(n))/n  #one value in each of the n strata
+        if len(bound) > 2 and bound[2] == 'log':
+            values[name] = np.exp(np.log(low) + u*(np.log(high) - np.log(low)))
+        else:
+            values[name] = low + u*(high - low)
+    return pd.DataFrame(values)
+
+#objective of the worker processes, set by _init_worker
+_worker = {}
+
+def _init_worker(spec, names, config, working_dir, weights, theta_depth, early_stop, best):
+    #attaches the shared forcing and builds the inputs shared by the candidates of a worker process
+    blocks, forcing = attach_forcing(spec)
+    _worker.update(blocks=blocks, objective=Objective(names, config, working_dir, weights, theta_depth, forcing,
+                                                      early_stop, best))
+
+def evaluate_candidate(candidate, parameters):
+    """Runs one candidate in a worker process, see Objective.evaluate"""
+    return {'candidate': candidate, **_worker['objective'].evaluate(parameters)}
+
+def calibrate(candidates, config=None, working_dir=None, processes=None, weights=None, theta_depth=None,
+              early_stop=True):
+    """
+    Evaluates the candidates of a parameter table in a process pool
+
+    Parameters
+    ----------
+    candidates : pandas.DataFrame
+        one row per candidate, one column per model_config parameter (e.g. from sample_candidates)
+    config, working_dir, weights, theta_depth, early_stop :
+        see Objective
+    processes : int
+        number of worker processes (number of CPUs if not given)
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per candidate, sorted by objective: parameters, objective, RMSE of each
+        term, status, error message and fraction of the period simulated
+    """
+    config = (config if config is not None else RunConfig()).replace(print_run_progress=False)
+    working_dir = Path(working_dir) if working_dir is not None else Path.cwd()
+
+    unknown = set(candidates.columns) - set(vars(config))
+    if unknown:
+        raise AttributeError("Unknown model_config parameters: " + ", ".join(sorted(unknown)))
+    blocks, spec = share_forcing(read_forcing(config, working_dir))
+
+    try:
+        ctx = multiprocessing.get_context('spawn')
+        best = ctx.Value('d', np.inf)  #best objective, read by the runs of all the workers
+        with ProcessPoolExecutor(processes, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(spec, list(candidates.columns), config, working_dir, weights, theta_depth,
+                                           early_stop, best)) as pool:
+            futures = [pool.submit(evaluate_candidate, candidate, row.to_dict()) for candidate, row in candidates.iterrows()]
+            rows = [future.result() for future in futures]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return pd.DataFrame(rows).set_index('candidate').sort_values('objective')
+
+def _parse_assignments(values):
+    #name=value command line arguments
+    return dict(value.split('=', 1) for value in values or [])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('candidates', nargs='?', help='csv parameter table, one column per model_config parameter')
+    parser.add_argument('--bounds', nargs='+', help='name=low:high or name=low:high:log, sampled instead of a table')
+    parser.add_argument('--samples', type=int, default=32, help='number of candidates sampled within the bounds')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the sample')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--weights', nargs='+', help='term=weight, terms: ' + ', '.join(OBSERVATIONS))
+    parser.add_argument('--theta-depth', type=float, default=None, help='depth of the water content sensor [m]')
+    parser.add_argument('--no-early-stop', action='store_true', help='runs every candidate to the end')
+    parser.add_argument('--output', default='calibration_results.csv', help='csv file of the results table')
+    args = parser.parse_args()
+
+    if args.candidates is not None:
+        candidates = pd.read_csv(args.candidates)
+    elif args.bounds:
+        bounds = {name: tuple(float(v) if v != 'log' else v for v in bound.split(':'))
+                  for name, bound in _parse_assignments(args.bounds).items()}
+        candidates = sample_candidates(bounds, args.samples, args.seed)
+    else:
+        parser.error('a candidates table or --bounds is required')
+    weights = {term: float(w) for term, w in _parse_assignments(args.weights).items()} if args.weights else None
+
+    results = calibrate(candidates, processes=args.processes, weights=weights, theta_depth=args.theta_depth,
+                        early_stop=not args.no_early_stop)
+    results.to_csv(args.output)
+    print(results.to_string())
@@ -1,6 +1,3 @@
-import model_config as cfg
-from model_setup import z_Above
-
 import numpy as np
 #######################################################################
 #LEAF AREA DENSITY FORMULATION (LAD) [1/m]
@@ -22,4 +19,10 @@ def calc_LAD(z_Above, dz, z_m, Hspec, L_m):
         if z_LAD[i]==Hspec:
             LAD[i]=0
     return LAD
-LAD = calc_LAD(z_Above, cfg.dz, cfg.z_m, cfg.Hspec, cfg.L_m)
\ No newline at end of file
+
+#LAD of the configuration in model_config, built by simulation.default_simulation when first imported by name
+def __getattr__(name):
+    from simulation import default_simulation
+    if name == 'LAD':
+        return default_simulation().LAD
+    raise AttributeError("module 'canopy' has no attribute '" + name + "'")
@@ -0,0 +1,137 @@
+import hashlib
+import os
+from pathlib import Path
+from types import ModuleType
+
+import numpy as np
+from scipy import sparse
+
+from forcing_cache import file_digest
+
+###############################################################################
+#CHECKPOINT AND RESTART
+###############################################################################
+#With checkpoint = True in model_config, Picard writes its state (potentials, time,
+#counters, the outputs saved so far, the variables of the last iteration and the
+#factorized Jacobian of the chord solver) to working_dir/checkpoint_dir/checkpoint.npz
+#every checkpoint_freq seconds of simulated time. With restart = True, Picard resumes
+#from that file, and the run gives the same results, bit for bit, as an uninterrupted one.
+#With stream_output, the streamed snapshots are synced to output/model_out.nc before each
+#checkpoint is written (OutputStream.flush), so this also holds for a killed process: the
+#restarted run rewrites the snapshots after the checkpoint.
+
+CHECKPOINT_FILE = 'checkpoint.npz'
+
+#model_config options that do not change the solution, a checkpoint can be resumed with other values
+#(not stream_output: with it the checkpoint only holds the last saved snapshot, the others are in the stream)
+RUN_OPTIONS = ('print_run_progress', 'print_freq', 'checkpoint', 'checkpoint_freq', 'checkpoint_dir', 'restart',
+               'save_telemetry', 'output_variables', 'output_format', 'output_float32',
+               'forcing_cache', 'forcing_cache_dir')
+
+#workspace variables of the last iteration, carried from one time step to the next
+WORKSPACE_ARRAYS = ('cnp1m', 'knp1m', 'theta', 'Se', 'stress_kx', 'stress_kr', 'stress_roots', 'Kr', 'S_S')
+
+def config_hash(cfg, working_dir):
+    """
+    Hash of the configuration values that change the solution and of the input file
+
+    Parameters
+    ----------
+    cfg : RunConfig or module
+    working_dir : Path
+        directory containing data/input_fname
+
+    Returns
+    -------
+    str
+    """
+    values = sorted((key, repr(value)) for key, value in vars(cfg).items()
+                    if not key.startswith('_') and not isinstance(value, ModuleType) and key not in RUN_OPTIONS)
+    data_path = Path(working_dir) / 'data' / cfg.input_fname
+    digest = file_digest(data_path) if data_path.exists() else ''
+    return hashlib.sha256(repr((values, digest)).encode()).hexdigest()
+
+def checkpoint_path(sim):
+    return sim.working_dir / sim.cfg.checkpoint_dir / CHECKPOINT_FILE
+
+def save_checkpoint(sim, state, saved, ws, telemetry=None):
+    """
+    Writes the state of Picard to checkpoint_path(sim). The file is written next
+    to the previous checkpoint and renamed, so an interruption while writing
+    leaves the previous checkpoint intact.
+
+    Parameters
+    ----------
+    sim : simulation.Simulation
+    state : dict
+        scalars and arrays of the time loop (hn, t, i, dt, sav, niter, n_iterations)
+    saved : dict
+        outputs saved so far (H, K, ...)
+    ws : dict
+        workspace of picard_workspace
+    telemetry : dict
+        record of solver_telemetry (optional)
+    """
+    arrays = {'config_hash': config_hash(sim.cfg, sim.working_dir), 'q_inf': ws['q_inf'], 'n_factor': ws['n_factor']}
+    arrays.update({'state_' + key: value for key, value in state.items()})
+    arrays.update({'saved_' + key: value for key, value in saved.items()})
+    arrays.update({'ws_' + key: ws[key] for key in WORKSPACE_ARRAYS})
+
+    #Jacobian of the factorization kept by the chord solver, refactorized on restart
+    if ws['lu'] is not None:
+        M = ws['lu_matrix']
+        arrays.update(lu_data=M.data, lu_indices=M.indices, lu_indptr=M.indptr, lu_shape=M.shape, lu_dt=ws['lu_dt'])
+
+    if telemetry is not None:
+        arrays.update({'telemetry_' + key: np.asarray(value) for key, value in telemetry.items()})
+
+    path = checkpoint_path(sim)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('.' + path.name)
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+def load_checkpoint(sim, saved, ws, telemetry=None):
+    """
+    Restores the checkpoint of sim into the saved outputs, the workspace and the
+    telemetry record
+
+    Returns
+    -------
+    dict or None
+        state of the time loop (hn, t, i, dt, sav, niter, n_iterations), None if there is no checkpoint
+
+    Raises
+    ------
+    ValueError
+        if the checkpoint was written with another configuration or input file
+    """
+    from scipy.sparse.linalg import splu
+
+    path = checkpoint_path(sim)
+    if not path.exists():
+        return None
+
+    with np.load(path) as data:
+        if str(data['config_hash']) != config_hash(sim.cfg, sim.working_dir):
+            raise ValueError("The checkpoint " + str(path) + " was written with another configuration or input file")
+
+        for key in saved:
+            saved[key][...] = data['saved_' + key]
+        for key in WORKSPACE_ARRAYS:
+            ws[key][...] = data['ws_' + key]
+        ws['q_inf'] = data['q_inf'][()]
+        ws['n_factor'] = int(data['n_factor'])
+
+        if 'lu_data' in data:
+            M = sparse.csc_matrix((data['lu_data'], data['lu_indices'], data['lu_indptr']), shape=tuple(data['lu_shape']))
+            ws['lu'], ws['lu_matrix'], ws['lu_dt'] = splu(M), M, data['lu_dt'][()]
+
+        if telemetry is not None:
+            for key in telemetry:
+                telemetry[key] = list(data['telemetry_' + key]) if 'telemetry_' + key in data else []
+
+        state = {key[len('state_'):]: data[key][()] for key in data.files if key.startswith('state_')}
+    state['hn'] = np.array(state['hn'])
+    return state
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Ensemble runner for parameter sweeps
+
+Runs initial_conditions + Picard + format_model_output for every row of a
+parameter table in a process pool, and collects the water balance and
+transpiration summaries of all members into one table. The forcing is read
+and processed once, and the workers read it from shared memory. So are the
+transpiration inputs (e.g. the NHL transpiration) when no member changes the
+parameters they are computed from.
+
+Usage
+-----
+python ensemble.py members.csv                  #one column per model_config parameter, one row per member
+python ensemble.py members.csv --processes 4 --output ensemble_summary.csv
+python ensemble.py members.csv --batch-size 16   #members integrated in lockstep by each worker (batch)
+
+or from Python:
+
+    members = pd.DataFrame({'Ksat_1': [1e-7, 2e-7, 4e-7], 'n_1': [1.4, 1.5, 1.6]})
+    summary = run_ensemble(members, processes=3)
+"""
+import argparse
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from simulation import RunConfig, Simulation, read_forcing
+
+#parameters computed from others in model_config: name : (parameter, function)
+#they are recomputed for the members that change the parameter but not the derived value
+DERIVED_PARAMETERS = {'m_1': ('n_1', lambda n: 1-(1/n)),
+                      'm_2': ('n_2', lambda n: 1-(1/n))}
+
+def member_config(config, parameters):
+    """
+    Configuration of one member: config with the parameters of its row
+
+    Parameters
+    ----------
+    config : RunConfig
+    parameters : dict
+        model_config name : value, in the units of model_config (e.g. Kr, kmax in m/sPa)
+
+    Returns
+    -------
+    RunConfig
+    """
+    overrides = dict(parameters)
+    for derived, (name, function) in DERIVED_PARAMETERS.items():
+        if name in overrides and derived not in overrides:
+            overrides[derived] = function(overrides[name])
+    return config.replace(**overrides)
+
+def share_forcing(forcing):
+    """
+    Copies the forcing arrays to shared memory blocks
+
+    Returns
+    -------
+    blocks : list
+        SharedMemory blocks, to be closed and unlinked by the caller
+    spec : dict
+        name : (block name, shape, dtype) of each array, for attach_forcing
+    """
+    blocks, spec = [], {}
+    for name, value in forcing.items():
+        value = np.asarray(value)
+        block = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        np.ndarray(value.shape, value.dtype, buffer=block.buf)[...] = value
+        blocks.append(block)
+        spec[name] = (block.name, value.shape, value.dtype.str)
+    return blocks, spec
+
+def attach_forcing(spec):
+    """
+    Attaches the forcing shared by share_forcing in another process
+
+    Returns
+    -------
+    blocks : list
+        SharedMemory blocks, to be kept open while the forcing is used
+    forcing : dict
+        name : read-only view of the shared array
+    """
+    blocks, forcing = [], {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        array = np.ndarray(shape, dtype, buffer=block.buf)
+        array.flags.writeable = False
+        blocks.append(block)
+        forcing[name] = array
+    return blocks, forcing
+
+#forcing and configuration of the worker processes, set by _init_worker
+_worker = {}
+
+def _init_worker(spec, transpiration_spec, config, working_dir):
+    #attaches the shared forcing and transpiration inputs in a worker process
+    blocks, forcing = attach_forcing(spec)
+    transpiration = None
+    if transpiration_spec is not None:
+        transpiration_blocks, transpiration = attach_forcing(transpiration_spec)
+        blocks += transpiration_blocks
+    _worker.update(blocks=blocks, forcing=forcing, transpiration=transpiration, config=config, working_dir=working_dir)
+
+def run_member(member, parameters):
+    """
+    Runs one member in a worker process
+
+    Returns
+    -------
+    dict
+        member, its parameters and the summaries of member_summary, or the error
+        of a member that failed (e.g. Picard did not converge)
+    """
+    row = {'member': member, **parameters}
+    try:
+        config = member_config(_worker['config'], parameters)
+        sim = Simulation(config, _worker['working_dir'], forcing=_worker['forcing'],
+                         transpiration=_worker['transpiration'])
+        outputs = sim.run()
+        output_vars, df_waterbal, df_EP = sim.format_output(outputs)
+        row.update(member_summary(output_vars, df_waterbal), status='ok')
+    except Exception:
+        row.update(status='failed', error=traceback.format_exc(limit=1).strip().splitlines()[-1])
+    return row
+
+def run_member_batch(batch):
+    """
+    Runs several members in lockstep in a worker process (see batch.run_batch)
+
+    Parameters
+    ----------
+    batch : list
+        (member, parameters) of each member
+
+    Returns
+    -------
+    list
+        rows of run_member
+    """
+    from batch import run_batch
+
+    configs = [member_config(_worker['config'], parameters) for _, parameters in batch]
+    try:
+        outputs = run_batch(configs, _worker['working_dir'], _worker['forcing'], _worker['transpiration'])
+    except Exception:
+        error = traceback.format_exc(limit=1).strip().splitlines()[-1]
+        return [{'member': member, **parameters, 'status': 'failed', 'error': error} for member, parameters in batch]
+
+    rows = []
+    for (member, parameters), config, output in zip(batch, configs, outputs):
+        row = {'member': member, **parameters}
+        if output is None:
+            row.update(status='failed', error='Picard iteration did not converge')
+        else:
+            sim = Simulation(config, _worker['working_dir'], forcing=_worker['forcing'],
+                             transpiration=_worker['transpiration'])
+            output_vars, df_waterbal, df_EP = sim.format_output(output)
+            row.update(member_summary(output_vars, df_waterbal), status='ok')
+        rows.append(row)
+    return rows
+
+def member_summary(output_vars, df_waterbal):
+    """
+    Water balance (mm) and transpiration summaries of one member
+
+    Parameters
+    ----------
+    output_vars, df_waterbal :
+        outputs of format_model_output
+
+    Returns
+    -------
+    dict
+    """
+    summary = df_waterbal.iloc[0].to_dict()
+    trans_h = output_vars['trans_h']
+    summary['trans_hourly_max'] = trans_h.max()                #mm/h
+    summary['trans_daily_mean'] = trans_h.resample('D').sum().mean()  #mm/day
+    summary['H_min'] = output_vars['H'].min()                  #MPa
+    return summary
+
+def run_ensemble(members, config=None, working_dir=None, processes=None, batch_size=1):
+    """
+    Runs the members of a parameter table in a process pool
+
+    Parameters
+    ----------
+    members : pandas.DataFrame
+        one row per member, one column per model_config parameter (e.g. Ksat_1,
+        alpha_1, n_1, Kr, qz, kmax, ap, bp); m_1 and m_2 follow n_1 and n_2
+    config : RunConfig
+        configuration shared by all members (model_config if not given)
+    working_dir : str or Path
+        directory with the data/ inputs (current directory if not given)
+    processes : int
+        number of worker processes (number of CPUs if not given)
+    batch_size : int
+        members integrated together by each worker with batch.run_batch (fixed time step
+        Picard only, the members can differ only in batch.BATCH_PARAMETERS)
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per member: parameters, water balance (df_waterbal), transpiration
+        summaries, status and error message of the failed members
+    """
+    #the members keep their outputs in memory (member_summary), they do not share output/model_out.nc
+    config = (config if config is not None else RunConfig()).replace(print_run_progress=False, stream_output=False)
+    working_dir = Path(working_dir) if working_dir is not None else Path.cwd()
+
+    #the forcing does not depend on the swept parameters: read once, shared by all members
+    unknown = set(members.columns) - set(vars(config))
+    if unknown:
+        raise AttributeError("Unknown model_config parameters: " + ", ".join(sorted(unknown)))
+    forcing = read_forcing(config, working_dir)
+    blocks, spec = share_forcing(forcing)
+
+    try:
+        #the transpiration inputs (NHL model run, stomata reductions) are computed once when
+        #no member changes the parameters they depend on, instead of by every member
+        transpiration_spec = None
+        if not set(members.columns) & set(Simulation._INPUTS['transpiration']):
+            transpiration_blocks, transpiration_spec = share_forcing(Simulation(config, working_dir, forcing=forcing).transpiration)
+            blocks += transpiration_blocks
+
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(processes, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(spec, transpiration_spec, config, working_dir)) as pool:
+            if batch_size > 1:
+                rows = [(member, row.to_dict()) for member, row in members.iterrows()]
+                futures = [pool.submit(run_member_batch, rows[i:i+batch_size]) for i in range(0, len(rows), batch_size)]
+                rows = [row for future in futures for row in future.result()]
+            else:
+                futures = [pool.submit(run_member, member, row.to_dict()) for member, row in members.iterrows()]
+                rows = [future.result() for future in futures]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return pd.DataFrame(rows).set_index('member')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('members', help='csv parameter table, one column per model_config parameter')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--output', default='ensemble_summary.csv', help='csv file of the summary table')
+    parser.add_argument('--batch-size', type=int, default=1, help='members integrated together by each worker')
+    args = parser.parse_args()
+
+    summary = run_ensemble(pd.read_csv(args.members), processes=args.processes, batch_size=args.batch_size)
+    summary.to_csv(args.output)
+    print(summary.to_string())
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+###############################################################################
+#FORCING CACHE
+###############################################################################
+#The forcing processed by met_data / met_data_nhl (time series at model resolution)
+#is stored as one .npy file per variable in a directory named after a hash of the
+#input file contents and of the configuration values used to process it. Later
+#runs with the same inputs load the arrays memory-mapped instead of parsing the csv.
+
+CACHE_VERSION = 1  #increase when the processing of the forcing changes
+
+def file_digest(path, chunk_size=2**20):
+    #sha256 of the contents of a file
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def forcing_cache_key(kind, data_path, cfg):
+    """
+    Key of the processed forcing of a run
+
+    Parameters
+    ----------
+    kind : str
+        name of the processing ('pm' for met_data, 'nhl' for met_data_nhl)
+    data_path : Path
+        input csv file
+    cfg : RunConfig or module
+        configuration (start_time, end_time, dt, dt0, tmin, Rho)
+
+    Returns
+    -------
+    str
+    """
+    params = (CACHE_VERSION, kind, file_digest(data_path), str(cfg.start_time), str(cfg.end_time),
+              cfg.dt, cfg.dt0, cfg.tmin, cfg.Rho)
+    return kind + '_' + hashlib.sha256(repr(params).encode()).hexdigest()[:20]
+
+def load_cached_forcing(cache_dir, key):
+    """
+    Loads the arrays stored under key, memory-mapped (read-only)
+
+    Returns
+    -------
+    dict or None
+        None if there is no cache entry for key
+    """
+    entry = Path(cache_dir) / key
+    if not entry.is_dir():
+        return None
+    return {path.stem: np.load(path, mmap_mode='r') for path in entry.glob('*.npy')}
+
+def save_cached_forcing(cache_dir, key, arrays):
+    """
+    Stores arrays (dict of name : array) under key. The entry is written to a
+    temporary directory first and then renamed, so that runs sharing the cache
+    never read a partial entry.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=cache_dir, prefix='.' + key))
+    for name, value in arrays.items():
+        np.save(tmp / (name + '.npy'), np.asarray(value))
+    try:
+        os.rename(tmp, cache_dir / key)
+    except OSError:  #entry written in the meantime by another run
+        for path in tmp.iterdir():
+            path.unlink()
+        tmp.rmdir()
@@ -1,14 +1,19 @@
-import model_config as cfg
-from met_data import q_rain
-from model_setup import nz, dz, z, nz_s, nz_r, nz_clay, z_soil
-
 import numpy as np
 #######################################################################
 #INITIAL CONDITIONS
 #######################################################################
 #soil initial conditions as described in the paper [VERMA et al., 2014]
 
-def initial_conditions():
+def initial_conditions(sim=None):
+    #sim: simulation.Simulation giving the configuration, grid and precipitation
+    #(the configuration in model_config if not given)
+    if sim is None:
+        from simulation import default_simulation
+        sim = default_simulation()
+    cfg, q_rain = sim.cfg, sim.q_rain
+    nz, z, nz_s, nz_r, nz_clay, z_soil = sim.nz, sim.z, sim.nz_s, sim.nz_r, sim.nz_clay, sim.z_soil
+    dz = cfg.dz
+
     initial_H=np.zeros(shape=nz)
 
     factor_soil=(cfg.H_init_soilbottom-(cfg.H_init_soilmid))/(int((cfg.clay_d-cfg.cte_clay)/dz)) #factor for interpolation
@@ -0,0 +1,212 @@
+from functools import lru_cache
+
+import numpy as np
+from scipy import linalg
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+
+###############################################################################
+#LINEAR SOLVERS FOR THE PICARD STEP
+###############################################################################
+#The MPFD matrix A (equations S.25 to S.41) is tridiagonal, plus the soil-root
+#coupling terms of the sink/source (equation S.22). Soil node nz_s-nr+e is always
+#coupled with root node nz_s+e, so the coupling entries lie on the two
+#diagonals at offset +-nr, where nr = nz_r-nz_s is the number of root nodes.
+#A is therefore banded and can be solved without forming a dense pseudo-inverse.
+
+def coupling_offset(nz_s, nz_r):
+    """
+    Distance between a soil node and the root node it exchanges water with
+
+    Parameters
+    ----------
+    nz_s : int
+        number of soil nodes
+    nz_r : int
+        number of soil + root nodes
+
+    Returns
+    -------
+    int
+        offset of the soil-root coupling diagonals of A
+    """
+    return nz_r - nz_s
+
+def _merge_coupling(lower, upper, coupling, nr):
+    #with a single root node the coupling lies on the tridiagonal band itself
+    if nr == 1:
+        lower = lower + coupling
+        upper = upper + coupling
+    return lower, upper
+
+def dense_from_diagonals(lower, diag, upper, coupling, nr):
+    """
+    Builds the dense matrix A from its diagonals
+
+    Parameters
+    ----------
+    lower : array (nz-1)
+        sub-diagonal A[i+1,i]
+    diag : array (nz)
+        main diagonal A[i,i]
+    upper : array (nz-1)
+        super-diagonal A[i,i+1]
+    coupling : array (nz-nr)
+        soil-root coupling A[i,i+nr] = A[i+nr,i]
+    nr : int
+        offset of the coupling diagonals
+
+    Returns
+    -------
+    A : array (nz, nz)
+    """
+    lower, upper = _merge_coupling(lower, upper, coupling, nr)
+    A = np.diagflat(diag) + np.diagflat(upper, 1) + np.diagflat(lower, -1)
+    if nr > 1:
+        A = A + np.diagflat(coupling, nr) + np.diagflat(coupling, -nr)
+    return A
+
+def banded_from_diagonals(lower, diag, upper, coupling, nr):
+    """
+    Stores A in the LAPACK banded format used by scipy.linalg.solve_banded
+
+    Parameters
+    ----------
+    see dense_from_diagonals
+
+    Returns
+    -------
+    ab : array (2*nr+1, nz)
+        ab[nr + i - j, j] = A[i,j]
+    """
+    lower, upper = _merge_coupling(lower, upper, coupling, nr)
+    nz = len(diag)
+    ab = np.zeros(shape=(2*nr + 1, nz))
+    ab[nr, :] = diag
+    ab[nr - 1, 1:] = upper
+    ab[nr + 1, :-1] = lower
+    if nr > 1:
+        ab[0, nr:] = coupling
+        ab[2*nr, :-nr] = coupling
+    return ab
+
+def sparse_from_diagonals(lower, diag, upper, coupling, nr):
+    """
+    Stores A as a scipy.sparse CSC matrix
+
+    Parameters
+    ----------
+    see dense_from_diagonals
+
+    Returns
+    -------
+    A : scipy.sparse.csc_matrix (nz, nz)
+    """
+    lower, upper = _merge_coupling(lower, upper, coupling, nr)
+    if nr > 1:
+        return sparse.diags([coupling, lower, diag, upper, coupling], [-nr, -1, 0, 1, nr], format='csc')
+    return sparse.diags([lower, diag, upper], [-1, 0, 1], format='csc')
+
+def solve_linear_system(lower, diag, upper, coupling, nr, R, solver='banded', nz_s=None):
+    """
+    Solves A * deltam = R for the Picard increment deltam
+
+    Parameters
+    ----------
+    lower, diag, upper, coupling, nr :
+        diagonals of A (see dense_from_diagonals)
+    R : array (nz)
+        residual of MPFD (right hand side)
+    solver : str
+        'dense'  : SVD pseudo-inverse of the full matrix (original formulation)
+        'sparse' : sparse LU factorization (SuperLU) of the CSC matrix
+        'banded' : banded LU factorization (LAPACK gbsv) of A reordered to bandwidth 2
+                   (see interleaved_band_indices), or with bandwidth nr if nz_s is not given
+    nz_s : int
+        number of soil nodes
+
+    Returns
+    -------
+    deltam : array (nz)
+    """
+    if solver == 'banded' and nz_s is not None:
+        return solve_linear_system_batch(lower[None], diag[None], upper[None], coupling[None], nr, R[None], nz_s)[0]
+    elif solver == 'banded':
+        return linalg.solve_banded((nr, nr), banded_from_diagonals(lower, diag, upper, coupling, nr), R,
+                                   overwrite_ab=True, check_finite=False)
+    elif solver == 'sparse':
+        return spsolve(sparse_from_diagonals(lower, diag, upper, coupling, nr), R)
+    elif solver == 'dense':
+        return np.dot(np.linalg.pinv(dense_from_diagonals(lower, diag, upper, coupling, nr)), R)
+    else:
+        raise ValueError("Unknown linear solver: " + str(solver))
+
+@lru_cache(maxsize=None)
+def interleaved_band_indices(nz, nz_s, nr):
+    """
+    Positions of the entries of A in the banded storage of the reordered matrix,
+    where each soil node nz_s-nr+e is placed next to the root node nz_s+e it is
+    coupled with. In this order the soil-soil and root-root neighbours are two
+    positions apart and A has bandwidth 2 instead of nr. The entries between the
+    top soil node and the bottom root node, which would lie outside this band, are
+    zero (no-flux boundaries of face_conductivities).
+
+    Returns
+    -------
+    order : array (nz)
+        node at each position of the reordered matrix
+    entries : dict
+        band of A ('diag', 'upper', 'lower', 'coupling_upper', 'coupling_lower') :
+        (entries of the band, row in the banded storage, column) of the entries within the band
+    """
+    pairs = np.column_stack((np.arange(nz_s-nr, nz_s), np.arange(nz_s, nz_s+nr))).ravel()
+    order = np.concatenate((np.arange(0, nz_s-nr), pairs, np.arange(nz_s+nr, nz)))
+    position = np.argsort(order)
+
+    #(row, column) of the entries of each band of A
+    k, u, c = np.arange(nz), np.arange(nz-1), np.arange(nz-nr)
+    bands = {'diag': (k, k), 'upper': (u, u+1), 'lower': (u+1, u), 'coupling_upper': (c, c+nr), 'coupling_lower': (c+nr, c)}
+
+    entries = {}
+    for band, (i, j) in bands.items():
+        offset = position[i] - position[j]
+        inside = np.abs(offset) <= 2
+        entries[band] = (np.flatnonzero(inside), 2 + offset[inside], position[j][inside])
+    return order, entries
+
+def solve_linear_system_batch(lower, diag, upper, coupling, nr, R, nz_s):
+    """
+    Solves the systems A_b * deltam_b = R_b of a batch of members in one banded LU
+    factorization (LAPACK gbsv). Each A_b is reordered to bandwidth 2 (see
+    interleaved_band_indices) and the members are stacked along the diagonal of a
+    single banded matrix, the entries linking consecutive members being zero.
+
+    Parameters
+    ----------
+    lower, diag, upper, coupling :
+        diagonals of the members (see dense_from_diagonals), with a leading member axis
+    nr : int
+        offset of the coupling diagonals
+    R : array (members, nz)
+        residuals of MPFD (right hand sides)
+    nz_s : int
+        number of soil nodes
+
+    Returns
+    -------
+    deltam : array (members, nz)
+    """
+    members, nz = diag.shape
+    order, entries = interleaved_band_indices(nz, nz_s, nr)
+    first = nz*np.arange(members)[:, None]  #first column of each member in the stacked matrix
+
+    ab = np.zeros(shape=(5, members*nz))
+    for band, values in (('diag', diag), ('upper', upper), ('lower', lower),
+                         ('coupling_upper', coupling), ('coupling_lower', coupling)):
+        index, row, col = entries[band]
+        ab[row, first + col] += values[:, index]
+
+    x = linalg.solve_banded((2, 2), ab, R[:, order].ravel(), overwrite_ab=True, overwrite_b=True, check_finite=False)
+    deltam = np.empty(shape=(members, nz))
+    deltam[:, order] = x.reshape(members, nz)
+    return deltam
@@ -5,23 +5,39 @@ Created on Mon Aug  5 11:10:31 2019
 @author: mdef0001
 """
 import time
-start = time.time()  # start run clock
 
 from initial_conditions import initial_conditions
-from model_functions import format_model_output, Picard, save_output
-import model_config as cfg
+from model_functions import format_model_output, Picard, save_output, solver_telemetry, save_telemetry, telemetry_summary
+from simulation import Simulation
 
-############## Calculate initial conditions #######################
-H_initial, Head_bottom_H = initial_conditions()
+def main():
+    start = time.time()  # start run clock
 
-############## Run the model #######################
-H,K,S_stomata,theta, S_kx, S_kr,C,Kr_sink, Capac, S_sink,EVsink_ts, THETA, infiltration,trans_2d = Picard(H_initial, Head_bottom_H)
+    ############## Configuration of the run (model_config) #######################
+    sim = Simulation()
+    cfg = sim.cfg
 
-############## Calculate water balance and format model outputs #######################
-output_vars, df_waterbal, df_EP = format_model_output(H,K,S_stomata,theta, S_kx, S_kr,C,Kr_sink, Capac, S_sink, EVsink_ts,
-                                                     THETA, infiltration,trans_2d, cfg.dt, cfg.dz)
+    ############## Calculate initial conditions #######################
+    H_initial, Head_bottom_H = initial_conditions(sim)
 
-####################### Save model outputs ###################################
-save_output(output_vars, df_waterbal, df_EP)
+    ############## Run the model #######################
+    telemetry = solver_telemetry() if cfg.save_telemetry else None
+    H,K,S_stomata,theta, S_kx, S_kr,C,Kr_sink, Capac, S_sink,EVsink_ts, THETA, infiltration,trans_2d = Picard(H_initial, Head_bottom_H,
+                                                                                                              telemetry, sim)
 
-print(f"run time: {time.time() - start} s")  # end run clock
\ No newline at end of file
+    ############## Calculate water balance and format model outputs #######################
+    output_vars, df_waterbal, df_EP = format_model_output(H,K,S_stomata,theta, S_kx, S_kr,C,Kr_sink, Capac, S_sink, EVsink_ts,
+                                                         THETA, infiltration,trans_2d, cfg.save_freq, cfg.dz, sim)
+
+    ####################### Save model outputs ###################################
+    save_output(output_vars, df_waterbal, df_EP, sim)
+    if telemetry is not None:
+        save_telemetry(telemetry, sim)
+        print(telemetry_summary(telemetry, sim).to_string(index=False))
+
+    print(f"run time: {time.time() - start} s")  # end run clock
+
+#the worker processes of the NHL engine (nhl_config.processes > 1) are spawned and
+#import this module again, so the run must only start when it is the main script
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,8 @@
-from pathlib import Path
 import pandas as pd
 import numpy as np
 
-import model_config as cfg
-from model_setup import z_upper, interpolate_2d
+from model_setup import interpolate_2d
+from forcing_cache import forcing_cache_key, load_cached_forcing, save_cached_forcing
 
 # Helper functions
 def calc_NETRAD(SW_in):
@@ -21,9 +20,9 @@ def calc_NETRAD(SW_in):
         Net radiation
     """
     return SW_in * 0.6
-def calc_infiltration_rate(precipitation, tmax, dt0):
-    precipitation=precipitation/cfg.dt #dividing the value over half hour to seconds [mm/s]
-    rain=precipitation/cfg.Rho  #[converting to m/s]
+def calc_infiltration_rate(precipitation, tmax, dt0, t_data, dt, Rho):
+    precipitation=precipitation/dt #dividing the value over half hour to seconds [mm/s]
+    rain=precipitation/Rho  #[converting to m/s]
     q_rain=np.interp(np.arange(0,tmax+dt0,dt0), t_data, rain) #interpolating
     q_rain=np.nan_to_num(q_rain) #m/s precipitation rate= infiltration rate
     return q_rain
@@ -31,76 +30,146 @@ def calc_esat(Ta):
     return 611*np.exp((17.27*(Ta-273.15))/(Ta-35.85)) #Pascal
 def calc_delta(Ta, e_sat):
     return (4098/((Ta-35.85)**2))*e_sat
-def interp_to_model_res(var, tmax, dt0):
+def interp_to_model_res(var, tmax, dt0, t_data):
     return np.interp(np.arange(0, tmax + dt0, dt0), t_data, var)
 
-###########################################################
-#Load and format input data
-###########################################################
+def read_met_data(cfg, data_path):
+    """
+    Reads the input data of the Penman-Monteith scheme and interpolates it to
+    the model resolution
+
+    Parameters
+    ----------
+    cfg : RunConfig or module
+        model configuration (start_time, end_time, dt, dt0, tmin, Rho)
+    data_path : Path
+        input csv file
+
+    Returns
+    -------
+    dict
+        tmax, t_data and the time series q_rain, Ta, SW_in, VPD, NET, delta_2d at model resolution
+    """
+    ###########################################################
+    #Load and format input data
+    ###########################################################
 
-#Input file
-working_dir = Path.cwd()
-data_path = working_dir / 'data' / cfg.input_fname
+    start_time = pd.to_datetime(cfg.start_time)
+    end_time = pd.to_datetime(cfg.end_time)
 
-start_time = pd.to_datetime(cfg.start_time)
-end_time = pd.to_datetime(cfg.end_time)
+    #read input data
+    df = pd.read_csv(data_path)
+    step_time_hh = pd.Series(pd.date_range(start_time, end_time, freq=str(cfg.dt)+'s'))
 
-#read input data
-df = pd.read_csv(data_path)
-step_time_hh = pd.Series(pd.date_range(start_time, end_time, freq=str(cfg.dt)+'s'))
+    # Select data for length of run
+    df = df.iloc[0:len(step_time_hh)]
+    df.index = step_time_hh
 
-# Select data for length of run
-df = df.iloc[0:len(step_time_hh)]
-df.index = step_time_hh
+    tmax = len(df) * cfg.dt
+    t_data = np.arange(cfg.tmin, tmax, cfg.dt)         # data time grids for input data
+    t_data=list(t_data)
 
-tmax = len(df) * cfg.dt
-t_data = np.arange(cfg.tmin, tmax, cfg.dt)         # data time grids for input data
-t_data=list(t_data)
-nt_data=len(t_data)                      #length of input data
+    #variables to arrays
+    precipitation = df['Rain (mm)'].values
+    Ta_C = df['T(degC)']
+    SW_in = df['Radiation (W/m2)']
+    VPD = df['VPD (kPa)']
 
-#variables to arrays
-precipitation = df['Rain (mm)'].values
-Ta_C = df['T(degC)']
-SW_in = df['Radiation (W/m2)']
-VPD = df['VPD (kPa)']
+    #temperature
+    Ta = Ta_C + 273.15 #converting temperature from degree Celsius to Kelvin
+    Ta = Ta.interpolate(method = 'linear')
 
-#temperature
-Ta = Ta_C + 273.15 #converting temperature from degree Celsius to Kelvin
-Ta = Ta.interpolate(method = 'linear')
+    #incoming solar radiation
+    SW_in = SW_in.interpolate(method = 'time')
 
-#incoming solar radiation
-SW_in = SW_in.interpolate(method = 'time')
+    #vapor pressure deficit
+    VPD=VPD[VPD > 0] #eliminating negative VPD
+    VPD = VPD.reindex(SW_in.index)
+    VPD=VPD.interpolate(method='linear')*1000  #kPa to Pa
+    VPD=VPD.fillna(0)
 
-#vapor pressure deficit
-VPD=VPD[VPD > 0] #eliminating negative VPD
-VPD = VPD.reindex(SW_in.index)
-VPD=VPD.interpolate(method='linear')*1000  #kPa to Pa
-VPD=VPD.fillna(0)
+    ########################################################
+    #SETTING PRECIPITATION AS INFILTRATION BOUNDARY CONDITION
+    #in case of set by user
+    ###########################################################
 
-########################################################
-#SETTING PRECIPITATION AS INFILTRATION BOUNDARY CONDITION
-#in case of set by user
-###########################################################
+    q_rain = calc_infiltration_rate(precipitation, tmax, cfg.dt0, t_data, cfg.dt, cfg.Rho)
 
-q_rain = calc_infiltration_rate(precipitation, tmax, cfg.dt0)
+    ########################################################################
+    #INTERPOLATING VARIABLES FOR PENMAN-MONTEITH TRANSPIRATION
+    #variables are in the data resolution (half-hourly) and are interpolated to model resolution
+    ##########################################################################
 
-########################################################################
-#INTERPOLATING VARIABLES FOR PENMAN-MONTEITH TRANSPIRATION
-#variables are in the data resolution (half-hourly) and are interpolated to model resolution
-##########################################################################
+    Ta = interp_to_model_res(Ta, tmax, cfg.dt0, t_data)
+    SW_in = interp_to_model_res(SW_in, tmax, cfg.dt0, t_data)
+    VPD = interp_to_model_res(VPD, tmax, cfg.dt0, t_data)
 
+    e_sat = calc_esat(Ta)
+    delta_2d = calc_delta(Ta, e_sat)
 
-Ta = interp_to_model_res(Ta, tmax, cfg.dt0)
-SW_in = interp_to_model_res(SW_in, tmax, cfg.dt0)
-VPD = interp_to_model_res(VPD, tmax, cfg.dt0)
+    NET = calc_NETRAD(SW_in)
 
-e_sat = calc_esat(Ta)
-delta_2d = calc_delta(Ta, e_sat)
+    return {'tmax': tmax, 't_data': np.asarray(t_data), 'q_rain': q_rain, 'Ta': Ta, 'SW_in': SW_in, 'VPD': VPD,
+            'NET': NET, 'delta_2d': delta_2d}
 
-NET = calc_NETRAD(SW_in)
+def load_met_data(cfg, working_dir, nz_upper, forcing=None):
+    """
+    Forcing of the Penman-Monteith scheme at model resolution, read with
+    read_met_data or, with cfg.forcing_cache, loaded memory-mapped from the
+    forcing cache (see forcing_cache) when the same input was processed before
+
+    Parameters
+    ----------
+    cfg : RunConfig or module
+        model configuration (input_fname, start_time, end_time, dt, dt0, ...)
+    working_dir : Path
+        directory containing data/input_fname
+    nz_upper : int
+        number of stem nodes, for the canopy-distributed variables
 
-####2d interpolation of met data
-NET_2d = interpolate_2d(NET, len(z_upper))
-VPD_2d = interpolate_2d(VPD, len(z_upper))
-Ta_2d = interpolate_2d(Ta, len(z_upper))
-SW_in_2d = interpolate_2d(SW_in, len(z_upper))
\ No newline at end of file
+    forcing : dict
+        arrays returned by read_met_data for this configuration (e.g. shared by the
+        members of an ensemble), used instead of reading the input file
+
+    Returns
+    -------
+    dict
+        start_time, end_time, tmax, t_data, q_rain, Ta, SW_in, VPD, NET at model
+        resolution, delta_2d, and NET_2d, VPD_2d, Ta_2d, SW_in_2d as views of the time
+        series repeated over the canopy nodes (see model_setup.interpolate_2d)
+    """
+    #Input file
+    data_path = working_dir / 'data' / cfg.input_fname
+
+    met = dict(forcing) if forcing is not None else None
+    if met is None and cfg.forcing_cache:
+        cache_dir = working_dir / cfg.forcing_cache_dir
+        key = forcing_cache_key('pm', data_path, cfg)
+        met = load_cached_forcing(cache_dir, key)
+    if met is None:
+        met = read_met_data(cfg, data_path)
+        if cfg.forcing_cache:
+            save_cached_forcing(cache_dir, key, met)
+
+    met['tmax'] = np.asarray(met['tmax']).item()
+    met['t_data'] = list(met['t_data'])
+    met['start_time'] = pd.to_datetime(cfg.start_time)
+    met['end_time'] = pd.to_datetime(cfg.end_time)
+
+    ####2d interpolation of met data (zero-stride views, no copies)
+    met['NET_2d'] = interpolate_2d(met['NET'], nz_upper)
+    met['VPD_2d'] = interpolate_2d(met['VPD'], nz_upper)
+    met['Ta_2d'] = interpolate_2d(met['Ta'], nz_upper)
+    met['SW_in_2d'] = interpolate_2d(met['SW_in'], nz_upper)
+
+    return met
+
+#Forcing of the configuration in model_config (q_rain, NET_2d, tmax, ...), loaded by
+#simulation.default_simulation when first imported by name
+def __getattr__(name):
+    from simulation import Simulation, default_simulation
+    if name == 'working_dir':
+        return default_simulation().working_dir
+    if name in Simulation._MET:
+        return getattr(default_simulation(), name)
+    raise AttributeError("module 'met_data' has no attribute '" + name + "'")
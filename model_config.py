@@ -19,6 +19,12 @@ end_time = "2007-01-01 00:02:00" #end of simulation
 dt = 1800  #seconds - input data resolution
 tmin = 0  #tmin [s]
 
+#Forcing cache: the forcing processed at model resolution is stored in forcing_cache_dir
+#(relative to the working directory) and loaded memory-mapped by later runs with the same
+#input file, start_time, end_time, dt and dt0
+forcing_cache = False
+forcing_cache_dir = 'cache'
+
 ###############################################################################
 #RUN OPTIONS - printing
 ###############################################################################
@@ -41,6 +47,71 @@ dz = 0.1  #model spatial resolution [m]
 
 stop_tol = 0.0001  #stop tolerance of equation converging
 
+#Linear solver for the Picard increment (A * deltam = R_MPFD)
+#'dense'  : SVD pseudo-inverse of the full matrix (original formulation, slow)
+#'sparse' : sparse LU factorization of A
+#'banded' : banded LU factorization of A (tridiagonal + soil-root coupling diagonals)
+linear_solver = 'banded'
+
+#Nonlinear solver of each time step
+#'picard' : modified Picard iteration (Celia et al., 1990), solved with linear_solver
+#'newton' : Newton-Raphson with the analytic Jacobian of the MPFD residual (sparse LU)
+#'chord'  : Newton-Raphson reusing the LU factorization of the Jacobian across iterations and
+#           time steps while the increments decrease by at least a factor chord_rate per iteration
+nonlinear_solver = 'picard'
+chord_rate = 0.1
+
+#Bounded memory: the per time step scratch arrays of Picard (transpiration, sinks/sources, Se)
+#are single column buffers instead of arrays over all model time steps; only the half-hourly
+#outputs are kept, so the memory of Picard does not depend on the run length
+bounded_memory = False
+
+#Compiled time step (requires numba, otherwise the NumPy implementation is used)
+#only applies to nonlinear_solver = 'picard', which then uses its own banded solver instead of linear_solver
+numba_kernel = False
+
+#OUTPUTS
+save_freq = 1800  #interval of the saved outputs [s], multiple of dt0 (the water balance sums the saved rates)
+                  #dividing 3600 s, or longer than 3600 s (trans_h is then accumulated over each interval)
+#outputs written by save_output: a profile of model_functions.OUTPUT_PROFILES ('all', 'water_balance')
+#or a list of names, e.g. ['trans_h', 'df_waterbal', 'THETA', 'H']
+output_variables = 'all'
+#'csv': one file per variable; 'npz': compressed output/model_output.npz;
+#'netcdf': zlib compressed output/model_output.nc (requires netCDF4)
+output_format = 'csv'
+output_float32 = False  #write the outputs (and the streamed outputs) in single precision
+
+#Streaming output: the outputs saved every save_freq (H, K, Capac, S_kx, S_kr, S_sink, Kr_sink, EVsink_ts, THETA,
+#trans_2d, infiltration) are appended to output/model_out.nc by a background thread while the model
+#runs, instead of being written to csv files at the end, and are not kept in memory (requires netCDF4)
+stream_output = False
+
+#Checkpoints: the state of the time loop is written to checkpoint_dir/checkpoint.npz (relative to the
+#working directory) every checkpoint_freq seconds of simulated time (multiple of save_freq);
+#with restart = True the run resumes from that checkpoint, with the same results as an uninterrupted run
+checkpoint = False
+checkpoint_freq = 86400
+checkpoint_dir = 'checkpoints'
+restart = False
+
+#Solver telemetry: iterations, final max |deltam|, timings, infiltration and cavitation of every time step
+#written to output/solver_telemetry.csv and output/solver_summary.csv
+save_telemetry = False
+cavitation_threshold = 0.5  #a step counts as cavitating when some xylem node keeps less than this fraction of its conductivity
+
+#ADAPTIVE TIME STEPPING
+#the time step grows when the Picard iterations converge quickly and shrinks when they struggle;
+#a step that does not converge in max_iter iterations is repeated with a smaller time step.
+#Steps always land on the half-hourly saving times, dt0 is used as the first time step
+adaptive_dt = False  #False: fixed time step dt0
+dt_min = 1           #minimum time step [s]
+dt_max = 120         #maximum time step [s] - transpiration is lagged by one step, larger values lose accuracy
+iter_grow = 4        #time step grows if Picard converges in iter_grow iterations or less
+iter_shrink = 10     #time step shrinks if Picard needs more than iter_shrink iterations
+dt_grow = 1.5        #growth factor of the time step
+dt_shrink = 0.5      #reduction factor of the time step
+max_iter = 30        #maximum number of Picard iterations before the step is repeated with a smaller dt
+
 #############################################################################
 #MODEL PARAMETERS
 #Values according to Verma et al., 2014
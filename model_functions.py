@@ -1,84 +1,92 @@
 #importing libraries
+from time import perf_counter
 import numpy as np
 import pandas as pd
-from scipy import linalg
-from numpy.linalg import multi_dot
+from scipy import sparse
+from scipy.sparse.linalg import splu
+
+from linear_solver import coupling_offset, interleaved_band_indices, solve_linear_system
+from numba_kernel import BAND, HAVE_NUMBA, picard_step_kernel
+from transpiration import jarvis_fleaf, calc_transpiration
+from model_setup import soil_node_parameters
+from output_writer import STREAM_VARIABLES, open_output_stream, read_stream_summary
+from checkpoint import load_checkpoint, save_checkpoint
+
+#The model configuration, grid and forcing are given by a simulation.Simulation (sim),
+#which the step functions find in their workspace ws['sim']. Functions called without
+#one use simulation.default_simulation(), built from model_config.
+def _simulation(sim):
+    if sim is None:
+        from simulation import default_simulation
+        sim = default_simulation()
+    return sim
+
+#cavitation curve, K and C shared by the root and stem xylem
+#results are written into the buffers in out=(C, K, cavitation) when given, so the
+#Picard iterations can reuse the same arrays instead of allocating new ones
+#The nodal functions below also accept a batch of members: potentials of shape (members, nodes)
+#with parameters of shape (members, 1) (see batch), the nodes being always the last axis
+def xylem_hydraulics(arg, ap, bp, k_ind, Aind, p, sat_xylem, Phi_0, out=None):
 
-from model_setup import z_soil, nz_s, nz_r, z_upper, z, nz, nz_sand, nz_clay
-from met_data import tmax, start_time, end_time, working_dir
+    #arg= potential [Pa]
+    if out is None:
+        C, K, cavitation = np.empty(np.shape(arg)), np.empty(np.shape(arg)), np.empty(np.shape(arg))
+    else:
+        C, K, cavitation = out
+
+    #CAVITATION CURVE: 1-1/(1+exp(ap*(arg-bp))), no cavitation for positive potentials
+    np.subtract(arg, bp, out=cavitation)
+    np.multiply(ap, cavitation, out=cavitation)
+    np.exp(cavitation, out=cavitation)
+    np.add(1, cavitation, out=cavitation)
+    np.divide(1, cavitation, out=cavitation)
+    np.subtract(1, cavitation, out=cavitation)
+    np.copyto(cavitation, 1, where=arg>0)
+
+    #K = k_ind*Aind*cavitation
+    np.multiply(k_ind*Aind, cavitation, out=K)
+
+    #CAPACITANCE FUNCTION AS IN BOHRER ET AL 2005
+    np.subtract(Phi_0, arg, out=C)
+    np.divide(C, Phi_0, out=C)
+    np.power(C, -(p+1), out=C)
+    np.multiply((Aind*p*sat_xylem)/(Phi_0), C, out=C)
 
-import model_config as cfg
+    return C, K, cavitation
 
-#Imports for PM transpiration
-if cfg.transpiration_scheme == 0:
-    from met_data import VPD_2d, NET_2d, delta_2d, SW_in
-    from transpiration import jarvis_fleaf, calc_transpiration, f_Ta_2d, f_d_2d, f_s_2d
-    from canopy import LAD
-    from met_data import q_rain
+#derivatives of the xylem C and K with respect to the potential, used by the Newton solver
+#cavitation is the cavitation curve returned by xylem_hydraulics for the same potentials
+def xylem_hydraulics_derivatives(arg, cavitation, ap, k_ind, Aind, p, sat_xylem, Phi_0):
 
-#Imports for NHL transpiration
-elif cfg.transpiration_scheme == 1:
-    import nhl_transpiration.nhl_config as ncfg
-    from nhl_transpiration.NHL_functions import calc_stem_wp_response, calc_transpiration_nhl
-    from nhl_transpiration.main import NHL_modelres, LAD
-    from nhl_transpiration.met_data_nhl import q_rain
+    #dK/dPhi - the cavitation curve is constant for positive potentials
+    dK=np.where(arg>0, 0, k_ind*Aind*ap*cavitation*(1-cavitation))
 
+    #dC/dPhi of the capacitance function of Bohrer et al 2005
+    dC=((Aind*p*sat_xylem)/(Phi_0))*((p+1)/Phi_0)*((Phi_0-arg)/Phi_0)**(-(p+2))
 
-##############Temporal discretization according to MODEL resolution
-t_num = np.arange(0,tmax+cfg.dt0,cfg.dt0)         #[s]
-nt = len(t_num)  #number of time steps
-########################################
+    return dC, dK
 
 #function for stem xylem: K and C
-def Porous_media_xylem(arg, ap, bp, kmax, Aind_x, p, sat_xylem, Phi_0):
+def Porous_media_xylem(arg, ap, bp, kmax, Aind_x, p, sat_xylem, Phi_0, out=None):
 
     #arg= potential [Pa]
-    cavitation_xylem=np.zeros(shape=(len(arg)))
-
-    for i in np.arange(0,len(cavitation_xylem),1):
-        if arg[i]>0:
-            cavitation_xylem[i]=1
-        else:
-            cavitation_xylem[i]=(1-1/(1+np.exp(ap*(arg[i]-bp))))
-
     #Index Ax/As - area of xylem per area of soil
     #kmax = m/s
-    K=kmax*Aind_x*cavitation_xylem
-
-    #CAPACITANCE FUNCTION AS IN BOHRER ET AL 2005
-    C=np.zeros(shape=len(z[nz_r:nz]))
-
-    C=((Aind_x*p*sat_xylem)/(Phi_0))*((Phi_0-arg)/Phi_0)**(-(p+1))
+    C, K, cavitation_xylem = xylem_hydraulics(arg, ap, bp, kmax, Aind_x, p, sat_xylem, Phi_0, out)
 
     return C,K, cavitation_xylem
 ########################################################################################
 
 #function for root xylem: K and C
-def Porous_media_root(arg, ap, bp, Ksax, Aind_r, p, sat_xylem, Phi_0):
+def Porous_media_root(arg, ap, bp, Ksax, Aind_r, p, sat_xylem, Phi_0, out=None):
      #arg= potential (Pa)
-    stress_kr=np.zeros(shape=(len(arg)))
-
-    for i in np.arange(0,len(stress_kr),1):
-        if arg[i]>0:
-            stress_kr[i]=1
-        else:
-            stress_kr[i]=(1-1/(1+np.exp(ap*(arg[i]-bp))))  #CAVITATION CURVE FOR THE ROOT XYLEM
-
 
     #Index Ar/As - area of root xylem per area of soil
     #considered 1 following VERMA ET AL 2014 {for this case}
 
-    #Keax = effective root axial conductivity
-    K=Ksax*Aind_r*stress_kr #[m2/s Pa]
-
-    #KEEPING CAPACITANCE CONSTANT - using value according to VERMA ET AL., 2014
-    C=np.zeros(shape=nz_r-nz_s)
-    #C[:]=1.1*10**(-11)  #(1/Pa)
-
-    #CAPACITANCE FUNCTION AS IN BOHRER ET AL 2005
-
-    #considering axial area rollowing basal area [cylinder]
-    C=((Aind_r*p*sat_xylem)/(Phi_0))*((Phi_0-arg)/Phi_0)**(-(p+1))
+    #Keax = effective root axial conductivity [m2/s Pa]
+    #capacitance considering axial area rollowing basal area [cylinder]
+    C, K, stress_kr = xylem_hydraulics(arg, ap, bp, Ksax, Aind_r, p, sat_xylem, Phi_0, out)
 
     return C, K, stress_kr
 
@@ -87,384 +95,870 @@ def Porous_media_root(arg, ap, bp, Ksax, Aind_r, p, sat_xylem, Phi_0):
 #vanGenuchten for soil K and C
 def vanGenuchten(arg, z, g, Rho, clay_d, theta_S1, theta_R1, alpha_1, n_1, m_1, Ksat_1, theta_S2, theta_R2, alpha_2, n_2, m_2, Ksat_2, dtO):
 
+    params = soil_node_parameters(z, clay_d, theta_S1, theta_R1, alpha_1, n_1, m_1, Ksat_1,
+                                  theta_S2, theta_R2, alpha_2, n_2, m_2, Ksat_2)
+    return vanGenuchten_nodes(arg, *params, g, Rho)
+
+#vanGenuchten for soil K and C with the per-node parameters from model_setup.soil_node_parameters
+def vanGenuchten_nodes(arg, theta_S, theta_R, alpha, n, m, Ksat, g, Rho):
+
     #arg = potential from Pascal to meters
-    theta=np.zeros(shape=len(arg))
     arg=((arg)/(g*Rho))   #m
-
-    Se=np.zeros(shape=len(arg))
-    K=np.zeros(shape=len(arg))
-    C=np.zeros(shape=len(arg))
+    unsat=arg<0
     #considering l = 0.5
 
-    for i in np.arange(0,len(arg),1):
-        if z[i]<=clay_d : #clay_d=4.2m for verma
-
-            if arg[i]<0:
-            #Compute the volumetric moisture content
-                theta[i] = (theta_S1 - theta_R1)/((1 + (alpha_1*abs(arg[i]))**n_1)**m_1) + theta_R1  #m3/m3
-            #Compute the effective saturation
-                Se[i] = ((theta[i] - theta_R1)/(theta_S1 - theta_R1)) ## Unitless factor
-            #Compute the hydraulic conductivity
-                K[i]=Ksat_1*Se[i]**(1/2)*(1 - (1 - Se[i]**(1/m_1))**m_1)**2   # van genuchten Eq.8 (m/s) #
-            if arg[i]>=0:
-                theta[i]=theta_S1
-                K[i]=Ksat_1
-
-            C[i]=((-alpha_1*np.sign(arg[i])*m_1*(theta_S1-theta_R1))/(1-m_1))*Se[i]**(1/m_1)*(1-Se[i]**(1/m_1))**m_1
-
-        if z[i]>clay_d: #sand
-
-            if arg[i]<0:
-             #Compute the volumetric moisture content
-                theta[i] = (theta_S2 - theta_R2)/((1 + (alpha_2*abs(arg[i]))**n_2)**m_2) + theta_R2  #m3/m3
-            #Compute the effective saturation
-                Se[i] = ((theta[i] - theta_R2)/(theta_S2 - theta_R2)) ## Unitless factor
-            #Compute the hydraulic conductivity
-                K[i]=Ksat_2*Se[i]**(1/2)*(1 - (1 - Se[i]**(1/m_2))**m_2)**2   # van genuchten Eq.8 (m/s) #
-            if arg[i]>=0:
-                theta[i]=theta_S2
-                K[i]=Ksat_2
-
-            C[i]=((-alpha_2*np.sign(arg[i])*m_2*(theta_S2-theta_R2))/(1-m_2))*Se[i]**(1/m_2)*(1-Se[i]**(1/m_2))**m_2
-
-
+    #Compute the volumetric moisture content
+    theta=np.where(unsat, (theta_S - theta_R)/((1 + (alpha*np.abs(arg))**n)**m) + theta_R, theta_S)  #m3/m3
+    #Compute the effective saturation (zero for saturated nodes)
+    Se=np.where(unsat, (theta - theta_R)/(theta_S - theta_R), 0) ## Unitless factor
+    #Compute the hydraulic conductivity
+    K=np.where(unsat, Ksat*Se**(1/2)*(1 - (1 - Se**(1/m))**m)**2, Ksat)   # van genuchten Eq.8 (m/s) #
 
+    C=((-alpha*np.sign(arg)*m*(theta_S-theta_R))/(1-m))*Se**(1/m)*(1-Se**(1/m))**m
 
     K=(K/(Rho*g)) # since H is in Pa
     C=(C/(Rho*g)) # since H is in Pa
 
-
     return C, K,theta, Se
 
-###############################################################################
-
-###############################################################################
-
-def Picard(H_initial, Head_bottom_H):
-    #picard iteration solver, as described in the supplementary material
-    #solution following Celia et al., 1990
-
-    # Stem water potential [Pa]
-
-    ######################################################################
+#derivatives of the soil C and K with respect to the potential, used by the Newton solver
+#Se is the effective saturation returned by vanGenuchten_nodes for the same potentials
+def vanGenuchten_derivatives(arg, Se, theta_S, theta_R, alpha, n, m, Ksat, g, Rho):
 
+    #arg = potential from Pascal to meters
+    arg=((arg)/(g*Rho))   #m
+    unsat=arg<0
 
-    # Define matrices that we’ll need in solution(similar to celia et al.[1990])
-    x=np.ones(((nz-1),1))
-    DeltaPlus  = np.diagflat(-np.ones((nz,1))) + np.diagflat(x,1)  # delta (i+1) -delta(i)
-
-    y=-np.ones(((nz-1,1)))
-    DeltaMinus = np.diagflat(np.ones((nz,1))) + np.diagflat(y,-1)    #delta (i-1) - delta(i)
+    #the derivatives are singular at saturation (Se = 1), where they are set to zero
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        s=Se**(1/m)
+        dtheta=((alpha*m*(theta_S-theta_R))/(1-m))*s*(1-s)**m  #d theta/d arg (unsaturated)
+        dSe=dtheta/(theta_S-theta_R)                           #d Se/d arg
+        dsdSe=(1/m)*Se**(1/m-1)                                #d s/d Se
 
-    p=np.ones(((nz-1,1)))
-    MPlus  = np.diagflat(np.ones((nz,1))) + np.diagflat(p,1)
+        #K = Ksat*Se**(1/2)*f**2
+        f=1 - (1 - s)**m
+        dfdSe=m*(1-s)**(m-1)*dsdSe
+        dK=Ksat*(0.5*Se**(-1/2)*f**2 + 2*Se**(1/2)*f*dfdSe)*dSe
 
-    w=np.ones((nz-1,1))
-    MMinus = np.diagflat(np.ones((nz,1))) + np.diagflat(w,-1)
+        #C = (alpha*m*(theta_S-theta_R)/(1-m))*s*(1-s)**m
+        dC=((alpha*m*(theta_S-theta_R))/(1-m))*((1-s)**m - m*s*(1-s)**(m-1))*dsdSe*dSe
 
-    ############################Initializing the pressure heads/variables ###################
-    #only saving variables EVERY HALF HOUR
-    dim=np.mod(t_num,1800)==0
-    dim=sum(bool(x) for x in dim)
-
-    H = np.zeros(shape=(nz,dim)) #Stem water potential [Pa]
-    trans_2d=np.zeros(shape=(len(z_upper),dim))
-    K=np.zeros(shape=(nz,dim))
-    Capac=np.zeros(shape=(nz,dim))
-    S_kx=np.zeros(shape=(nz-nz_r,dim))
-    S_kr=np.zeros(shape=(nz_r-nz_s,dim))
-    S_sink=np.zeros(shape=(nz_r-nz_s,dim))
-    Kr_sink=np.zeros(shape=(nz_r-nz_s,dim))
-    THETA=np.zeros(shape=(nz_s,dim))
-    EVsink_ts=np.zeros(shape=((nz_r-nz_s),dim))
-    infiltration=np.zeros(shape=dim)
+    dK=np.where(unsat & np.isfinite(dK), dK, 0)
+    dC=np.where(unsat & np.isfinite(dC), dC, 0)
 
-    Pt_2d=np.zeros(shape=(len(z_upper),nt))
+    #since H is in Pa
+    dK=dK/(Rho*g)**2
+    dC=dC/(Rho*g)**2
 
-    S_stomata=np.zeros(shape=(len(z[nz_r:nz]),nt))
-    S_S=np.zeros(shape=(nz,nt))
-    theta=np.zeros(shape=(nz_s))
-    Se=np.zeros(shape=(nz_s,nt))
-    Kr=np.zeros(shape=(nz_r-nz_s))
+    return dC, dK
 
-    #H_initial = inital water potential [Pa]
-    H[:,0] = H_initial[:]
+###############################################################################
 
-#################################### ROOT MASS DISTRIBUTION FORMULATION ############################################
+#OPERATOR LAYER
+#The difference (DeltaPlus, DeltaMinus) and averaging (MPlus, MMinus) operators of
+#Celia et al. [1990] only couple neighbouring nodes, so they are applied as shifted
+#slices of the nodal arrays instead of dense nz x nz matrix products
 
-    #root mass distribution following VERMA ET AL 2O14
-
-    z_dist=np.arange(0,cfg.Root_depth+cfg.dz,cfg.dz)
-    z_dist=np.flipud(z_dist)
+#interlayer hydraulic conductivities, equations S.16 and S.17
+def face_conductivities(knp1m, nz_s, out=None):
 
-    r_dist=(np.exp(cfg.qz-((cfg.qz*z_dist)/cfg.Root_depth))*cfg.qz**2*(cfg.Root_depth-z_dist))/(cfg.Root_depth**2*(1+np.exp(cfg.qz)*(-1+cfg.qz)))
+    if out is None:
+        kbarplus, kbarminus = np.empty(np.shape(knp1m)), np.empty(np.shape(knp1m))
+    else:
+        kbarplus, kbarminus = out
 
+    #equation S.17
+    np.add(knp1m[..., :-1], knp1m[..., 1:], out=kbarplus[..., :-1])
+    np.multiply(1/2, kbarplus[..., :-1], out=kbarplus[..., :-1])  #1/2 (K_{i} + K_{i+1})
 
-####################################################################################################################################
+    kbarplus[..., -1]=0      #boundary condition at the top of the tree : no-flux
+    kbarplus[..., nz_s-1]=0  #boundary condition at the top of the soil
 
+    #equation S.16
+    kbarminus[..., 1:] = kbarplus[..., :-1]  #1/2 (K_{i-1} + K_{i})
 
+    kbarminus[..., 0]=0    #boundary contition at the bottom of the soil
+    kbarminus[..., nz_s]=0 #boundary contition at the bottom of the roots : no-flux
 
-   #INITIALIZING THESE VARIABLES FOR ITERATIONS
-    cnp1m=np.zeros(shape=(nz))
-    knp1m=np.zeros(shape=(nz))
-    stress_kx=np.zeros(shape=(nz-nz_r))
-    stress_kr=np.zeros(shape=(nz_r-nz_s))
-    stress_roots=np.zeros(shape=(nz_r-nz_s))
-    deltam=np.zeros(shape=(nz))
+    return kbarplus, kbarminus
 
+#residual of MPFD (right hand side), before boundary conditions
+def mpfd_residual(hnp1m, hn, cnp1m, kbarplus, kbarminus, S_S, dt0, dz, Rho, g):
 
-    #vector for adding potentials in B matrix
-    TS=np.zeros(shape=(nz_r))
+    #Kbarplus*DeltaPlus*h - Kbarminus*DeltaMinus*h
+    dh = np.diff(hnp1m)
+    flux = np.zeros(np.shape(hnp1m))
+    flux[..., :-1] = kbarplus[..., :-1]*dh
+    flux[..., 1:] = flux[..., 1:] - kbarminus[..., 1:]*dh
 
-    # Define an iteration counter
-    niter = 0
-    sav=0
+    return (1/(dz**2))*flux + (1/dz)*Rho*g*(kbarplus - kbarminus) - (1/dt0)*(hnp1m - hn)*cnp1m + S_S
 
-    for i in np.arange(1,nt,1):
-        #use nt for entire period
+#soil/root node pairs of the sink/source term (equation S.22): soil node nz_s-nr+e exchanges
+#water with root node nz_s+e, using the Feddes parameters of the soil layer of that soil node
+def root_uptake_map(nz_s, nz_r, nz_clay, cfg):
 
-        # Initialize the Picard iteration solver - saving variables every half-hour
-        if i==1:
-            hn=H[:,0] #condition for initial conditions
-        else:
-            hn=hnp1mp1 #condition for remaining time steps
+    nr = coupling_offset(nz_s, nz_r)
+    soil = np.arange(nz_s-nr, nz_s, 1) #soil nodes exchanging water with the roots
+    root = np.arange(nz_s, nz_r, 1)    #root nodes
+    clay = soil <= nz_clay
 
-        hnp1m = hn
+    return {'soil': soil,
+            'root': root,
+            'theta_1': np.where(clay, cfg.theta_1_clay, cfg.theta_1_sand),
+            'theta_2': np.where(clay, cfg.theta_2_clay, cfg.theta_2_sand)}
 
+#FEDDES root water uptake stress function
+#parameters from VERMA ET AL 2014: Equations S.73, 74 and 75 supplementary material
+#0 below theta_1, 1 above theta_2 and linear in between
+def feddes_stress(theta, theta_1, theta_2, out=None):
+    stress = np.subtract(theta, theta_1, out=out)
+    np.divide(stress, theta_2 - theta_1, out=stress)
+    return np.clip(stress, 0, 1, out=stress)
 
-        # Define a dummy stopping variable
-        stop_flag = 0
+#diagonals of the MPFD matrix A (equations S.25 to S.41) with the soil-root sink/source (equation S.22)
+def assemble_A_diagonals(cnp1m, kbarplus, kbarminus, Kr, uptake, dt0, dz, BottomBC):
 
-        while(stop_flag==0):
-        #=========================== above-ground xylem ========================
-             # Get C,K,for soil, roots, stem
+    soil, root = uptake['soil'], uptake['root']
+    nr = len(root)
 
-            #VanGenuchten relationships applied for the soil nodes
-            cnp1m[0:nz_s], knp1m[0:nz_s],theta[:], Se[:,i]=vanGenuchten(hnp1m[0:nz_s],z_soil, cfg.g, cfg.Rho, cfg.clay_d, cfg.theta_S1,
-                                                                        cfg.theta_R1, cfg.alpha_1, cfg.n_1, cfg.m_1, cfg.Ksat_1, cfg.theta_S2,
-                                                                        cfg.theta_R2, cfg.alpha_2, cfg.n_2, cfg.m_2, cfg.Ksat_2, cfg.dt0)
+    #tridiagonal part: (1/dt0)*C - (1/dz**2)*(Kbarplus*DeltaPlus - Kbarminus*DeltaMinus)
+    diag = (1/dt0)*cnp1m + (1/(dz**2))*(kbarplus + kbarminus)
+    upper = -(1/(dz**2))*kbarplus[..., :-1]
+    lower = -(1/(dz**2))*kbarminus[..., 1:]
 
-            #Equations for C, K for the root nodes
-            cnp1m[nz_s:nz_r],knp1m[nz_s:nz_r],stress_kr[:] = Porous_media_root(hnp1m[nz_s:nz_r], cfg.ap, cfg.bp, cfg.Ksax,
-                                                                               cfg.Aind_r, cfg.p, cfg.sat_xylem, cfg.Phi_0)
+    #sink/source term on the same timestep
+    diag[..., soil] = diag[..., soil] - Kr #soil
+    diag[..., root] = diag[..., root] - Kr #root
 
-            #Equations for C, K for stem nodes
-            cnp1m[nz_r:nz],knp1m[nz_r:nz], stress_kx[:] = Porous_media_xylem(hnp1m[nz_r:nz], cfg.ap, cfg.bp, cfg.kmax, cfg.Aind_x,
-                                                                             cfg.p, cfg.sat_xylem, cfg.Phi_0)
+    #terms outside diagonals: A[soil,root] = A[root,soil] = Kr
+    coupling = np.zeros(shape=np.shape(cnp1m)[:-1] + (np.shape(cnp1m)[-1]-nr,))
+    coupling[..., soil] = Kr
 
+    #bottom boundary condition - known potential - \delta\Phi=0
+    if BottomBC==0:
+        lower[..., 0] = 0
+        upper[..., 0] = 0
+        diag[..., 0] = 1
 
-            #% Compute the individual elements of the A matrix for LHS
+    return lower, diag, upper, coupling, nr
 
+###############################################################################
 
-            C=np.diagflat(cnp1m)
-
-            #interlayer hydraulic conductivity - transition between roots and stem
-            #calculated as a simple average
-            knp1m[nz_r]=(knp1m[nz_r-1]+knp1m[nz_r])/2
-
-            #interlayer between clay and sand
-            knp1m[nz_clay]=(knp1m[nz_clay]+knp1m[nz_clay+1])/2
+#linear interpolation in time of forcing given at model resolution (last axis of x)
+#at the model time grid (t multiple of dt0) it returns the stored values exactly
+def forcing_at(x, t, dt0):
+    j = t/dt0
+    i0 = min(int(j), x.shape[-1]-1)
+    w = j - i0
+    if w <= 0 or i0 == x.shape[-1]-1:
+        return x[..., i0]
+    return (1-w)*x[..., i0] + w*x[..., i0+1]
+
+#canopy-distributed transpiration at time t [1/s], using the stem potentials of the previous time step
+def step_transpiration(t, hn, sim):
+    cfg, nz_r, nz = sim.cfg, sim.nz_r, sim.nz
+
+    #For PM transpiration
+    if cfg.transpiration_scheme == 0: #0: PM transpiration scheme
+        #the forcing is the same at every canopy node: scalars broadcast against the stem potentials
+        Pt = calc_transpiration(forcing_at(sim.SW_in, t, cfg.dt0), forcing_at(sim.NET, t, cfg.dt0), forcing_at(sim.delta_2d, t, cfg.dt0),
+                                cfg.Cp, forcing_at(sim.VPD, t, cfg.dt0), cfg.lamb, cfg.gama, cfg.gb, cfg.ga, cfg.gsmax, cfg.Emax,
+                                forcing_at(sim.f_Ta, t, cfg.dt0), forcing_at(sim.f_s, t, cfg.dt0), forcing_at(sim.f_d, t, cfg.dt0),
+                                jarvis_fleaf(hn[..., nz_r:nz], cfg.hx50, cfg.nl), sim.LAD)
+    # For NHL transpiration
+    elif cfg.transpiration_scheme == 1:  #1: NHL transpiration scheme
+        from nhl_transpiration.NHL_functions import calc_stem_wp_response, calc_transpiration_nhl
+        Pt = calc_transpiration_nhl(forcing_at(sim.NHL_modelres, t, cfg.dt0),
+                                    calc_stem_wp_response(hn[nz_r:nz], sim.ncfg.wp_s50, sim.ncfg.c3).transpose(), sim.LAD)
+    return Pt
+
+#arrays reused by the Picard iterations of every time step
+#members: number of members of a batch (see batch), whose arrays have a leading member axis
+def picard_workspace(sim=None, members=None):
+    sim = _simulation(sim)
+    cfg, nz_s, nz_r, nz, nz_clay = sim.cfg, sim.nz_s, sim.nz_r, sim.nz, sim.nz_clay
+    lead = () if members is None else (members,)
 
-            #equation S.17
-            kbarplus = (1/2)*np.matmul(MPlus,knp1m)  #1/2 (K_{i} + K_{i+1})
+    #root mass distribution following VERMA ET AL 2O14
+    z_dist=np.arange(0,cfg.Root_depth+cfg.dz,cfg.dz)
+    z_dist=np.flipud(z_dist)
 
-            kbarplus[nz-1]=0    #boundary condition at the top of the tree : no-flux
-            kbarplus[nz_s-1]=0  #boundary condition at the top of the soil
+    r_dist=(np.exp(cfg.qz-((cfg.qz*z_dist)/cfg.Root_depth))*cfg.qz**2*(cfg.Root_depth-z_dist))/(cfg.Root_depth**2*(1+np.exp(cfg.qz)*(-1+cfg.qz)))
 
-            Kbarplus =np.diagflat(kbarplus)
+    ws = {'sim': sim,
+          'r_dist': r_dist,
+          'uptake': root_uptake_map(nz_s, nz_r, nz_clay, cfg),
+          'cnp1m': np.zeros(shape=lead + (nz,)),
+          'knp1m': np.zeros(shape=lead + (nz,)),
+          'kbarplus': np.zeros(shape=lead + (nz,)),
+          'kbarminus': np.zeros(shape=lead + (nz,)),
+          'theta': np.zeros(shape=lead + (nz_s,)),
+          'Se': np.zeros(shape=lead + (nz_s,)),
+          'stress_kx': np.zeros(shape=lead + (nz-nz_r,)),
+          'stress_kr': np.zeros(shape=lead + (nz_r-nz_s,)),
+          'stress_roots': np.zeros(shape=lead + (nz_r-nz_s,)),
+          'Kr': np.zeros(shape=lead + (nz_r-nz_s,)),
+          'S_S': np.zeros(shape=lead + (nz,)),
+          'q_inf': 0.0,
+          'delta_max': np.inf,          #max |deltam| of the last iteration
+          'timings': [0.0, 0.0, 0.0],   #wall time [s] of property evaluation, assembly and solve
+          'lu': None,     #LU factorization of the Jacobian (Newton solver)
+          'lu_matrix': None,  #factorized Jacobian, stored in the checkpoints
+          'lu_dt': None,  #time step of the factorized Jacobian
+          'n_factor': 0}  #number of Jacobian factorizations
+
+    #band storage of the matrix, right hand side and node order of the compiled kernel
+    if cfg.numba_kernel and members is None:
+        order, _ = interleaved_band_indices(nz, nz_s, coupling_offset(nz_s, nz_r))
+        ws['band'] = np.zeros(shape=(3*BAND + 1, nz))
+        ws['R'] = np.zeros(shape=(nz))
+        ws['band_position'] = np.argsort(order)
+
+        #arguments of numba_kernel.picard_step_kernel that are the same at every step: parameters
+        #and work arrays (updated in place, also by load_checkpoint)
+        uptake = ws['uptake']
+        ws['kernel_arguments'] = (nz_s, nz_r, nz_clay, float(cfg.dz), float(cfg.g), float(cfg.Rho),
+                                  float(cfg.stop_tol), int(cfg.UpperBC), int(cfg.BottomBC), *sim.soil_params,
+                                  float(cfg.ap), float(cfg.bp), float(cfg.Ksax), float(cfg.Aind_r), float(cfg.kmax),
+                                  float(cfg.Aind_x), float(cfg.p), float(cfg.sat_xylem), float(cfg.Phi_0), float(cfg.Kr),
+                                  ws['r_dist'], uptake['theta_1'], uptake['theta_2'], float(cfg.theta_S2),
+                                  ws['cnp1m'], ws['knp1m'], ws['theta'], ws['Se'], ws['stress_kr'], ws['stress_kx'],
+                                  ws['stress_roots'], ws['Kr'], ws['S_S'])
+    return ws
+
+def mpfd_iteration_residual(hnp1m, hn, dt, q_rain_t, Pt, ws):
+    """
+    Evaluates C, K for soil, roots and stem at iteration level m and the residual
+    of MPFD (right hand side) with the boundary conditions
+
+    Parameters
+    ----------
+    hnp1m : [Pa]
+        water potentials at iteration level m
+    hn : [Pa]
+        water potentials at the beginning of the time step
+    dt : [s]
+        time step
+    q_rain_t : [m/s]
+        precipitation rate at the end of the time step
+    Pt : [1/s]
+        canopy-distributed transpiration over the time step
+    ws : dict
+        workspace from picard_workspace, receives the variables of iteration level m
+
+    Returns
+    -------
+    R_MPFD : array (nz), or (members, nz) for a batch
+    """
+    sim = ws['sim']
+    cfg, nz_s, nz_r, nz, nz_clay, soil_params = sim.cfg, sim.nz_s, sim.nz_r, sim.nz, sim.nz_clay, sim.soil_params
+    cnp1m, knp1m, theta, S_S, uptake = ws['cnp1m'], ws['knp1m'], ws['theta'], ws['S_S'], ws['uptake']
+    kbarplus, kbarminus, stress_kx, stress_kr = ws['kbarplus'], ws['kbarminus'], ws['stress_kx'], ws['stress_kr']
+
+#=========================== above-ground xylem ========================
+     # Get C,K,for soil, roots, stem
+
+    #VanGenuchten relationships applied for the soil nodes
+    cnp1m[..., 0:nz_s], knp1m[..., 0:nz_s],theta[:], ws['Se'][:]=vanGenuchten_nodes(hnp1m[..., 0:nz_s], *soil_params, cfg.g, cfg.Rho)
+
+    #Equations for C, K for the root nodes
+    Porous_media_root(hnp1m[..., nz_s:nz_r], cfg.ap, cfg.bp, cfg.Ksax, cfg.Aind_r, cfg.p, cfg.sat_xylem, cfg.Phi_0,
+                      out=(cnp1m[..., nz_s:nz_r], knp1m[..., nz_s:nz_r], stress_kr))
+
+    #Equations for C, K for stem nodes
+    Porous_media_xylem(hnp1m[..., nz_r:nz], cfg.ap, cfg.bp, cfg.kmax, cfg.Aind_x, cfg.p, cfg.sat_xylem, cfg.Phi_0,
+                       out=(cnp1m[..., nz_r:nz], knp1m[..., nz_r:nz], stress_kx))
+
+
+    #interlayer hydraulic conductivity - transition between roots and stem
+    #calculated as a simple average
+    knp1m[..., nz_r]=(knp1m[..., nz_r-1]+knp1m[..., nz_r])/2
+
+    #interlayer between clay and sand
+    knp1m[..., nz_clay]=(knp1m[..., nz_clay]+knp1m[..., nz_clay+1])/2
+
+    #equations S.16 and S.17
+    face_conductivities(knp1m, nz_s, out=(kbarplus, kbarminus))
+
+    ##########ROOT WATER UPTAKE TERM ############################
+    soil, root = uptake['soil'], uptake['root']
+
+    #FEDDES root water uptake stress function of the soil node of each root node
+    stress_roots = feddes_stress(theta[..., soil], uptake['theta_1'], uptake['theta_2'], out=ws['stress_roots'])
+
+    #specific radial conductivity under saturated soil conditions
+    Ksrad=stress_roots*cfg.Kr #stress function is unitless
+
+    #effective root radial conductivity
+    Kerad=Ksrad*ws['r_dist']  #[1/sPa] #Kr is already divided by Rho*g
+
+    #effective root radial conductivity
+    Kr=Kerad
+
+
+    #Infiltration calculation - only infitrates if top soil layer is not saturated
+    #equation S.53
+    if cfg.UpperBC==0:
+        if theta.ndim == 1:
+            q_inf=min(q_rain_t,
+                            ((cfg.theta_S2-theta[-1])*(cfg.dz/dt))) #m/s
+        else:
+            q_inf=np.minimum(q_rain_t, (cfg.theta_S2-theta[..., -1:])*(cfg.dz/dt))[..., 0]
 
-            #equation S.16
-            kbarminus = (1/2)*np.matmul(MMinus,knp1m)  #1/2 (K_{i-1} - K_{i})
 
-            kbarminus[0]=0    #boundary contition at the bottom of the soil
-            kbarminus[nz_s]=0 #boundary contition at the bottom of the roots : no-flux
+################################## SINK/SOURCE TERM ON THE SAME TIMESTEP #####################################
+    #equation S.22 suplementary material, for every soil/root node pair
+    #SINK/SOURCE ARRAY : concatenating all sinks and sources in a vector
+    flow = Kr*(hnp1m[..., soil]-hnp1m[..., root])
+    S_S[..., soil] = -flow #soil
+    S_S[..., root] = flow  #root
+    S_S[..., nz_r:nz]=-Pt
 
-            Kbarminus = np.diagflat(kbarminus)
+    #% Compute the residual of MPFD (right hand side)
+    R_MPFD = mpfd_residual(hnp1m, hn, cnp1m, kbarplus, kbarminus, S_S, dt, cfg.dz, cfg.Rho, cfg.g)
 
-            ##########ROOT WATER UPTAKE TERM ############################
-            stress_roots=np.zeros(shape=(len(z[nz_s-(nz_r-nz_s):nz_s])))
+    #bottom boundary condition - known potential - \delta\Phi=0
+    if cfg.BottomBC==0:
+        R_MPFD[..., 0]=0
 
-            #FEDDES root water uptake stress function
-            #parameters from VERMA ET AL 2014: Equations S.73, 74 and 75 supplementary material
 
-            #clay
-            for k,j in zip(np.arange(nz_s-(nz_r-nz_s),nz_clay+1,1),np.arange(0,((len(stress_roots-1))-(nz_sand-nz_clay)),1)): #clay
-                if theta[k]<=cfg.theta_1_clay:
-                    stress_roots[j]=0
-                if cfg.theta_1_clay < theta[k] and theta[k]<= cfg.theta_2_clay:
-                    stress_roots[j]=(theta[k]-cfg.theta_1_clay)/(cfg.theta_2_clay-cfg.theta_1_clay)
-                if theta[k] > cfg.theta_2_clay:
-                    stress_roots[j]=1
-            #sand
-            for k,j in zip(np.arange(nz_clay+1,nz_s,1),np.arange(len(stress_roots)-(nz_sand-nz_clay),len(stress_roots),1)): #sand
-               if theta[k]<=cfg.theta_1_sand:
-                    stress_roots[j]=0
-               if cfg.theta_1_sand < theta[k] and theta[k] <=cfg.theta_2_sand:
-                    stress_roots[j]=(theta[k]-cfg.theta_1_sand)/(cfg.theta_2_sand-cfg.theta_1_sand)
-               if theta[k] > cfg.theta_2_sand:
-                    stress_roots[j]=1
 
+    if cfg.UpperBC==0:  #adding the infiltration on the most superficial soil layer [1/s]
+        R_MPFD[..., nz_s-1]=R_MPFD[..., nz_s-1]+(q_inf)/cfg.dz
 
-            #specific radial conductivity under saturated soil conditions
-            Ksrad=stress_roots*cfg.Kr #stress function is unitless
+    if cfg.BottomBC==2: #free drainage condition: F1-1/2 = K at the bottom of the soil
+        R_MPFD[..., 0]=R_MPFD[..., 0]-(kbarplus[..., 0]*cfg.Rho*cfg.g)/cfg.dz
 
-            #effective root radial conductivity
-            Kerad=Ksrad*r_dist  #[1/sPa] #Kr is already divided by Rho*g
+    ws['Kr'] = Kr
+    if cfg.UpperBC==0:
+        ws['q_inf'] = q_inf
+
+    return R_MPFD
+
+def picard_step(hn, dt, q_rain_t, Pt, Head_bottom_t, ws, max_iter=np.inf):
+    """
+    Advances the water potentials over one time step with the modified Picard
+    iteration (Celia et al., 1990), as described in the supplementary material
+
+    Parameters
+    ----------
+    hn : [Pa]
+        water potentials at the beginning of the time step
+    dt : [s]
+        time step
+    q_rain_t : [m/s]
+        precipitation rate at the end of the time step
+    Pt : [1/s]
+        canopy-distributed transpiration over the time step
+    Head_bottom_t : [Pa]
+        soil bottom potential at the end of the time step (BottomBC = 0)
+    ws : dict
+        workspace from picard_workspace, holds the variables of the last iteration on return
+    max_iter : int
+        maximum number of Picard iterations
+
+    Returns
+    -------
+    hnp1mp1 : [Pa]
+        water potentials at the end of the time step (hn if not converged)
+    m : int
+        number of Picard iterations
+    converged : bool
+    """
+    cfg = ws['sim'].cfg
+    hnp1m = hn
+    m = 0
+
+    while m < max_iter:
+        m = m + 1
+
+        #C, K and residual of MPFD at iteration level m
+        t0 = perf_counter()
+        R_MPFD = mpfd_iteration_residual(hnp1m, hn, dt, q_rain_t, Pt, ws)
+
+        #Compute deltam for iteration level m+1 : equations S.25 to S.41 (matrix)
+        t1 = perf_counter()
+        lower, diag, upper, coupling, nr = assemble_A_diagonals(ws['cnp1m'], ws['kbarplus'], ws['kbarminus'], ws['Kr'],
+                                                                ws['uptake'], dt, cfg.dz, cfg.BottomBC)
+        t2 = perf_counter()
+        deltam = solve_linear_system(lower, diag, upper, coupling, nr, R_MPFD, cfg.linear_solver, ws['sim'].nz_s)
+        t3 = perf_counter()
+
+        timings = ws['timings']
+        timings[0], timings[1], timings[2] = timings[0] + (t1-t0), timings[1] + (t2-t1), timings[2] + (t3-t2)
+        ws['delta_max'] = np.max(np.abs(deltam[:]))
+
+        if not np.isfinite(ws['delta_max']): #diverged, the step has to be repeated with a smaller dt
+            break
+
+        hnp1mp1 = hnp1m + deltam
+
+        if  ws['delta_max'] < cfg.stop_tol:  #equation S.42
+
+            #Bottom boundary condition at bottom of the soil
+            #setting for the next time step value for next cycle
+            if cfg.BottomBC==0:
+                hnp1mp1[0] = Head_bottom_t
+
+            return hnp1mp1, m, True
+
+        hnp1m = hnp1mp1
+
+    return hn, m, False
+
+def mpfd_jacobian(hnp1m, hn, dt, q_rain_t, ws):
+    """
+    Analytic Jacobian of the residual of MPFD with respect to the water potentials,
+    evaluated at the iteration level stored in ws by mpfd_iteration_residual.
+    Unlike the Picard matrix A, it includes the dependence of C, K, the root
+    water uptake and the infiltration on the potentials.
+
+    Parameters
+    ----------
+    hnp1m : [Pa]
+        water potentials at iteration level m
+    hn : [Pa]
+        water potentials at the beginning of the time step
+    dt : [s]
+        time step
+    q_rain_t : [m/s]
+        precipitation rate at the end of the time step
+    ws : dict
+        workspace holding C, K, theta and the root uptake of iteration level m
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix (nz, nz)
+        minus the Jacobian, so that the Newton increment solves M * deltam = R_MPFD
+    """
+    sim = ws['sim']
+    cfg, nz_s, nz_r, nz, nz_clay, soil_params = sim.cfg, sim.nz_s, sim.nz_r, sim.nz, sim.nz_clay, sim.soil_params
+    cnp1m, kbarplus, kbarminus, Kr = ws['cnp1m'], ws['kbarplus'], ws['kbarminus'], ws['Kr']
+    dz = cfg.dz
+    idx = np.arange(nz)
+
+    #derivatives of C and K at the nodes
+    dc=np.zeros(shape=(nz))
+    dk=np.zeros(shape=(nz))
+    dc[0:nz_s], dk[0:nz_s] = vanGenuchten_derivatives(hnp1m[0:nz_s], ws['Se'], *soil_params, cfg.g, cfg.Rho)
+    dc[nz_s:nz_r], dk[nz_s:nz_r] = xylem_hydraulics_derivatives(hnp1m[nz_s:nz_r], ws['stress_kr'], cfg.ap, cfg.Ksax,
+                                                                cfg.Aind_r, cfg.p, cfg.sat_xylem, cfg.Phi_0)
+    dc[nz_r:nz], dk[nz_r:nz] = xylem_hydraulics_derivatives(hnp1m[nz_r:nz], ws['stress_kx'], cfg.ap, cfg.kmax,
+                                                            cfg.Aind_x, cfg.p, cfg.sat_xylem, cfg.Phi_0)
+
+    #nodal K after the averaging at the root-stem and clay-sand interfaces: D = dK/dPhi
+    D_rows = np.concatenate((idx, [nz_r, nz_clay]))
+    D_cols = np.concatenate((idx, [nz_r-1, nz_clay+1]))
+    D_vals = np.concatenate((dk, [dk[nz_r-1]/2, dk[nz_clay+1]/2]))
+    D_vals[nz_r] = dk[nz_r]/2
+    D_vals[nz_clay] = dk[nz_clay]/2
+    D = sparse.csr_matrix((D_vals, (D_rows, D_cols)), shape=(nz, nz))
+
+    #dR/dK: each face conductivity is the mean of its two nodes
+    plus_on = np.ones(shape=(nz))  #faces i+1/2 that are not no-flux boundaries
+    plus_on[nz-1] = 0
+    plus_on[nz_s-1] = 0
+    minus_on = np.ones(shape=(nz)) #faces i-1/2 that are not no-flux boundaries
+    minus_on[0] = 0
+    minus_on[nz_s] = 0
+    grad = np.zeros(shape=(nz))
+    grad[:-1] = np.diff(hnp1m)/dz**2 + cfg.Rho*cfg.g/dz  #(1/dz**2)*DeltaPlus*h + gravity
+    a = (1/2)*grad*plus_on
+    b = np.zeros(shape=(nz))
+    b[1:] = (1/2)*grad[:-1]*minus_on[1:]
+    G_rows = [idx, idx[:-1], idx[1:]]
+    G_cols = [idx, idx[1:], idx[:-1]]
+    G_vals = [a - b, a[:-1], -b[1:]]
+    if cfg.BottomBC==2: #free drainage: R[0] - kbarplus[0]*Rho*g/dz
+        G_rows.append([0, 0])
+        G_cols.append([0, 1])
+        G_vals.append(np.full(2, -(1/2)*cfg.Rho*cfg.g/dz))
+    G = sparse.csr_matrix((np.concatenate(G_vals), (np.concatenate(G_rows), np.concatenate(G_cols))), shape=(nz, nz))
+    JK = (G @ D).tocoo()
+
+    #dR/dPhi with C, K and the root uptake fixed, plus the change of C: -(1/dt)*(C + dC/dPhi*(h - hn))
+    rows = [JK.row, idx, idx[:-1], idx[1:]]
+    cols = [JK.col, idx, idx[1:], idx[:-1]]
+    vals = [JK.data, -(kbarplus + kbarminus)/dz**2 - (1/dt)*(cnp1m + dc*(hnp1m - hn)), kbarplus[:-1]/dz**2, kbarminus[1:]/dz**2]
+
+    #root water uptake, equation S.22, with the Feddes stress depending on the soil moisture
+    uptake = ws['uptake']
+    soil, root, theta_1, theta_2 = uptake['soil'], uptake['root'], uptake['theta_1'], uptake['theta_2']
+    theta_s = ws['theta'][soil]
+    dstress = np.where((theta_1 < theta_s) & (theta_s <= theta_2), 1/(theta_2-theta_1), 0)
+    dKr = dstress*cfg.Kr*ws['r_dist']*cnp1m[soil]  #dKr/dPhi_soil
+    dh = hnp1m[soil] - hnp1m[root]
+    rows += [soil, soil, root, root]
+    cols += [soil, root, soil, root]
+    vals += [-Kr - dKr*dh, Kr, Kr + dKr*dh, -Kr]
+
+    #infiltration limited by the storage of the top soil layer, equation S.53
+    if cfg.UpperBC==0 and ws['q_inf'] < q_rain_t:
+        rows.append([nz_s-1])
+        cols.append([nz_s-1])
+        vals.append([-cnp1m[nz_s-1]/dt])
+
+    rows, cols, vals = np.concatenate(rows), np.concatenate(cols), -np.concatenate(vals)
+
+    #bottom boundary condition - known potential - \delta\Phi=0
+    if cfg.BottomBC==0:
+        keep = rows != 0
+        rows, cols, vals = np.append(rows[keep], 0), np.append(cols[keep], 0), np.append(vals[keep], 1)
+
+    return sparse.csc_matrix((vals, (rows, cols)), shape=(nz, nz))
+
+def newton_step(hn, dt, q_rain_t, Pt, Head_bottom_t, ws, max_iter=np.inf, chord=False):
+    """
+    Advances the water potentials over one time step with Newton-Raphson iterations
+    on the residual of MPFD, an alternative to picard_step with the same arguments
+    and convergence criterion (equation S.42)
+
+    With chord=True the LU factorization of the Jacobian is kept across iterations
+    and time steps, and only recomputed when the time step changes or the increment
+    decreases by less than cfg.chord_rate between two iterations
+
+    Returns
+    -------
+    hnp1mp1 : [Pa]
+        water potentials at the end of the time step (hn if not converged)
+    m : int
+        number of Newton iterations
+    converged : bool
+    """
+    cfg = ws['sim'].cfg
+    hnp1m = hn
+    m = 0
+    delta_max = np.inf
+
+    while m < max_iter:
+        m = m + 1
+
+        #C, K and residual of MPFD at iteration level m
+        t0 = perf_counter()
+        R_MPFD = mpfd_iteration_residual(hnp1m, hn, dt, q_rain_t, Pt, ws)
+
+        #Jacobian and its LU factorization
+        t1 = t2 = perf_counter()
+        if not chord or ws['lu'] is None or ws['lu_dt'] != dt:
+            M = mpfd_jacobian(hnp1m, hn, dt, q_rain_t, ws)
+            t2 = perf_counter()
+            ws['lu'] = splu(M)
+            ws['lu_matrix'] = M
+            ws['lu_dt'] = dt
+            ws['n_factor'] = ws['n_factor'] + 1
+
+        deltam = ws['lu'].solve(R_MPFD)
+        t3 = perf_counter()
+
+        timings = ws['timings']
+        timings[0], timings[1], timings[2] = timings[0] + (t1-t0), timings[1] + (t2-t1), timings[2] + (t3-t2)
+
+        delta_prev, delta_max = delta_max, np.max(np.abs(deltam[:]))
+        ws['delta_max'] = delta_max
+
+        if not np.isfinite(delta_max): #diverged, the step has to be repeated with a smaller dt
+            ws['lu'] = None
+            break
+
+        hnp1mp1 = hnp1m + deltam
+
+        #refactorize when the reused Jacobian no longer contracts the increments fast enough
+        if delta_max > cfg.chord_rate*delta_prev:
+            ws['lu'] = None
+
+        if  delta_max < cfg.stop_tol:  #equation S.42
+
+            #Bottom boundary condition at bottom of the soil
+            if cfg.BottomBC==0:
+                hnp1mp1[0] = Head_bottom_t
+
+            return hnp1mp1, m, True
+
+        hnp1m = hnp1mp1
+
+    ws['lu'] = None
+    return hn, m, False
+
+def compiled_picard_step(hn, dt, q_rain_t, Pt, Head_bottom_t, ws, max_iter=np.inf):
+    """
+    picard_step computed by the Numba kernel numba_kernel.picard_step_kernel,
+    with the same arguments and returns. The linear system is solved with the
+    kernel's own banded elimination, on the matrix reordered to half bandwidth
+    BAND (see linear_solver.interleaved_band_indices), so cfg.linear_solver is not used.
+    Its whole wall time is counted as solve time in ws['timings'].
+    """
+    hnp1mp1 = np.zeros(shape=(len(hn)))
+    q_inf = np.zeros(shape=(1))
+
+    t0 = perf_counter()
+    m, converged, ws['delta_max'] = picard_step_kernel(hn, float(dt), float(q_rain_t), np.ascontiguousarray(Pt, dtype=float), float(Head_bottom_t),
+                                      int(min(max_iter, 2**31-1)), *ws['kernel_arguments'], q_inf, hnp1mp1, ws['band'], ws['R'],
+                                      ws['band_position'])
+    ws['timings'][2] = ws['timings'][2] + (perf_counter()-t0)
+    ws['q_inf'] = q_inf[0]
+
+    return hnp1mp1, m, converged
+
+#time step for the next step of the adaptive time stepping, from the Picard iterations of the last step
+def next_time_step(dt, m, converged, cfg):
+    if not converged:
+        dt = dt*cfg.dt_shrink
+    elif m <= cfg.iter_grow:
+        dt = dt*cfg.dt_grow
+    elif m > cfg.iter_shrink:
+        dt = dt*cfg.dt_shrink
+    return min(max(dt, cfg.dt_min), cfg.dt_max)
+
+def Picard(H_initial, Head_bottom_H, telemetry=None, sim=None, monitor=None):
+    #picard iteration solver, as described in the supplementary material
+    #solution following Celia et al., 1990
+    #telemetry: record from solver_telemetry, receives the convergence and timings of every step (optional)
+    #monitor: function called as monitor(t, sav, saved) after every saved snapshot, with the dict of the
+    #         saved outputs (H in Pa, only the snapshot sav in column 0 with stream_output); it stops
+    #         the run by raising an exception (optional, see calibration)
+    #sim: simulation.Simulation with the configuration and inputs of the run (model_config if not given)
+    sim = _simulation(sim)
+    cfg, nz_s, nz_r, nz, z, z_upper = sim.cfg, sim.nz_s, sim.nz_r, sim.nz, sim.z, sim.z_upper
+    t_num, nt, q_rain = sim.t_num, sim.nt, sim.q_rain
 
-            #effective root radial conductivity
-            Kr=Kerad
+    # Stem water potential [Pa]
 
+    ######################################################################
 
-#######################################################################
-            #tridiagonal matrix
-            A = (1/cfg.dt0)*C - (1/(cfg.dz**2))*(np.dot(Kbarplus,DeltaPlus) - np.dot(Kbarminus,DeltaMinus))
 
+    ############################Initializing the pressure heads/variables ###################
+    #only saving variables every save_freq seconds (half hour by default)
+    if cfg.save_freq % cfg.dt0 != 0:
+        raise ValueError("save_freq (" + str(cfg.save_freq) + " s) must be a multiple of dt0 (" + str(cfg.dt0) + " s)")
+    #format_model_output accumulates the saved transpiration over each hour (trans_h), or over each
+    #save_freq interval when longer: a shorter save_freq has to divide the hour
+    if cfg.save_freq < 3600 and 3600 % cfg.save_freq != 0:
+        raise ValueError("save_freq (" + str(cfg.save_freq) + " s) must divide 3600 s or be longer than 3600 s")
+    dim=np.mod(t_num,cfg.save_freq)==0
+    dim=sum(bool(x) for x in dim)
 
+    #with stream_output the snapshots are written to output/model_out.nc as they are saved and
+    #the arrays only hold the current one (column 0), so memory does not grow with the run length
+    nsav = 1 if cfg.stream_output else dim
+    H = np.zeros(shape=(nz,nsav)) #Stem water potential [Pa]
+    trans_2d=np.zeros(shape=(len(z_upper),nsav))
+    K=np.zeros(shape=(nz,nsav))
+    Capac=np.zeros(shape=(nz,nsav))
+    S_kx=np.zeros(shape=(nz-nz_r,nsav))
+    S_kr=np.zeros(shape=(nz_r-nz_s,nsav))
+    S_sink=np.zeros(shape=(nz_r-nz_s,nsav))
+    Kr_sink=np.zeros(shape=(nz_r-nz_s,nsav))
+    THETA=np.zeros(shape=(nz_s,nsav))
+    EVsink_ts=np.zeros(shape=((nz_r-nz_s),nsav))
+    infiltration=np.zeros(shape=dim)
 
-            #Infiltration calculation - only infitrates if top soil layer is not saturated
-            #equation S.53
-            if cfg.UpperBC==0:
-                q_inf=min(q_rain[i],
-                                ((cfg.theta_S2-theta[-1])*(cfg.dz/cfg.dt0))) #m/s
+    #variables at model resolution - with adaptive time stepping each step is stored
+    #at the model time step closest to its end
+    #in bounded memory mode they are single column buffers overwritten every step, and
+    #S_stomata is kept at the saving times only, so memory does not grow with the run length
+    ncol = 1 if cfg.bounded_memory else nt
+    Pt_2d=np.zeros(shape=(len(z_upper),ncol))
 
+    S_stomata=np.zeros(shape=(len(z[nz_r:nz]),dim if cfg.bounded_memory else nt))
+    S_S=np.zeros(shape=(nz,ncol))
+    Se=np.zeros(shape=(nz_s,ncol))
 
-################################## SINK/SOURCE TERM ON THE SAME TIMESTEP #####################################
-              #equation S.22 suplementary material
-            if cfg.Root_depth==cfg.Soil_depth:
-                #diagonals
-                for k,e in zip(np.arange(0,nz_s,1),np.arange(0,(nz_r-nz_s),1)):
-                    A[k,k]=A[k,k]-Kr[e] #soil ---  from 0:soil top
-                for j, w in zip(np.arange(nz_s,nz_r,1),np.arange(0,(nz_r-nz_s),1)):
-                    A[j,j]=A[j,j]-Kr[w] #root ---- from soil bottom :root top
+    #H_initial = inital water potential [Pa]
+    H[:,0] = H_initial[:]
 
-                #terms outside diagonals
-                for k , j,e in zip(np.arange((nz_r-nz_s),nz_r,1),np.arange((0),nz_s,1),np.arange(0,(nz_r-nz_s),1)):
-                    A[j,k]=+Kr[e] #root
+    saved = {'H': H, 'K': K, 'Capac': Capac, 'S_kx': S_kx, 'S_kr': S_kr, 'S_sink': S_sink, 'Kr_sink': Kr_sink,
+             'EVsink_ts': EVsink_ts, 'THETA': THETA, 'trans_2d': trans_2d, 'infiltration': infiltration}
 
-                for k, j,e in zip(np.arange(nz_s,nz_r,1),np.arange(0,nz_s,1),np.arange(0,(nz_r-nz_s),1)):
-                    A[k,j]=+Kr[e] #soil
+   #INITIALIZING THESE VARIABLES FOR ITERATIONS
+    ws = picard_workspace(sim)
 
+    if cfg.nonlinear_solver not in ('picard', 'newton', 'chord'):
+        raise ValueError("Unknown nonlinear solver: " + str(cfg.nonlinear_solver))
 
-                 #residual for vector Right hand side vector
-                TS[0:nz_s]=-Kr*(hnp1m[0:nz_s]-hnp1m[nz_s:nz_r]) #soil
-                TS[(nz_s):nz_r]=+Kr*(hnp1m[0:nz_s]-hnp1m[nz_s:nz_r]) #root
+    #compiled time step kernel, if requested and numba is installed
+    use_kernel = cfg.numba_kernel and HAVE_NUMBA
+    if cfg.numba_kernel and not HAVE_NUMBA:
+        print("numba is not installed, using the NumPy time step")
 
+    # Define an iteration counter
+    niter = 0
+    n_iterations = 0 #nonlinear iterations, including those of repeated steps
+    sav=0
 
+    hn=H[:,0].copy() #condition for initial conditions
+    t=t_num[0]
+    i=0
+    dt=cfg.dt0
+
+    #periodic checkpoints of the time loop, and restart from the last one (see checkpoint)
+    if cfg.checkpoint and cfg.checkpoint_freq % cfg.save_freq != 0:
+        raise ValueError("checkpoint_freq (" + str(cfg.checkpoint_freq) + " s) must be a multiple of save_freq (" + str(cfg.save_freq) + " s)")
+    state = load_checkpoint(sim, saved, ws, telemetry) if cfg.restart else None
+    if state is not None:
+        hn, t, i, dt = state['hn'], state['t'], state['i'], state['dt']
+        sav, niter, n_iterations = int(state['sav']), int(state['niter']), int(state['n_iterations'])
+        if cfg.print_run_progress:
+            print("restarting from the checkpoint at t =", t, "s")
+
+    #streaming writer of the saved outputs (see output_writer), fed from the solver loop
+    if cfg.stream_output:
+        stream = open_output_stream(sim, start=sav + 1 if state is not None else None)
+        if state is None:
+            stream.write(t_num[0], stream_snapshot(saved, 0, 0, cfg.dz))
+    else:
+        stream = None
+
+    #the stream is closed (pending snapshots written) also when the run stops with an exception
+    try:
+        while t < t_num[-1]:
+            #use nt for entire period
+
+            if cfg.adaptive_dt:
+                #shorten the step to land exactly on the next saving time (every save_freq) or the end of the run
+                t_target = min((np.floor(t/cfg.save_freq) + 1)*cfg.save_freq, t_num[-1])
+                dt_step = min(dt, t_target - t)
+                if t_target - t - dt_step < cfg.dt_min:
+                    dt_step = t_target - t
+                t_new = t + dt_step if dt_step < t_target - t else t_target
+                max_iter = cfg.max_iter
             else:
-                 #diagonals
-                for k,e in zip(np.arange(nz_s-(nz_r-nz_s),nz_s,1),np.arange(0,(nz_r-nz_s),1)):
-                    A[k,k]=A[k,k]-Kr[e] #soil --- (soil-roots):soil
-                for j, w in zip(np.arange(nz_s,nz_r,1),np.arange(0,(nz_r-nz_s),1)):
-                    A[j,j]=A[j,j]-Kr[w] #root ---- soil:root
-
-                #terms outside diagonals
-                for k , j,e in zip(np.arange(nz_s,nz_r,1),np.arange(nz_s-(nz_r-nz_s),nz_s,1),np.arange(0,(nz_r-nz_s),1)):
-                    A[j,k]=+Kr[e] #root
-
-                for k, j,e in zip(np.arange(nz_s,nz_r,1),np.arange(nz_s-(nz_r-nz_s),nz_s,1),np.arange(0,(nz_r-nz_s),1)):
-                    A[k,j]=+Kr[e] #soil
+                t_new = t_num[i+1]
+                dt_step = cfg.dt0
+                max_iter = np.inf
 
-
-                #residual for vector Right hand side vector
-                TS[nz_s-(nz_r-nz_s):nz_s]=-Kr*(hnp1m[nz_s-(nz_r-nz_s):nz_s]-hnp1m[nz_s:nz_r]) #soil
-                TS[(nz_s):nz_r]=+Kr*(hnp1m[nz_s-(nz_r-nz_s):nz_s]-hnp1m[nz_s:nz_r]) #root
-
-
-########################################################################################################
+            # model time step closest to the end of the time step (column of the scratch arrays)
+            it = 0 if cfg.bounded_memory else min(int(round(t_new/cfg.dt0)), nt-1)
 
             ##########TRANSPIRATION FORMULATION #################
+            Pt_2d[:,it] = step_transpiration(t_new, hn, sim)
 
-            #For PM transpiration
-            if cfg.transpiration_scheme == 0: #0: PM transpiration scheme
-                Pt_2d[:,i] = calc_transpiration(SW_in[i], NET_2d[:,i], delta_2d[i], cfg.Cp, VPD_2d[:,i], cfg.lamb, cfg.gama,
-                                                cfg.gb, cfg.ga, cfg.gsmax, cfg.Emax, f_Ta_2d[:,i], f_s_2d[:,i], f_d_2d[:,i],
-                                                jarvis_fleaf(hn[nz_r:nz], cfg.hx50, cfg.nl), LAD)
-            # For NHL transpiration
-            elif cfg.transpiration_scheme == 1:  #1: NHL transpiration scheme
-                Pt_2d[:,i] = calc_transpiration_nhl(NHL_modelres[:,i],
-                                                    calc_stem_wp_response(hn[nz_r:nz], ncfg.wp_s50, ncfg.c3).transpose(), LAD)
-
-            #SINK/SOURCE ARRAY : concatenating all sinks and sources in a vector
-            S_S[:,i]=np.concatenate((TS,-Pt_2d[:,i])) #vector with sink and sources
-
-
-
-            #dummy variable to help breaking the multiplication into parts
-            matrix2=multi_dot([Kbarplus,DeltaPlus,hnp1m]) - multi_dot([Kbarminus,DeltaMinus,hnp1m])
-
-            #% Compute the residual of MPFD (right hand side)
-
-            R_MPFD = (1/(cfg.dz**2))*(matrix2) + (1/cfg.dz)* cfg.Rho * cfg.g *(kbarplus - kbarminus) - (1/cfg.dt0)*np.dot((hnp1m - hn),C)+(S_S[:,i])
-
-            #bottom boundary condition - known potential - \delta\Phi=0
-            if cfg.BottomBC==0:
-                A[1,0]=0
-                A[0,1]=0
-                A[0,0]=1
-                R_MPFD[0]=0
-
-
-
-            if cfg.UpperBC==0:  #adding the infiltration on the most superficial soil layer [1/s]
-                R_MPFD[nz_s-1]=R_MPFD[nz_s-1]+(q_inf)/cfg.dz
+            ws['timings'] = [0.0, 0.0, 0.0]
 
-            if cfg.BottomBC==2: #free drainage condition: F1-1/2 = K at the bottom of the soil
-                R_MPFD[0]=R_MPFD[0]-(kbarplus[0]*cfg.Rho*cfg.g)/cfg.dz
-
-
-            #Compute deltam for iteration level m+1 : equations S.25 to S.41 (matrix)
-            deltam = np.dot(linalg.pinv2(A),R_MPFD)
-
-
-            if  np.max(np.abs(deltam[:])) < cfg.stop_tol:  #equation S.42
-                stop_flag = 1
-                hnp1mp1 = hnp1m + deltam
-
-                #Bottom boundary condition at bottom of the soil
-                #setting for the next time step value for next cycle
-                if cfg.BottomBC==0:
-                    hnp1mp1[0] = Head_bottom_H[i]
+            # Picard (or Newton) iteration solver
+            if cfg.nonlinear_solver == 'picard' and use_kernel:
+                hnp1mp1, m, converged = compiled_picard_step(hn, dt_step, forcing_at(q_rain, t_new, cfg.dt0), Pt_2d[:,it],
+                                                             forcing_at(Head_bottom_H, t_new, cfg.dt0), ws, max_iter)
+            elif cfg.nonlinear_solver == 'picard':
+                hnp1mp1, m, converged = picard_step(hn, dt_step, forcing_at(q_rain, t_new, cfg.dt0), Pt_2d[:,it],
+                                                    forcing_at(Head_bottom_H, t_new, cfg.dt0), ws, max_iter)
+            else:
+                hnp1mp1, m, converged = newton_step(hn, dt_step, forcing_at(q_rain, t_new, cfg.dt0), Pt_2d[:,it],
+                                                    forcing_at(Head_bottom_H, t_new, cfg.dt0), ws, max_iter,
+                                                    chord=(cfg.nonlinear_solver == 'chord'))
+            n_iterations = n_iterations + m
+
+            if telemetry is not None:
+                record_step(telemetry, t_new, dt_step, m, converged, ws)
+
+            if not converged:
+                if not cfg.adaptive_dt or dt_step <= cfg.dt_min:
+                    raise RuntimeError("Picard iteration did not converge at t = " + str(t_new) + " s with dt = " + str(dt_step) + " s")
+                #repeat the time step with a smaller dt
+                dt = next_time_step(dt_step, m, converged, cfg)
+                continue
+
+            if cfg.adaptive_dt:
+                dt = next_time_step(dt, m, converged, cfg)
+
+            t = t_new
+            i = i + 1
+            S_S[:,it] = ws['S_S']
+            Se[:,it] = ws['Se']
+
+            #saving output variables only every save_freq seconds
+            if np.mod(t,cfg.save_freq)==0:
+                sav=sav+1
+
+                col = 0 if cfg.stream_output else sav  #column of the saved arrays
+                H[:,col] = hnp1mp1 #saving potential
+                trans_2d[:,col]=Pt_2d[:,it] #1/s
+                hsoil=hnp1mp1[nz_s-(nz_r-nz_s):nz_s]
+                hroot=hnp1mp1[(nz_s):(nz_r)]
+                EVsink_ts[:,col]=-ws['Kr'][:]*(hsoil-hroot)  #sink term soil #saving
+
+                #saving output variables
+                K[:,col]=ws['knp1m']
+                THETA[:,col]=ws['theta']
+                Capac[:,col]=ws['cnp1m']
+                S_kx[:,col]=ws['stress_kx']
+                S_kr[:,col]=ws['stress_kr']
+                S_sink[:,col]=ws['stress_roots']
+                Kr_sink[:,col]=ws['Kr']
+
+                if cfg.UpperBC==0 and forcing_at(q_rain, t, cfg.dt0)>0:
+                    infiltration[sav]=ws['q_inf']
+
+                if stream is not None:
+                    stream.write(t, stream_snapshot(saved, col, sav, cfg.dz))
+
+                if monitor is not None:
+                    monitor(t, sav, saved)
+
+                if cfg.checkpoint and np.mod(t,cfg.checkpoint_freq)==0:
+                    #the streamed snapshots up to the checkpoint must be on disk before it is written
+                    if stream is not None:
+                        stream.flush()
+                    save_checkpoint(sim, {'hn': hnp1mp1, 't': t, 'i': i, 'dt': dt, 'sav': sav, 'niter': niter + 1,
+                                          'n_iterations': n_iterations}, saved, ws, telemetry)
+            niter=niter+1
+
+            if cfg.print_run_progress:
+                if (niter % cfg.print_freq) == 0:
+                    print("calculated time steps",niter)
 
-                #saving output variables only every 30min
-                if np.mod(t_num[i],1800)==0:
-                    sav=sav+1
+            hn=hnp1mp1 #condition for remaining time steps
+    finally:
+        if stream is not None:
+            stream.close()
 
-                    H[:,sav] = hnp1mp1 #saving potential
-                    trans_2d[:,sav]=Pt_2d[:,i] #1/s
-                    hsoil=hnp1mp1[nz_s-(nz_r-nz_s):nz_s]
-                    hroot=hnp1mp1[(nz_s):(nz_r)]
-                    EVsink_ts[:,sav]=-Kr[:]*(hsoil-hroot)  #sink term soil #saving
+    if cfg.print_run_progress:
+        print("time steps:", niter, "- nonlinear iterations:", n_iterations, "(" + cfg.nonlinear_solver + ")",
+              "- iterations per step:", round(n_iterations/max(niter, 1), 2))
+        if cfg.nonlinear_solver != 'picard':
+            print("Jacobian factorizations:", ws['n_factor'])
 
-                    #saving output variables
-                    K[:,sav]=knp1m
-                    THETA[:,sav]=theta
-                    Capac[:,sav]=cnp1m
-                    S_kx[:,sav]=stress_kx
-                    S_kr[:,sav]=stress_kr
-                    S_sink[:,sav]=stress_roots
-                    Kr_sink[:,sav]=Kr
+    if telemetry is not None:
+        finish_telemetry(telemetry)
 
-                    if cfg.UpperBC==0 and q_rain[i]>0:
-                        infiltration[sav]=q_inf
-                niter=niter+1
+    theta=ws['theta']
 
-                if cfg.print_run_progress:
-                    if (niter % cfg.print_freq) == 0:
-                        print("calculated time steps",niter)
+    #capacitance matrix of the last iteration
+    C=np.diagflat(ws['cnp1m'])
 
-            else:
-                hnp1mp1 =hnp1m + deltam
-                hnp1m = hnp1mp1
+    #the streamed outputs are in output/model_out.nc
+    if stream is not None:
+        return None, None,S_stomata,theta, None, None,C,None, None, None,None,None, infiltration,None
 
     return H*(10**(-6)), K,S_stomata,theta, S_kx, S_kr,C,Kr_sink, Capac, S_sink,EVsink_ts,THETA, infiltration,trans_2d
 
+def stream_snapshot(saved, col, sav, dz):
+    #snapshot sav of the half-hourly outputs (column col of the saved arrays), in the units returned
+    #by Picard (H in MPa), with the sums of output_writer.STREAM_SUMMARY computed as in format_model_output
+    snapshot = {name: x[..., col] for name, x in saved.items() if name != 'infiltration'}
+    snapshot['infiltration'] = saved['infiltration'][sav]
+    snapshot['H'] = snapshot['H']*(10**(-6))
+    snapshot.update(theta_storage=sum(snapshot['THETA']*dz), EVsink_total=sum(-snapshot['EVsink_ts']*dz),
+                    trans_sum=sum(snapshot['trans_2d']), trans=sum(snapshot['trans_2d']*dz)*1000)
+    return snapshot
+
 #Calculating water balance from model outputs
 def format_model_output(H,K,S_stomata,theta, S_kx, S_kr,C,Kr_sink, Capac, S_sink, EVsink_ts, THETA,
-                       infiltration,trans_2d, dt, dz):
+                       infiltration,trans_2d, dt, dz, sim=None):
+    #dt: interval of the saved outputs [s] (cfg.save_freq)
+    #with stream_output the half-hourly outputs are not returned by Picard (None): the water balance
+    #uses the sums written with every snapshot to output/model_out.nc (output_writer.STREAM_SUMMARY)
+    sim = _simulation(sim)
+    cfg, start_time = sim.cfg, sim.start_time
+    summary = read_stream_summary(sim) if cfg.stream_output else None
     ####################### Water balance ###################################
 
-    theta_i=sum(THETA[:,1]*cfg.dz)
-    theta_t=sum(THETA[:,-1]*cfg.dz)
+    if summary is not None:
+        theta_i=summary['theta_storage'][1]
+        theta_t=summary['theta_storage'][-1]
+    else:
+        theta_i=sum(THETA[:,1]*cfg.dz)
+        theta_t=sum(THETA[:,-1]*cfg.dz)
     theta_tot=theta_i-theta_t  #(m)
     theta_tot=theta_tot*1000  #(mm)
 
@@ -473,14 +967,21 @@ def format_model_output(H,K,S_stomata,theta, S_kx, S_kr,C,Kr_sink, Capac, S_sink
         theta_tot=(theta_tot)+infilt_tot
     ############################
 
-    EVsink_total=np.zeros(shape=(len(EVsink_ts[0])))
-    for i in np.arange(1,len(EVsink_ts[0]),1):
-        EVsink_total[i]=sum(-EVsink_ts[:,i]*dz)  #(1/s) over the simulation times dz [m]= m
+    if summary is not None:
+        EVsink_total=np.array(summary['EVsink_total'])
+        EVsink_total[0]=0
+    else:
+        EVsink_total=np.zeros(shape=(len(EVsink_ts[0])))
+        for i in np.arange(1,len(EVsink_ts[0]),1):
+            EVsink_total[i]=sum(-EVsink_ts[:,i]*dz)  #(1/s) over the simulation times dz [m]= m
 
     root_water=sum(EVsink_total)*1000*dt #mm
     #############################
 
-    transpiration_tot=sum(sum(trans_2d))*1000*dt*dz ##mm
+    if summary is not None:
+        transpiration_tot=sum(summary['trans_sum'])*1000*dt*dz ##mm
+    else:
+        transpiration_tot=sum(sum(trans_2d))*1000*dt*dz ##mm
 
     df_waterbal = pd.DataFrame(data={'theta_i':theta_i,
                 'theta_t':theta_t, 'theta_tot':theta_tot, 'infilt_tot':infilt_tot,
@@ -490,33 +991,162 @@ def format_model_output(H,K,S_stomata,theta, S_kx, S_kr,C,Kr_sink, Capac, S_sink
     #summing during all time steps and multiplying by 1000 = mm  #
     #the dt factor is accounting for the time step - to the TOTAl and not the rate
 
-    #end of simulation adding +1 time step to match dimensions
-    step_time = pd.Series(pd.date_range(start_time, end_time + pd.to_timedelta(dt, unit = 's'), freq=str(dt)+'s'))
+    #saving times of the outputs, dt apart from start_time
+    step_time = pd.Series(pd.date_range(start_time, periods=len(infiltration), freq=str(dt)+'s'))
     ############################################################################
 
     #########################################################
 
-    d = {'trans':(sum(trans_2d[:,:]*dz)*1000)} #mm/s
+    d = {'trans':summary['trans'] if summary is not None else (sum(trans_2d[:,:]*dz)*1000)} #mm/s
     df_EP = pd.DataFrame(data=d,index=step_time[:])
 
-    trans_h = dt*df_EP['trans'].resample('60T').sum() # hourly accumulated simulated transpiration
+    # hourly accumulated simulated transpiration, accumulated over each saving interval for dt > 3600 s
+    trans_h = dt*df_EP['trans'].resample('60T' if dt <= 3600 else str(dt)+'s').sum()
 
-    output_vars = {'H':H.transpose(), 'K': K.transpose(), 'S_stomata':S_stomata, 'theta':theta, 'S_kx':S_kx.transpose(),
-                   'S_kr':S_kr.transpose(), 'C':C, 'Kr_sink':Kr_sink.transpose(), 'Capac':Capac.transpose(), 'S_sink': S_sink.transpose(),
-                   'EVsink_ts':EVsink_ts.transpose(), 'trans_h':trans_h,'THETA':THETA.transpose(), 'infiltration':infiltration,
-                   'trans_2d':trans_2d.transpose(),'EVsink_total':EVsink_total}
+    if summary is not None:
+        #the half-hourly variables are in output/model_out.nc
+        output_vars = {'S_stomata':S_stomata, 'theta':theta, 'C':C, 'trans_h':trans_h, 'infiltration':infiltration,
+                       'EVsink_total':EVsink_total}
+    else:
+        output_vars = {'H':H.transpose(), 'K': K.transpose(), 'S_stomata':S_stomata, 'theta':theta, 'S_kx':S_kx.transpose(),
+                       'S_kr':S_kr.transpose(), 'C':C, 'Kr_sink':Kr_sink.transpose(), 'Capac':Capac.transpose(), 'S_sink': S_sink.transpose(),
+                       'EVsink_ts':EVsink_ts.transpose(), 'trans_h':trans_h,'THETA':THETA.transpose(), 'infiltration':infiltration,
+                       'trans_2d':trans_2d.transpose(),'EVsink_total':EVsink_total}
 
     return output_vars, df_waterbal, df_EP
 
 ####################### Save model outputs ###################################
-def save_output(output_vars, df_waterbal, df_EP):
-    #Writes model outputs to csv files
+#output profiles: names of output_vars, df_waterbal and df_EP written by save_output
+OUTPUT_PROFILES = {'all': None,
+                   'water_balance': ['trans_h', 'df_waterbal', 'THETA', 'H']}
+
+def output_selection(cfg):
+    #names of the outputs to write, None for all; cfg.output_variables is a profile of OUTPUT_PROFILES or a list
+    if isinstance(cfg.output_variables, str):
+        if cfg.output_variables not in OUTPUT_PROFILES:
+            raise ValueError("Unknown output profile '" + cfg.output_variables + "', options: " + ", ".join(OUTPUT_PROFILES))
+        return OUTPUT_PROFILES[cfg.output_variables]
+    return list(cfg.output_variables)
+
+def save_output(output_vars, df_waterbal, df_EP, sim=None):
+    #Writes the model outputs selected by cfg.output_variables to working_dir/output
+    #output_format 'csv': one csv file per variable
+    #              'npz': output/model_output.npz, compressed
+    #              'netcdf': output/model_output.nc, zlib compressed (requires netCDF4)
+    #the df_waterbal and df_EP tables are always written as csv
+    sim = _simulation(sim)
+    cfg, working_dir = sim.cfg, sim.working_dir
+    dtype = np.float32 if cfg.output_float32 else np.float64
 
     # make output directory if one doesn't exist
     (working_dir /'output').mkdir(exist_ok=True)
 
-    for var in output_vars:
-        pd.DataFrame(output_vars[var]).to_csv(working_dir / 'output' / (var + '.csv'), index = False, header=False)
+    selected = output_selection(cfg)
+    #with stream_output, the half-hourly variables are in output/model_out.nc
+    streamed = STREAM_VARIABLES if cfg.stream_output else {}
+    arrays = {var: np.asarray(output_vars[var], dtype=dtype) for var in output_vars
+              if var not in streamed and (selected is None or var in selected)}
+
+    if cfg.output_format == 'csv':
+        for var in arrays:
+            pd.DataFrame(arrays[var]).to_csv(working_dir / 'output' / (var + '.csv'), index = False, header=False)
+    elif cfg.output_format == 'npz':
+        np.savez_compressed(working_dir / 'output' / 'model_output.npz', **arrays)
+    elif cfg.output_format == 'netcdf':
+        import xarray as xr
+        ds = xr.Dataset({var: ([var + '_dim' + str(k) for k in range(x.ndim)], x) for var, x in arrays.items()})
+        ds.to_netcdf(working_dir / 'output' / 'model_output.nc', engine='netcdf4',
+                     encoding={var: {'zlib': True, 'complevel': 4} for var in arrays})
+    else:
+        raise ValueError("Unknown output_format '" + str(cfg.output_format) + "', options: csv, npz, netcdf")
+
+    if selected is None or 'df_waterbal' in selected:
+        df_waterbal.to_csv(working_dir / 'output' / ('df_waterbal' + '.csv'), index=False, header=True)
+    if selected is None or 'df_EP' in selected:
+        df_EP.to_csv(working_dir / 'output' / ('df_EP' + '.csv'), index=True, header=True)
+
+###############################################################################
+#SOLVER TELEMETRY
+###############################################################################
+#per step records of the nonlinear solver, including the rejected steps of the adaptive time stepping
+#kept as lists while running and converted to arrays by finish_telemetry
+TELEMETRY_FIELDS = {'t': float,                #time at the end of the step [s]
+                    'dt': float,               #time step [s]
+                    'converged': bool,
+                    'iterations': np.int32,    #nonlinear iterations
+                    'delta_max': float,        #max |deltam| of the last iteration [Pa]
+                    'time_properties': float,  #wall time of C, K, root uptake and residual [s]
+                    'time_assembly': float,    #wall time of the matrix (Picard) or Jacobian (Newton) [s]
+                    'time_solve': float,       #wall time of the linear solve [s]
+                    'q_inf': float,            #infiltration rate [m/s]
+                    'min_conductivity': float} #lowest fraction of the xylem conductivity left by cavitation
+
+def solver_telemetry():
+    #empty telemetry record to pass to Picard
+    return {field: [] for field in TELEMETRY_FIELDS}
+
+def record_step(telemetry, t, dt, m, converged, ws):
+    #appends one time step, read from the Picard workspace
+    telemetry['t'].append(t)
+    telemetry['dt'].append(dt)
+    telemetry['converged'].append(converged)
+    telemetry['iterations'].append(m)
+    telemetry['delta_max'].append(float(ws['delta_max']))
+    telemetry['time_properties'].append(ws['timings'][0])
+    telemetry['time_assembly'].append(ws['timings'][1])
+    telemetry['time_solve'].append(ws['timings'][2])
+    telemetry['q_inf'].append(float(ws['q_inf']))
+    telemetry['min_conductivity'].append(min(ws['stress_kr'].min(), ws['stress_kx'].min()))
+
+def finish_telemetry(telemetry):
+    #converts the records to compact arrays
+    for field, dtype in TELEMETRY_FIELDS.items():
+        telemetry[field] = np.asarray(telemetry[field], dtype=dtype)
+    return telemetry
+
+def telemetry_summary(telemetry, sim=None):
+    """
+    Summary table of the solver telemetry
+
+    Parameters
+    ----------
+    telemetry : dict
+        record filled by Picard
+    sim : simulation.Simulation
+        simulation of the run, for cfg.cavitation_threshold (model_config if not given)
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per metric; rain steps are the accepted steps with infiltration, and
+        cavitation steps those where some xylem node kept less than cfg.cavitation_threshold
+        of its conductivity
+    """
+    cfg = _simulation(sim).cfg
+    ok = np.asarray(telemetry['converged'], dtype=bool)
+    iterations = np.asarray(telemetry['iterations'])
+    delta_max = np.asarray(telemetry['delta_max'])[ok]
+    time_total = [np.sum(telemetry[field]) for field in ('time_properties', 'time_assembly', 'time_solve')]
+
+    summary = {'time steps': ok.sum(),
+               'rejected steps': (~ok).sum(),
+               'nonlinear iterations': iterations.sum(),
+               'iterations per step (mean)': iterations[ok].mean() if ok.any() else np.nan,
+               'iterations per step (max)': iterations.max() if len(iterations) else 0,
+               'final max |deltam| (max) [Pa]': delta_max.max() if len(delta_max) else np.nan,
+               'property evaluation time [s]': time_total[0],
+               'assembly time [s]': time_total[1],
+               'linear solve time [s]': time_total[2],
+               'steps with infiltration': (np.asarray(telemetry['q_inf'])[ok] > 0).sum(),
+               'steps with cavitation': (np.asarray(telemetry['min_conductivity'])[ok] < cfg.cavitation_threshold).sum()}
+
+    return pd.DataFrame({'metric': list(summary), 'value': list(summary.values())})
+
+def save_telemetry(telemetry, sim=None):
+    #Writes the per step telemetry and its summary table to csv files, next to the model outputs
+    working_dir = _simulation(sim).working_dir
+
+    (working_dir /'output').mkdir(exist_ok=True)
 
-    df_waterbal.to_csv(working_dir / 'output' / ('df_waterbal' + '.csv'), index=False, header=True)
-    df_EP.to_csv(working_dir / 'output' / ('df_EP' + '.csv'), index=True, header=True)
\ No newline at end of file
+    pd.DataFrame(telemetry).to_csv(working_dir / 'output' / 'solver_telemetry.csv', index=False, header=True)
+    telemetry_summary(telemetry, sim).to_csv(working_dir / 'output' / 'solver_summary.csv', index=False, header=True)
@@ -7,8 +7,6 @@ Created on Wed Mar 20 07:07:38 2019
 """
 import numpy as np
 
-from model_config import dz, Soil_depth, Root_depth, Hspec, sand_d, clay_d
-
 #This code is a simple example replicating the results of the topic
 #3.3 Modeling LAD and capacitance from the paper:
 #Tree Hydrodynamic Modelling of Soil Plant Atmosphere Continuum (SPAC-3Hpy)
@@ -62,6 +60,37 @@ def spatial_discretization(dz, Soil_depth, Root_depth, Hspec, sand_d, clay_d):
     return z_soil, nz_s, z_root, nz_r, z_Above, nz_Above, z_upper, z, nz, nz_sand, nz_clay
 
 
+###########################################################
+#Soil hydraulic parameters at each soil node
+###########################################################
+
+def soil_node_parameters(z_soil, clay_d, theta_S1, theta_R1, alpha_1, n_1, m_1, Ksat_1,
+                         theta_S2, theta_R2, alpha_2, n_2, m_2, Ksat_2):
+    """
+    Assigns the van Genuchten parameters of the soil duplex to each soil node
+    (clay for z <= clay_d, sand above). The layering does not change during a run,
+    so the arrays are built once and reused by vanGenuchten_nodes.
+
+    Parameters
+    ----------
+    z_soil : [m]
+        heights of the soil nodes
+    clay_d : [m]
+        depth of the clay/sand interface
+
+    Returns
+    -------
+    theta_S, theta_R, alpha, n, m, Ksat : arrays of length len(z_soil)
+    """
+    clay = z_soil <= clay_d
+    theta_S = np.where(clay, theta_S1, theta_S2)
+    theta_R = np.where(clay, theta_R1, theta_R2)
+    alpha = np.where(clay, alpha_1, alpha_2)
+    n = np.where(clay, n_1, n_2)
+    m = np.where(clay, m_1, m_2)
+    Ksat = np.where(clay, Ksat_1, Ksat_2)
+    return theta_S, theta_R, alpha, n, m, Ksat
+
 #############################################
 # Helper functions 
 #################################################
@@ -76,13 +105,21 @@ def interpolate_2d(x, zdim):
         input
     zdim : [type]
         length of z dimension
+
+    Returns
+    -------
+    array (zdim, len(x))
+        read-only view of x repeated along z (zero stride), the values are not copied
     """
-    x_2d = np.zeros(shape=(zdim, len(x)))
-    for i in np.arange(0,len(x),1):
-        x_2d[:,i]=x[i]
-    return x_2d
+    return np.broadcast_to(np.asarray(x, dtype=float), (zdim, len(x)))
 
 def neg2zero(x):
     return np.where(x < 0, 0, x)
 
-z_soil, nz_s, z_root, nz_r, z_Above, nz_Above, z_upper, z, nz, nz_sand, nz_clay = spatial_discretization(dz, Soil_depth, Root_depth, Hspec, sand_d, clay_d)
\ No newline at end of file
+#Discretization of the configuration in model_config (z_soil, nz_s, ..., soil_params),
+#built by simulation.default_simulation when first imported by name
+def __getattr__(name):
+    from simulation import Simulation, default_simulation
+    if name in Simulation._GRID:
+        return getattr(default_simulation(), name)
+    raise AttributeError("module 'model_setup' has no attribute '" + name + "'")
@@ -1,8 +1,11 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import pandas as pd
 import xarray as xr
 import numpy as np
 from scipy.interpolate import interp1d
+from scipy.linalg import solve_banded
 
 def calc_esat(Tair):
     '''
@@ -121,7 +124,68 @@ def thomas_tridiagonal (aa, bb, cc, dd):
 
     return q
 
-def solve_Uz(z, dz, Cd ,a_s, U_top, **kwargs):
+def solve_tridiagonal_batch(aa, bb, cc, dd, solver='thomas'):
+    """
+    Solves a batch of tridiagonal systems
+
+    Parameters
+    ----------
+    aa, bb, cc, dd : arrays (..., n)
+        lower, main and upper diagonals and right hand sides, as in thomas_tridiagonal
+        (aa[..., 0] and cc[..., -1] are not used), one system per leading index
+    solver : str
+        'thomas': forward and back sweeps of thomas_tridiagonal, vectorized over the batch
+                  (same operations, so the same results, as thomas_tridiagonal); a single
+                  system (1D arrays) is solved with thomas_tridiagonal itself
+        'banded': the systems are stacked along the diagonal of a single banded matrix and
+                  solved in one LU factorization (LAPACK, scipy.linalg.solve_banded), much
+                  faster than the sweeps for a few systems
+
+    Returns
+    -------
+    q : array (..., n)
+    """
+    shape = np.shape(bb)
+    if solver == 'thomas' and len(shape) == 1:
+        #the scalar sweeps are faster than the column indexing for one system
+        return thomas_tridiagonal(aa, bb, cc, dd)
+    n = shape[-1]
+    aa, bb, cc, dd = (np.reshape(v, (-1, n)) for v in (aa, bb, cc, dd))
+
+    if solver == 'banded':
+        #A[i, i+1] in row 0 and A[i+1, i] in row 2, zero between consecutive systems
+        ab = np.zeros((3, bb.size))
+        upper = np.array(cc, dtype=float)
+        upper[:, -1] = 0
+        lower = np.array(aa, dtype=float)
+        lower[:, 0] = 0
+        ab[0, 1:] = upper.ravel()[:-1]
+        ab[1] = bb.ravel()
+        ab[2, :-1] = lower.ravel()[1:]
+        q = solve_banded((1, 1), ab, np.ravel(dd), overwrite_ab=True, check_finite=False)
+        return q.reshape(shape)
+    elif solver != 'thomas':
+        raise ValueError("Unknown tridiagonal solver: " + str(solver))
+
+    bet = np.zeros(bb.shape)
+    gam = np.zeros(bb.shape)
+    q = np.zeros(bb.shape)
+
+    bet[:, 0] = bb[:, 0]
+    gam[:, 0] = dd[:, 0]/bb[:, 0]
+
+    for i in range(1, n):
+        bet[:, i] = bb[:, i] - (aa[:, i] * cc[:, i - 1] / bet[:, i - 1])
+        gam[:, i] = (dd[:, i] - aa[:, i] * gam[:, i - 1]) / bet[:, i]
+
+    q[:, -1] = gam[:, -1]
+
+    for i in range(n-2, -1, -1):
+        q[:, i] = gam[:, i]-(cc[:, i]*q[:, i+1]/bet[:, i])
+
+    return q.reshape(shape)
+
+def solve_Uz(z, dz, Cd ,a_s, U_top, tol=0.0001, tridiagonal_solver='thomas', **kwargs):
     """
     Solves the momentum equation to calculate the vertical wind profile.
     Applies no-slip boundary condition: wind speed  =  0 at surface (z = 0).
@@ -134,6 +198,8 @@ def solve_Uz(z, dz, Cd ,a_s, U_top, **kwargs):
     Cd : drag coefficient [unitless], assumed to be 0.2 (Katul et al 2004)
     a_s: leaf surface area [m2]
     U_top : Measured wind speed at top of canopy [m s-1]
+    tol : convergence tolerance of the wind speed [m s-1]
+    tridiagonal_solver : solver of solve_tridiagonal_batch, 'thomas' or 'banded'
     **kwargs to be passed to calc_mixing_length
 
     Outputs:
@@ -156,7 +222,7 @@ def solve_Uz(z, dz, Cd ,a_s, U_top, **kwargs):
     # start iterative solution
     err = 10**9
 
-    while err > 0.0001:
+    while err > tol:
         # dU/dz
         dU = np.zeros(n)
         dU[1:] = np.diff(U)/dz
@@ -185,8 +251,8 @@ def solve_Uz(z, dz, Cd ,a_s, U_top, **kwargs):
         dia[0] = 1
         dia[-1] = 1
 
-        # Solve tridiagonal matrix using Thomas algorithm
-        Un = thomas_tridiagonal(lod, dia, upd, co)
+        # Solve tridiagonal matrix
+        Un = solve_tridiagonal_batch(lod, dia, upd, co, tridiagonal_solver)
         err = np.max(np.abs(Un - U))
 
         # Use successive relaxations in iterations
@@ -195,6 +261,37 @@ def solve_Uz(z, dz, Cd ,a_s, U_top, **kwargs):
 
     return U, Km
 
+#normalized wind profiles of the canopies already solved, see solve_Uz_normalized
+_wind_profiles = {}
+
+def solve_Uz_normalized(z, dz, Cd, a_s, tol=10**-8, tridiagonal_solver='thomas', **kwargs):
+    """
+    Wind profile for U_top = 1 m s-1, solved once for each canopy
+
+    With the no-slip bottom boundary, Km = l**2 |dU/dz| and the drag Cd a_s |U| U,
+    the momentum equation is homogeneous of degree 2 in U: the profile for a wind
+    speed U_top at the top of the canopy is U_top times the profile for U_top = 1,
+    and Km scales likewise. The normalized profile is solved with solve_Uz to the
+    tolerance tol and kept for the next calls with the same canopy.
+
+    Inputs:
+    _______
+    z, dz, Cd, a_s, tridiagonal_solver, **kwargs : see solve_Uz
+    tol : convergence tolerance of the normalized wind speed [-]
+
+    Outputs:
+    ________
+    U1, Km1 : wind speed and turbulent diffusivity of momentum for U_top = 1 (read-only arrays)
+    """
+    key = (np.asarray(z, dtype=float).tobytes(), dz, Cd, np.asarray(a_s, dtype=float).tobytes(), tol,
+           tridiagonal_solver, tuple(sorted(kwargs.items())))
+    if key not in _wind_profiles:
+        U1, Km1 = solve_Uz(z, dz, Cd, a_s, 1, tol=tol, tridiagonal_solver=tridiagonal_solver, **kwargs)
+        U1.flags.writeable = False
+        Km1.flags.writeable = False
+        _wind_profiles[key] = U1, Km1
+    return _wind_profiles[key]
+
 def calc_gb(uz, d = 0.0015):
     """
     Calculates the leaf boundary layer conductance and resistance, assuming laminar boundary layer
@@ -303,6 +400,8 @@ def calc_rad_attenuation(PAR, LAD, dz, alpha, Cf = 0.85, x = 1, **kwargs):
     xn1=np.sqrt(alpha * alpha + (np.cos(np.deg2rad(zenith_angle))) ** 2)
     xd1=(alpha + 1.774 * np.cos(np.deg2rad(zenith_angle)) * (alpha + 1.182) **(-0.733))
     k = xn1/xd1
+    if np.ndim(k) > 0:  #one zenith angle per time step: attenuation on the (time, z) grid
+        k = k[:, None]
 
     LAI_cumulative = (LAD*dz)[::-1].cumsum()[::-1] # Cumulative sum from top of canopy
     # Calculate P0 and Qp
@@ -405,6 +504,9 @@ def solve_leaf_physiology(Tair, Qp, Ca, Vcmax25, alpha_p, VPD, **kwargs):
     def calc_Aj(alpha_p, e_m, Qp, Ci, gamma_star, Rd):
         return alpha_p * e_m * Qp * (Ci - gamma_star) / (Ci + 2 * gamma_star) - Rd
 
+    # Calculate leaf boundary layer resistance, which does not change over the iterations
+    gb, rb = calc_gb(**kwargs)
+
     # Solve for An, gs, and Ci
     Ci = 0.99 * Ca
     Cs = Ca  # CO2 concentration at the surface
@@ -421,8 +523,6 @@ def solve_leaf_physiology(Tair, Qp, Ca, Vcmax25, alpha_p, VPD, **kwargs):
         # Calculate stomatal conductance
         gs = calc_gs_Leuning(g0, m, A, Cs, gamma_star, VPD)
 
-        # Calculate leaf boundary layer resistance
-        gb, rb = calc_gb(**kwargs)
         Cs = np.maximum(Ca - A * rb, np.full(len(A), 0.1 * Ca))
         Ci2 = Cs - A / gs
         err = max(np.abs(Ci - Ci2))
@@ -487,7 +587,7 @@ def calc_respiration(Tair):
     Re = RE10 * Q10 **((Tair - Tr)/Tr)
     return Re
 
-def solve_C_closure(z, Kc, Ca, S_initial, Re, a_s, Tair, Qp, Vcmax25, alpha_p, VPD,**kwargs):
+def solve_C_closure(z, Kc, Ca, S_initial, Re, a_s, Tair, Qp, Vcmax25, alpha_p, VPD, tridiagonal_solver='thomas', **kwargs):
 
     CF = 1.15 * 1000 / 29
     Re = Re / CF
@@ -520,8 +620,8 @@ def solve_C_closure(z, Kc, Ca, S_initial, Re, a_s, Tair, Qp, Vcmax25, alpha_p, V
         upd[-1] = 0
         co[-1] = Ca[-1]
 
-        # Use Thomas algorithm to solve
-        Cn = thomas_tridiagonal(lod, dia, upd, co)
+        # Solve tridiagonal matrix
+        Cn = solve_tridiagonal_batch(lod, dia, upd, co, tridiagonal_solver)
         err = np.max(np.abs(Cn - C))
 
         #use successive relaxations in iterations
@@ -576,7 +676,7 @@ def calc_LAI_vertical(LADnorm, z_h_LADnorm, tot_LAI_crown, dz, h):
 
     return LAD_z
 
-def calc_NHL(dz, h, Cd, U_top, ustar, PAR, Ca, Vcmax25, alpha_gs, alpha_p, total_LAI_sp, plot_area, total_crown_area_sp, mean_crown_area_sp, LADnorm, z_h_LADnorm, RH, Tair, Press, Cf=0.85, x=1, **kwargs):
+def calc_NHL(dz, h, Cd, U_top, ustar, PAR, Ca, Vcmax25, alpha_gs, alpha_p, total_LAI_sp, plot_area, total_crown_area_sp, mean_crown_area_sp, LADnorm, z_h_LADnorm, RH, Tair, Press, Cf=0.85, x=1, wind_profile='solve', tridiagonal_solver='thomas', leaf_solver='fixed_point', **kwargs):
     """
     Calculate NHL transpiration
 
@@ -597,6 +697,14 @@ def calc_NHL(dz, h, Cd, U_top, ustar, PAR, Ca, Vcmax25, alpha_gs, alpha_p, total
         effective leaf conductance
     Press : [kPa]
         air pressure
+    wind_profile : str
+        'scaled': normalized wind profile of the canopy (solve_Uz_normalized) times U_top
+        'solve' : wind profile solved for U_top (solve_Uz)
+    tridiagonal_solver : str
+        solver of the wind profile systems, 'thomas' or 'banded' (see solve_tridiagonal_batch)
+    leaf_solver : str
+        iterations of the leaf physiology: 'fixed_point' (solve_leaf_physiology), or 'masked'
+        or 'secant' (see solve_leaf_physiology_batch)
 
     Returns
     -------
@@ -617,7 +725,11 @@ def calc_NHL(dz, h, Cd, U_top, ustar, PAR, Ca, Vcmax25, alpha_gs, alpha_p, total
     LAD = calc_LAI_vertical(LADnorm, z_h_LADnorm, tot_LAI_crown, dz, h) #[m2leaf m-2crown m-1stem]
 
     # Calculate wind speed at each layer
-    U, Km = solve_Uz(z, dz, Cd , LAD , U_top, h = h)
+    if wind_profile == 'scaled':
+        U1, Km1 = solve_Uz_normalized(z, dz, Cd, LAD, tridiagonal_solver = tridiagonal_solver, h = h)
+        U, Km = U_top * U1, U_top * Km1
+    else:
+        U, Km = solve_Uz(z, dz, Cd , LAD , U_top, tridiagonal_solver = tridiagonal_solver, h = h)
 
     # Adjust the diffusivity and velocity by Ustar
     U = U * ustar
@@ -627,7 +739,12 @@ def calc_NHL(dz, h, Cd, U_top, ustar, PAR, Ca, Vcmax25, alpha_gs, alpha_p, total
     P0, Qp, zenith_angle = calc_rad_attenuation(PAR, LAD, dz, alpha_gs, Cf, x, **kwargs)
 
     # Solve conductances
-    A, gs, Ci, Cs, gb, geff = solve_leaf_physiology(Tair, Qp, Ca, Vcmax25, alpha_p, VPD = VPD, uz = U)
+    if leaf_solver == 'fixed_point':
+        A, gs, Ci, Cs, gb, geff = solve_leaf_physiology(Tair, Qp, Ca, Vcmax25, alpha_p, VPD = VPD, uz = U)
+    else:
+        A, gs, Ci, Cs, gb, geff = (v[0] for v in solve_leaf_physiology_batch(
+            np.reshape(Tair, (1, 1)), Qp[None, :], np.reshape(Ca, (1, 1)), Vcmax25, alpha_p, np.reshape(VPD, (1, 1)),
+            U[None, :], method = leaf_solver))
 
     # Calculate the transpiration per m-1 [ kg H2O s-1 m-1_stem]
     NHL_trans_leaf = calc_transpiration_leaf(VPD, Tair, geff, Press)  #[kg H2O m-2leaf s-1]
@@ -657,7 +774,8 @@ def calc_NHL(dz, h, Cd, U_top, ustar, PAR, Ca, Vcmax25, alpha_gs, alpha_p, total
 
 def calc_NHL_timesteps(dz, h, Cd, met_data, Vcmax25, alpha_gs, alpha_p,
             total_LAI_spn, plot_area, total_crown_area_spn, mean_crown_area_spn, LAD_norm, z_h_LADnorm,
-            lat, long, time_offset = -5):
+            lat, long, time_offset = -5, wind_profile = 'solve', tridiagonal_solver = 'thomas',
+            leaf_solver = 'fixed_point'):
 
     zmin = 0
     z = np.arange(zmin, h, dz)  # [m]
@@ -673,7 +791,7 @@ def calc_NHL_timesteps(dz, h, Cd, met_data, Vcmax25, alpha_gs, alpha_p,
         ds, LAD, zenith_angle = calc_NHL(
             dz, h, Cd, met_data.WS_F.iloc[i], met_data.USTAR.iloc[i], met_data.PPFD_IN.iloc[i], met_data.CO2_F.iloc[i], Vcmax25, alpha_gs, alpha_p,
             total_LAI_spn, plot_area, total_crown_area_spn, mean_crown_area_spn, LAD_norm, z_h_LADnorm,
-            met_data.RH.iloc[i], met_data.TA_F.iloc[i], met_data.PA_F.iloc[i], doy = met_data.Timestamp.iloc[i].dayofyear, lat = lat,
+            met_data.RH.iloc[i], met_data.TA_F.iloc[i], met_data.PA_F.iloc[i], wind_profile = wind_profile, tridiagonal_solver = tridiagonal_solver, leaf_solver = leaf_solver, doy = met_data.Timestamp.iloc[i].dayofyear, lat = lat,
             long= long, time_offset = time_offset, time_of_day = met_data.Timestamp[i].hour + met_data.Timestamp[i].minute/60)
 
         zenith_angle_all[i] = zenith_angle
@@ -681,6 +799,336 @@ def calc_NHL_timesteps(dz, h, Cd, met_data, Vcmax25, alpha_gs, alpha_p,
     d2 = xr.concat(datasets, pd.Index(met_data.Timestamp, name="time"))
     return d2, LAD, zenith_angle_all
 
+def calc_NHL_timesteps_parallel(calc_timesteps, dz, h, Cd, met_data, *args, processes=None, chunk_size=None, **kwargs):
+    """
+    Runs calc_timesteps on time chunks of met_data in a process pool and reassembles
+    the outputs in time order. The met records are independent of each other, so the
+    outputs are the same as those of calc_timesteps on the whole of met_data.
+
+    Parameters
+    ----------
+    calc_timesteps : function
+        calc_NHL_timesteps or calc_NHL_timesteps_batch
+    dz, h, Cd, met_data, *args, **kwargs :
+        parameters of calc_timesteps
+    processes : int
+        number of worker processes (number of CPUs if not given)
+    chunk_size : int
+        number of met records of each chunk (four chunks per process if not given)
+
+    Returns
+    -------
+    outputs of calc_timesteps
+    """
+    processes = processes if processes is not None else multiprocessing.cpu_count()
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(met_data) // (4 * processes)))
+    chunks = [met_data.iloc[i:i + chunk_size].reset_index(drop=True) for i in range(0, len(met_data), chunk_size)]
+
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(processes, mp_context=ctx) as pool:
+        futures = [pool.submit(calc_timesteps, dz, h, Cd, chunk, *args, **kwargs) for chunk in chunks]
+        results = [future.result() for future in futures]
+
+    ds = xr.concat([result[0] for result in results], dim="time")
+    zenith_angle_all = np.concatenate([result[2] for result in results])
+    return ds, results[0][1], zenith_angle_all
+
+###############################################################################
+#BATCHED NHL ENGINE
+###############################################################################
+#The functions below evaluate all the met records at once on the (time, z) grid.
+#Time-dependent inputs are arrays of shape (nt,) (or (nt, 1) columns to broadcast
+#against the heights), the iterative solvers keep iterating only the time columns
+#that have not converged yet, with the convergence criteria of the serial functions,
+#so every column goes through the same iterations as in calc_NHL.
+
+def solve_Uz_batch(z, dz, Cd, a_s, U_top, tridiagonal_solver='thomas', **kwargs):
+    """
+    solve_Uz for the wind speeds at the top of the canopy of all time steps
+
+    Parameters
+    ----------
+    z, dz, Cd, a_s, tridiagonal_solver, **kwargs :
+        see solve_Uz
+    U_top : array (nt) [m s-1]
+        measured wind speed at the top of the canopy
+
+    Returns
+    -------
+    U, Km : arrays (nt, nz)
+        wind speed and turbulent diffusivity of momentum, see solve_Uz
+    """
+    n = len(z)
+    U_bottom = 0  # no-slip boundary
+    U = np.linspace(U_bottom, U_top, n, axis=-1)  # linear profiles to begin the iterations
+    Km = np.zeros(U.shape)
+
+    mixing_length = calc_mixing_length(z, **kwargs)
+
+    # iterate the time steps that have not converged
+    active = np.arange(len(U))
+    while len(active) > 0:
+        Ua = U[active]
+
+        # dU/dz
+        dU = np.zeros(Ua.shape)
+        dU[:, 1:] = np.diff(Ua)/dz
+        dU[:, 0] = dU[:, 1]
+
+        # model for diffusivity, from Poggi et al 2004, eqn 6
+        Kma = (mixing_length ** 2) * np.abs(dU)
+
+        # Set up coefficients for ODE
+        a1 = -Kma
+        dKm = np.concatenate((Kma[:, 1:2]-Kma[:, 0:1], np.diff(Kma)), axis=1)
+        a2 = -dKm/dz
+        a3 = Cd * a_s * np.abs(Ua)
+
+        # Set the elements of the tridiagonal matrices
+        upd = (a1 / (dz * dz) + a2 / (2 * dz))
+        dia = (-a1 * 2 / (dz * dz) + a3)
+        lod = (a1 / (dz * dz) - a2 / (2 * dz))
+        co = np.zeros(Ua.shape)
+        co[:, 0] = U_bottom
+        co[:, -1] = U_top[active]
+        lod[:, 0] = 0
+        lod[:, -1] = 0
+        upd[:, 0] = 0
+        upd[:, -1] = 0
+        dia[:, 0] = 1
+        dia[:, -1] = 1
+
+        Un = solve_tridiagonal_batch(lod, dia, upd, co, tridiagonal_solver)
+        err = np.max(np.abs(Un - Ua), axis=1)
+
+        # Use successive relaxations in iterations
+        eps1 = 0.5
+        U[active] = eps1 * Un + (1 - eps1) * Ua
+        Km[active] = Kma
+        active = active[err > 0.0001]
+
+    return U, Km
+
+def solve_leaf_physiology_batch(Tair, Qp, Ca, Vcmax25, alpha_p, VPD, uz, method='fixed_point', return_iterations=False):
+    """
+    solve_leaf_physiology for all time steps
+
+    Parameters
+    ----------
+    Tair, Ca, VPD : arrays (nt, 1)
+        air temperature [deg C], CO2 concentration and vapor pressure deficit [kPa]
+    Qp, uz : arrays (nt, nz)
+        absorbed PAR and wind speed
+    Vcmax25, alpha_p :
+        see solve_leaf_physiology
+    method : str
+        'fixed_point': fixed-point iterations of solve_leaf_physiology, each time step iterating
+                       until all its heights have converged (same results as solve_leaf_physiology)
+        'masked'     : the same iterations, each (time, z) element stopping as soon as it has converged
+        'secant'     : secant iterations on the residual Ci2(Ci) - Ci of the fixed point, each
+                       element stopping as soon as it has converged
+        The fixed-point map computes gs with Cs of the previous iteration, as solve_leaf_physiology
+        does, while the secant residual uses Cs of the current A: the two maps only agree at
+        convergence, so the iteration counts of 'secant' and of the fixed-point methods do not
+        measure the same thing, and the solutions agree within the tolerance of the iterations
+    return_iterations : bool
+        also return the number of iterations of each element
+
+    Returns
+    -------
+    A, gs, Ci, Cs, gb, geff : arrays (nt, nz)
+        see solve_leaf_physiology
+    iterations : array (nt, nz) of int
+        iterations of each element, if return_iterations
+    """
+    # Parameters
+    #Farquhar model
+    Kc25 = 300 # [umol mol-1] Michaelis-Menten constant for CO2, at 25 deg C
+    Ko25 = 300 # [mmol mol-1] Michaelis-Menten constant for O2, at 25 deg C
+    e_m = 0.08 # [mol mol-1]
+    o = 210 #[mmol mol-1]
+    #Leuning model
+    g0 = 0.01 #[mol m-2 s-1]
+    m = 4.0  #unitless
+
+    # Adjust the Farquhar model parameters for temperature
+    Vcmax = Vcmax25 * np.exp( 0.088 * (Tair - 25)) / (1 + np.exp(0.29 * (Tair - 41)))
+    Kc = Kc25 * np.exp(0.074 * (Tair -25))
+    Ko = Ko25 * np.exp(0.018 * (Tair - 25))
+
+    #Calculate gamma_star and Rd
+    Rd = 0.015 * Vcmax  # Dark respiration [umol m-2 s-1]
+    gamma_star = (3.69 + 0.188 * (Tair - 25) + 0.0036 * (Tair -25 ) ** 2) * 10
+
+    # Terms that do not change over the iterations: leaf boundary layer resistance,
+    # Michaelis-Menten term of Ac and quantum yield term of Aj
+    gb, rb = calc_gb(uz)
+    Kco = Kc * (1 + o / Ko)
+    aq = alpha_p * e_m * Qp
+
+    # The iterations run over units: the time steps (rows of the grid) for 'fixed_point',
+    # the (time, z) elements otherwise. All the inputs are laid out as (units, heights of a unit)
+    shape = np.broadcast(Qp, Ca).shape
+    if method == 'fixed_point':
+        units = shape[0]
+    elif method in ('masked', 'secant'):
+        units = shape[0] * shape[1]
+    else:
+        raise ValueError("Unknown leaf physiology solver: " + str(method))
+    aq, Vcmax, Kco, Rd, gamma_star, Ca, VPD, rb = (np.broadcast_to(v, shape).reshape(units, -1)
+                                                   for v in (aq, Vcmax, Kco, Rd, gamma_star, Ca, VPD, rb))
+
+    def calc_A(Ci, i):
+        # net assimilation of the units i, minimum of the RuBP limited and saturated rates
+        Aj = aq[i] * (Ci - gamma_star[i]) / (Ci + 2 * gamma_star[i]) - Rd[i]
+        Ac = Vcmax[i] * (Ci - gamma_star[i])/(Ci + Kco[i]) - Rd[i]
+        return np.minimum(Ac, Aj)
+
+    # Solve for An, gs, and Ci, iterating the units that have not converged
+    Ci = 0.99 * Ca
+    Cs = Ca.copy()  # CO2 concentration at the surface
+    A, gs = np.zeros(Ci.shape), np.zeros(Ci.shape)
+    iterations = np.zeros(units, dtype=int)
+
+    active = np.arange(units)
+    count = 0
+    if method == 'secant':
+        Ci_prev, F_prev = np.zeros(Ci.shape), np.zeros(Ci.shape)
+    while len(active) > 0 and count < 200:
+        Ci_a = Ci[active]
+        A_a = calc_A(Ci_a, active)
+
+        if method == 'secant':
+            # Ci2(Ci) with the surface concentration of the current Ci
+            Cs_a = np.maximum(Ca[active] - A_a * rb[active], 0.1 * Ca[active])
+            gs_a = calc_gs_Leuning(g0, m, A_a, Cs_a, gamma_star[active], VPD[active])
+            Ci2 = Cs_a - A_a / gs_a
+            F = Ci2 - Ci_a
+
+            # secant update, fixed-point update at the first iteration and for flat secants
+            Ci_next = Ci2
+            if count > 0:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    secant = Ci_a - F * (Ci_a - Ci_prev[active]) / (F - F_prev[active])
+                Ci_next = np.where(np.isfinite(secant), secant, Ci2)
+            Ci_prev[active], F_prev[active] = Ci_a, F
+        else:
+            # Calculate stomatal conductance, with the surface concentration of the previous iteration
+            gs_a = calc_gs_Leuning(g0, m, A_a, Cs[active], gamma_star[active], VPD[active])
+            Cs_a = np.maximum(Ca[active] - A_a * rb[active], 0.1 * Ca[active])
+            Ci2 = Cs_a - A_a / gs_a
+            Ci_next = Ci2
+
+        err = np.max(np.abs(Ci_a - Ci2), axis=1)
+        converged = ~(err > 0.01)
+        Ci_next[converged] = Ci2[converged]
+
+        A[active], gs[active], Cs[active], Ci[active] = A_a, gs_a, Cs_a, Ci_next
+        count += 1
+        iterations[active] = count
+        active = active[~converged]
+
+    A, gs, Ci, Cs = (x.reshape(shape) for x in (A, gs, Ci, Cs))
+    gb = np.broadcast_to(gb, shape).copy()
+    geff = calc_geff(gb, gs)
+
+    for x in (A, Ci, Cs, gs, gb, geff):
+        x[:, 0] = x[:, 1]
+
+    if return_iterations:
+        return A, gs, Ci, Cs, gb, geff, np.broadcast_to(iterations.reshape(shape[0], -1), shape).copy()
+    return A, gs, Ci, Cs, gb, geff
+
+def calc_NHL_batch(dz, h, Cd, U_top, ustar, PAR, Ca, Vcmax25, alpha_gs, alpha_p, total_LAI_sp, plot_area, total_crown_area_sp, mean_crown_area_sp, LADnorm, z_h_LADnorm, RH, Tair, Press, Cf=0.85, x=1, wind_profile='solve', tridiagonal_solver='thomas', leaf_solver='fixed_point', **kwargs):
+    """
+    calc_NHL for all time steps
+
+    Parameters
+    ----------
+    U_top, ustar, PAR, Ca, RH, Tair, Press : arrays (nt)
+        met records of the time steps
+    **kwargs :
+        for calc_zenith_angle, doy and time_of_day being arrays (nt)
+    other parameters :
+        see calc_NHL
+
+    Returns
+    -------
+    variables : dict
+        U, Km, P0, Qp, A, gs, Ci, Cs, gb, geff, NHL_trans_leaf, NHL_trans_sp_stem : arrays (nt, nz)
+        leaf_iterations : array (nt, nz), iterations of the leaf physiology
+    LAD : array (nz)
+    zenith_angle : array (nt)
+    """
+    #time-dependent values as columns, to broadcast against the heights
+    PAR, Ca, RH, Tair, Press = (np.asarray(v, dtype=float)[:, None] for v in (PAR, Ca, RH, Tair, Press))
+
+    # Calculate VPD
+    VPD = calc_vpd_kPa(RH, Tair = Tair)
+
+    #Set up vertical grid
+    zmin = 0
+    z = np.arange(zmin, h, dz)  # [m]
+
+    # Calculate leaf area for each vertical layer (for one tree)
+    tot_LAI_crown = total_LAI_sp * plot_area / total_crown_area_sp  # LAI per crown area [m2_leaf m-2_crown]
+
+    # Distrubute leaves vertically, and assign leaf area to stem
+    LAD = calc_LAI_vertical(LADnorm, z_h_LADnorm, tot_LAI_crown, dz, h) #[m2leaf m-2crown m-1stem]
+
+    # Calculate wind speed at each layer
+    U_top = np.asarray(U_top, dtype=float)
+    if wind_profile == 'scaled':
+        U1, Km1 = solve_Uz_normalized(z, dz, Cd, LAD, tridiagonal_solver = tridiagonal_solver, h = h)
+        U, Km = U_top[:, None] * U1, U_top[:, None] * Km1
+    else:
+        U, Km = solve_Uz_batch(z, dz, Cd, LAD, U_top, tridiagonal_solver = tridiagonal_solver, h = h)
+
+    # Adjust the diffusivity and velocity by Ustar
+    ustar = np.asarray(ustar, dtype=float)[:, None]
+    U = U * ustar
+    Km = Km * ustar
+
+    # Calculate radiation at each layer
+    P0, Qp, zenith_angle = calc_rad_attenuation(PAR, LAD, dz, alpha_gs, Cf, x, **kwargs)
+
+    # Solve conductances
+    A, gs, Ci, Cs, gb, geff, leaf_iterations = solve_leaf_physiology_batch(Tair, Qp, Ca, Vcmax25, alpha_p, VPD, U,
+                                                                            method = leaf_solver, return_iterations = True)
+
+    # Calculate the transpiration per m-1 [ kg H2O s-1 m-1_stem]
+    NHL_trans_leaf = calc_transpiration_leaf(VPD, Tair, geff, Press)  #[kg H2O m-2leaf s-1]
+    NHL_trans_sp_stem = NHL_trans_leaf * LAD  # [kg H2O s-1 m-1stem m-2ground]
+
+    variables = dict(U=U, Km=Km, P0=P0, Qp=Qp, A=A, gs=gs, Ci=Ci, Cs=Cs, gb=gb, geff=geff,
+                     NHL_trans_leaf=NHL_trans_leaf, NHL_trans_sp_stem=NHL_trans_sp_stem, leaf_iterations=leaf_iterations)
+    return variables, LAD, zenith_angle
+
+def calc_NHL_timesteps_batch(dz, h, Cd, met_data, Vcmax25, alpha_gs, alpha_p,
+            total_LAI_spn, plot_area, total_crown_area_spn, mean_crown_area_spn, LAD_norm, z_h_LADnorm,
+            lat, long, time_offset = -5, wind_profile = 'solve', tridiagonal_solver = 'thomas',
+            leaf_solver = 'fixed_point'):
+    """
+    calc_NHL_timesteps with calc_NHL_batch: same parameters and outputs (dataset of
+    the (time, z) variables, LAD and zenith angles of the met records), the dataset
+    also holding the iterations of the leaf physiology (leaf_iterations)
+    """
+    zmin = 0
+    z = np.arange(zmin, h, dz)  # [m]
+
+    timestamp = met_data.Timestamp.dt
+    variables, LAD, zenith_angle_all = calc_NHL_batch(
+        dz, h, Cd, met_data.WS_F.values, met_data.USTAR.values, met_data.PPFD_IN.values, met_data.CO2_F.values, Vcmax25, alpha_gs, alpha_p,
+        total_LAI_spn, plot_area, total_crown_area_spn, mean_crown_area_spn, LAD_norm, z_h_LADnorm,
+        met_data.RH.values, met_data.TA_F.values, met_data.PA_F.values, wind_profile = wind_profile, tridiagonal_solver = tridiagonal_solver, leaf_solver = leaf_solver, doy = timestamp.dayofyear.values, lat = lat,
+        long = long, time_offset = time_offset, time_of_day = (timestamp.hour + timestamp.minute/60).values)
+
+    d2 = xr.Dataset(data_vars={name: (["time", "z"], value) for name, value in variables.items()},
+                    coords=dict(time=pd.Index(met_data.Timestamp, name="time"), z=(["z"], z)),
+                    attrs=dict(description="Model output"))
+    return d2, LAD, zenith_angle_all
+
 def calc_stem_wp_response(stem_wp, wp_s50, c3):
     """
     Calculates the restriction for NHL transpiration
@@ -708,11 +1156,11 @@ def calc_stem_wp_response(stem_wp, wp_s50, c3):
 def calc_transpiration_nhl(nhl_transpiration, stem_wp_fn, LAD):
     return nhl_transpiration * stem_wp_fn * LAD
 
-def write_outputs(output_vars):
+def write_outputs(output_vars, working_dir=None):
 
-    #Writes model outputs to csv files
+    #Writes model outputs to csv files in working_dir/output (current directory if not given)
 
-    working_dir = Path.cwd()
+    working_dir = Path(working_dir) if working_dir is not None else Path.cwd()
 
     # make output directory if one doesn't exist
     (working_dir /'output').mkdir(exist_ok=True)
@@ -720,18 +1168,20 @@ def write_outputs(output_vars):
     for var in output_vars:
         pd.DataFrame(output_vars[var]).to_csv(working_dir / 'output' / ('nhl_' + var + '.csv'), index = False, header=False)
 
-def write_outputs_netcdf(ds):
+def write_outputs_netcdf(ds, working_dir=None):
     """
     Writes model output to netcdf file
 
     Parameters
     ----------
     ds : [xarray dataset]
+    working_dir : [Path]
+        the file is written to working_dir/output (current directory if not given)
     """
 
 
 
-    working_dir = Path.cwd()
+    working_dir = Path(working_dir) if working_dir is not None else Path.cwd()
 
     # make output directory if one doesn't exist
     (working_dir /'output').mkdir(exist_ok=True)
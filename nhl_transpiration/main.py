@@ -4,41 +4,92 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 
-import nhl_transpiration.nhl_config as ncfg
 from nhl_transpiration.NHL_functions import *
 
-# Read in LAD and met data
-# Met data must include
-met_data = pd.read_csv(Path.cwd() / 'nhl_transpiration/data' / ncfg.met_data, parse_dates=[0])
-LAD_data = pd.read_csv(Path.cwd() / 'nhl_transpiration/data' / ncfg.LAD_norm)
+def run_nhl(ncfg, working_dir=None):
+    """
+    Runs the NHL transpiration model and interpolates the transpiration to the
+    model resolution. The NHL outputs are written to working_dir/output.
 
-met_data = met_data[(met_data.Timestamp >= pd.to_datetime(ncfg.start_time)) &
-                    (met_data.Timestamp <= pd.to_datetime(ncfg.end_time))].reset_index(drop=True)
+    Parameters
+    ----------
+    ncfg : module or namespace
+        NHL parameters (nhl_transpiration.nhl_config or RunConfig.nhl_config())
+    working_dir : Path
+        directory containing nhl_transpiration/data (current directory if not given)
 
-total_LAI_sp = np.array([1.1,1.45,0.84,0.044])*1.176*1.1 # vector, total leaf area index for each species [m2-leaf/m2-ground]
-crown_scaling = np.array([2, 0.2, 0.1, 8])
-total_crown_area_sp = total_LAI_sp * crown_scaling / sum(total_LAI_sp * crown_scaling) * ncfg.plot_area
+    Returns
+    -------
+    NHL_modelres : array (time, z)
+        NHL transpiration at model resolution [m s-1 * m-1stem]
+    LAD : array
+        leaf area density
+    """
+    working_dir = Path(working_dir) if working_dir is not None else Path.cwd()
 
-ds, LAD, zen = calc_NHL_timesteps(ncfg.dz, ncfg.height_sp, ncfg.Cd, met_data, ncfg.Vcmax25, ncfg.alpha_gs, ncfg.alpha_p,
+    # Read in LAD and met data
+    # Met data must include
+    met_data = pd.read_csv(working_dir / 'nhl_transpiration/data' / ncfg.met_data, parse_dates=[0])
+    LAD_data = pd.read_csv(working_dir / 'nhl_transpiration/data' / ncfg.LAD_norm)
+
+    met_data = met_data[(met_data.Timestamp >= pd.to_datetime(ncfg.start_time)) &
+                        (met_data.Timestamp <= pd.to_datetime(ncfg.end_time))].reset_index(drop=True)
+
+    total_LAI_sp = np.array([1.1,1.45,0.84,0.044])*1.176*1.1 # vector, total leaf area index for each species [m2-leaf/m2-ground]
+    crown_scaling = np.array([2, 0.2, 0.1, 8])
+    total_crown_area_sp = total_LAI_sp * crown_scaling / sum(total_LAI_sp * crown_scaling) * ncfg.plot_area
+
+    if ncfg.engine == 'batch':
+        calc_timesteps = calc_NHL_timesteps_batch
+    elif ncfg.engine == 'serial':
+        calc_timesteps = calc_NHL_timesteps
+    else:
+        raise ValueError("Unknown NHL engine: " + str(ncfg.engine))
+
+    args = (ncfg.dz, ncfg.height_sp, ncfg.Cd, met_data, ncfg.Vcmax25, ncfg.alpha_gs, ncfg.alpha_p,
             ncfg.total_LAI_sp, ncfg.plot_area, total_crown_area_sp[0], ncfg.mean_crown_area_sp, LAD_data[ncfg.species], LAD_data.z_h,
-            ncfg.latitude, ncfg.longitude, time_offset = ncfg.time_offset)
+            ncfg.latitude, ncfg.longitude)
+    if ncfg.processes > 1:
+        ds, LAD, zen = calc_NHL_timesteps_parallel(calc_timesteps, *args, time_offset = ncfg.time_offset,
+                                                   wind_profile = ncfg.wind_profile, tridiagonal_solver = ncfg.tridiagonal_solver,
+                                                   leaf_solver = ncfg.leaf_solver, processes = ncfg.processes,
+                                                   chunk_size = ncfg.chunk_size)
+    else:
+        ds, LAD, zen = calc_timesteps(*args, time_offset = ncfg.time_offset, wind_profile = ncfg.wind_profile,
+                                      tridiagonal_solver = ncfg.tridiagonal_solver, leaf_solver = ncfg.leaf_solver)
+
+    #iterations of the leaf physiology of the batch engine, reported once for all the chunks
+    if 'leaf_iterations' in ds:
+        print('Leaf physiology (' + ncfg.leaf_solver + '): ' + str(round(float(ds.leaf_iterations.mean()), 2))
+              + ' iterations per element, max ' + str(int(ds.leaf_iterations.max())))
+        ds = ds.drop_vars('leaf_iterations')
+
+    write_outputs_netcdf(ds, working_dir)
+    write_outputs({'zenith':zen, 'LAD': LAD}, working_dir)
+
+    #Interpolate to model time resolution
+    #time in seconds
+    ds2 = ds.assign_coords({'time': pd.to_timedelta(pd.to_datetime(ds.time.values) - pd.to_datetime(ds.time.values[0]))/ np.timedelta64(1,'s')})
 
-write_outputs_netcdf(ds)
-write_outputs({'zenith':zen, 'LAD': LAD})
+    # New time and space coordinates matching model resolution
+    model_ts = np.arange(0, len(ds.time) * ncfg.met_dt + ncfg.dt0, ncfg.dt0)
+    model_z = np.arange(0, ncfg.height_sp, ncfg.dz)
 
-#Interpolate to model time resolution
-#time in seconds
-ds2 = ds.assign_coords({'time': pd.to_timedelta(pd.to_datetime(ds.time.values) - pd.to_datetime(ds.time.values[0]))/ np.timedelta64(1,'s')})
+    #NHL transpiration in units of m s-1 * LAD  = kg H2O s-1 m-1stem m-2ground
+    da = ds2.NHL_trans_sp_stem * 10**-3 #NHL in units of m s-1 * m-1stem
 
-# New time and space coordinates matching model resolution
-model_ts = np.arange(0, len(ds.time) * ncfg.met_dt + ncfg.dt0, ncfg.dt0)
-model_z = np.arange(0, ncfg.height_sp, ncfg.dz)
+    NHL_modelres = da.interp(z = model_z, time = model_ts, assume_sorted = True, kwargs={'fill_value':0})
 
-#NHL transpiration in units of m s-1 * LAD  = kg H2O s-1 m-1stem m-2ground
-da = ds2.NHL_trans_sp_stem * 10**-3 #NHL in units of m s-1 * m-1stem
+    #write NHL output to netcdf
+    NHL_modelres.to_netcdf(working_dir / 'output' / 'nhl_modelres_trans_out.nc')
+    NHL_modelres = NHL_modelres.data.transpose()
 
-NHL_modelres = da.interp(z = model_z, time = model_ts, assume_sorted = True, kwargs={'fill_value':0})
+    return NHL_modelres, LAD
 
-#write NHL output to netcdf
-NHL_modelres.to_netcdf('output/nhl_modelres_trans_out.nc')
-NHL_modelres = NHL_modelres.data.transpose()
\ No newline at end of file
+#NHL transpiration of the configuration in model_config, computed by simulation.default_simulation
+#when first imported by name
+def __getattr__(name):
+    from simulation import default_simulation
+    if name in ('NHL_modelres', 'LAD'):
+        return getattr(default_simulation(), name)
+    raise AttributeError("module 'nhl_transpiration.main' has no attribute '" + name + "'")
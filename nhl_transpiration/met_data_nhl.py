@@ -1,49 +1,112 @@
-from pathlib import Path
 import pandas as pd
 import numpy as np
 
-import model_config as cfg
+from forcing_cache import forcing_cache_key, load_cached_forcing, save_cached_forcing
 
 # Helper functions
 
-def calc_infiltration_rate(precipitation, tmax, dt0):
-    precipitation=precipitation/cfg.dt #dividing the value over half hour to seconds [mm/s]
-    rain=precipitation/cfg.Rho  #[converting to m/s]
+def calc_infiltration_rate(precipitation, tmax, dt0, t_data, dt, Rho):
+    precipitation=precipitation/dt #dividing the value over half hour to seconds [mm/s]
+    rain=precipitation/Rho  #[converting to m/s]
     q_rain=np.interp(np.arange(0,tmax+dt0,dt0), t_data, rain) #interpolating
     q_rain=np.nan_to_num(q_rain) #m/s precipitation rate= infiltration rate
     return q_rain
-def interp_to_model_res(var, tmax, dt0):
+def interp_to_model_res(var, tmax, dt0, t_data):
     return np.interp(np.arange(0, tmax + dt0, dt0), t_data, var)
 
-###########################################################
-#Load and format input data
-###########################################################
+def read_met_data_nhl(cfg, data_path):
+    """
+    Reads the precipitation of the NHL input data and interpolates it to the
+    model resolution
 
-#Input file
-working_dir = Path.cwd()
-data_path = working_dir / 'data' / cfg.input_fname
+    Parameters
+    ----------
+    cfg : RunConfig or module
+        model configuration (start_time, end_time, dt, dt0, tmin, Rho)
+    data_path : Path
+        input csv file
 
-start_time = pd.to_datetime(cfg.start_time)
-end_time = pd.to_datetime(cfg.end_time)
+    Returns
+    -------
+    dict
+        tmax, t_data and q_rain at model resolution
+    """
+    ###########################################################
+    #Load and format input data
+    ###########################################################
 
-#read input data
-df = pd.read_csv(data_path, parse_dates=[0])
+    start_time = pd.to_datetime(cfg.start_time)
+    end_time = pd.to_datetime(cfg.end_time)
 
-# Select data for length of run
-df = df[(df.Timestamp >=start_time) & (df.Timestamp <=end_time)]
-df = df.set_index('Timestamp')
+    #read input data
+    df = pd.read_csv(data_path, parse_dates=[0])
 
-tmax = len(df) * cfg.dt
-t_data = np.arange(cfg.tmin, tmax, cfg.dt)         # data time grids for input data
-t_data=list(t_data)
-nt_data=len(t_data)                      #length of input data
+    # Select data for length of run
+    df = df[(df.Timestamp >=start_time) & (df.Timestamp <=end_time)]
+    df = df.set_index('Timestamp')
 
-#variables to arrays
-precipitation = df['P_F'].values
+    tmax = len(df) * cfg.dt
+    t_data = np.arange(cfg.tmin, tmax, cfg.dt)         # data time grids for input data
+    t_data=list(t_data)
 
-########################################################
-#SETTING PRECIPITATION AS INFILTRATION BOUNDARY CONDITION
-#in case of set by user
-###########################################################
+    #variables to arrays
+    precipitation = df['P_F'].values
 
-q_rain = calc_infiltration_rate(precipitation, tmax, cfg.dt0)
\ No newline at end of file
+    ########################################################
+    #SETTING PRECIPITATION AS INFILTRATION BOUNDARY CONDITION
+    #in case of set by user
+    ###########################################################
+
+    q_rain = calc_infiltration_rate(precipitation, tmax, cfg.dt0, t_data, cfg.dt, cfg.Rho)
+
+    return {'tmax': tmax, 't_data': np.asarray(t_data), 'q_rain': q_rain}
+
+def load_met_data_nhl(cfg, working_dir, forcing=None):
+    """
+    Precipitation of the NHL input data at model resolution, read with
+    read_met_data_nhl or, with cfg.forcing_cache, loaded memory-mapped from the
+    forcing cache (see forcing_cache) when the same input was processed before
+
+    Parameters
+    ----------
+    cfg : RunConfig or module
+        model configuration (input_fname, start_time, end_time, dt, dt0, ...)
+    working_dir : Path
+        directory containing data/input_fname
+
+    forcing : dict
+        arrays returned by read_met_data_nhl for this configuration (e.g. shared by the
+        members of an ensemble), used instead of reading the input file
+
+    Returns
+    -------
+    dict
+        start_time, end_time, tmax, t_data and q_rain at model resolution
+    """
+    #Input file
+    data_path = working_dir / 'data' / cfg.input_fname
+
+    met = dict(forcing) if forcing is not None else None
+    if met is None and cfg.forcing_cache:
+        cache_dir = working_dir / cfg.forcing_cache_dir
+        key = forcing_cache_key('nhl', data_path, cfg)
+        met = load_cached_forcing(cache_dir, key)
+    if met is None:
+        met = read_met_data_nhl(cfg, data_path)
+        if cfg.forcing_cache:
+            save_cached_forcing(cache_dir, key, met)
+
+    met['tmax'] = np.asarray(met['tmax']).item()
+    met['t_data'] = list(met['t_data'])
+    met['start_time'] = pd.to_datetime(cfg.start_time)
+    met['end_time'] = pd.to_datetime(cfg.end_time)
+
+    return met
+
+#Forcing of the configuration in model_config, loaded by simulation.default_simulation
+#when first imported by name
+def __getattr__(name):
+    from simulation import default_simulation
+    if name in ('start_time', 'end_time', 'tmax', 't_data', 'q_rain'):
+        return getattr(default_simulation(), name)
+    raise AttributeError("module 'nhl_transpiration.met_data_nhl' has no attribute '" + name + "'")
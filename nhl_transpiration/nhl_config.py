@@ -22,6 +22,35 @@ x = 1  #Ratio of horizontal to vertical projections of leaves (leaf angle distri
 wp_s50 = -9.1 * 10**5 #value for oak from Mirfenderesgi
 c3 = 12.3 #value for oak from Mirfenderesgi
 
+#wind profile
+#'solve' : profile solved iteratively at every time step (solve_Uz), the results of the original NHL code
+#'scaled': profile for a wind speed of 1 m/s at the top of the canopy, solved once and scaled by
+#          the measured wind speed of each time step (solve_Uz_normalized), much faster; the profile
+#          is converged to 1e-8 instead of the 1e-4 m/s of solve_Uz, which changes the
+#          transpiration by about 1e-6 relative
+wind_profile = 'solve'
+#solver of the tridiagonal systems of the wind profile iterations
+#'thomas': Thomas algorithm (forward and back sweeps), the results of the original NHL code
+#'banded': LAPACK banded LU factorization of all the systems of an iteration at once, faster,
+#          the transpiration differs from 'thomas' by rounding (about 1e-15 relative)
+tridiagonal_solver = 'thomas'
+#iterations of the leaf photosynthesis and stomatal conductance (Ci within 0.01 umol mol-1)
+#'fixed_point': every height iterated until all the heights of its time step have converged
+#'masked'     : fixed-point iterations, each (time, z) element stopping as soon as it has converged
+#'secant'     : secant iterations on Ci, each element stopping as soon as it has converged (fewest iterations)
+leaf_solver = 'fixed_point'
+
+#NHL engine
+#'batch' : all the met records at once on the (time, z) grid (calc_NHL_timesteps_batch)
+#'serial': one calc_NHL call per met record (calc_NHL_timesteps)
+engine = 'batch'
+#worker processes of the NHL engine, the met records are split in time chunks of chunk_size
+#records run in parallel when processes > 1 (chunk_size = None: four chunks per process)
+#the workers are spawned and import the main script again: a script running the model with
+#processes > 1 must start the run under if __name__ == '__main__': (as main.py does)
+processes = 1
+chunk_size = None
+
 LAD_norm = 'LAD_data.csv' #LAD data
 met_data = input_fname
 met_dt = dt
@@ -0,0 +1,243 @@
+import numpy as np
+
+#Numba is optional: without it HAVE_NUMBA is False and model_functions.Picard
+#uses the NumPy implementation of the time step (picard_step)
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        def decorator(f):
+            return f
+        return decorator
+
+###############################################################################
+#COMPILED PICARD TIME STEP
+#The whole modified Picard iteration of one time step (C, K for soil, roots and
+#stem, root water uptake, residual of MPFD, banded matrix A, linear solve and
+#convergence check) in a single kernel, so the ~300 node arrays are not passed
+#through dozens of small NumPy calls per iteration
+###############################################################################
+
+@njit(cache=True)
+def _band_solve(ab, b, kl, ku, x):
+    #Gaussian elimination with partial pivoting of the banded system A*x = b, with A in the
+    #LAPACK band storage of gbtrf: A[i, j] = ab[kl+ku+i-j, j], the first kl rows receiving the
+    #fill-in of the row interchanges; ab and b are overwritten
+    n = len(b)
+    d = kl + ku  #row of the diagonal
+    for k in range(n):
+        imax = min(k + kl, n - 1)
+        jmax = min(k + kl + ku, n - 1)
+        p = k
+        amax = abs(ab[d, k])
+        for i in range(k + 1, imax + 1):
+            if abs(ab[d + i - k, k]) > amax:
+                amax = abs(ab[d + i - k, k])
+                p = i
+        if p != k:
+            for j in range(k, jmax + 1):
+                tmp = ab[d + k - j, j]
+                ab[d + k - j, j] = ab[d + p - j, j]
+                ab[d + p - j, j] = tmp
+            tmp = b[k]
+            b[k] = b[p]
+            b[p] = tmp
+        for i in range(k + 1, imax + 1):
+            f = ab[d + i - k, k] / ab[d, k]
+            if f != 0.0:
+                for j in range(k + 1, jmax + 1):
+                    ab[d + i - j, j] -= f * ab[d + k - j, j]
+                b[i] -= f * b[k]
+    for i in range(n - 1, -1, -1):
+        s = b[i]
+        for j in range(i + 1, min(i + kl + ku, n - 1) + 1):
+            s -= ab[d + i - j, j] * x[j]
+        x[i] = s / ab[d, i]
+
+#half bandwidth of A with the soil and root nodes interleaved (linear_solver.interleaved_band_indices)
+BAND = 2
+
+@njit(cache=True)
+def _band_set(ab, position, i, j, value):
+    #A[i, j] = value in the band storage of A with the nodes at their interleaved positions;
+    #the entries outside the band (between the top soil node and the bottom root node) are zero
+    offset = position[i] - position[j]
+    if abs(offset) <= BAND:
+        ab[2*BAND + offset, position[j]] = value
+
+@njit(cache=True)
+def _band_add(ab, position, i, j, value):
+    #A[i, j] += value, see _band_set
+    offset = position[i] - position[j]
+    if abs(offset) <= BAND:
+        ab[2*BAND + offset, position[j]] += value
+
+@njit(cache=True)
+def _xylem(h, ap, bp, k_ind, Aind, p, sat_xylem, Phi_0, C, K, cavitation):
+    #cavitation curve, K and C of the root/stem xylem (see model_functions.xylem_hydraulics)
+    for i in range(len(h)):
+        if h[i] > 0:
+            cavitation[i] = 1.0
+        else:
+            cavitation[i] = 1 - 1 / (1 + np.exp(ap * (h[i] - bp)))
+        K[i] = k_ind * Aind * cavitation[i]
+        C[i] = ((Aind * p * sat_xylem) / Phi_0) * ((Phi_0 - h[i]) / Phi_0) ** (-(p + 1))
+
+@njit(cache=True)
+def picard_step_kernel(hn, dt, q_rain_t, Pt, Head_bottom_t, max_iter,
+                       nz_s, nz_r, nz_clay, dz, g, Rho, stop_tol, UpperBC, BottomBC,
+                       theta_S, theta_R, alpha, n, m, Ksat,
+                       ap, bp, Ksax, Aind_r, kmax, Aind_x, p, sat_xylem, Phi_0,
+                       Kr_max, r_dist, theta_1, theta_2, theta_S_top,
+                       cnp1m, knp1m, theta, Se, stress_kr, stress_kx, stress_roots, Kr, S_S, q_inf,
+                       hnp1mp1, ab, R, position):
+    """
+    One time step of model_functions.picard_step
+
+    hnp1mp1 receives the potentials at the end of the step, the other work arrays
+    the variables of the last iteration and q_inf[0] the infiltration rate.
+    theta_1 and theta_2 are the Feddes parameters of the soil node of each root node.
+    A is assembled in the band storage ab (3*BAND+1, nz) with node i at column
+    position[i], the order of linear_solver.interleaved_band_indices in which each soil
+    node exchanging water with the roots is next to its root node, so that A has half
+    bandwidth BAND instead of nr.
+
+    Returns
+    -------
+    number of Picard iterations, converged flag, max |deltam| of the last iteration
+    """
+    nz = len(hn)
+    nr = nz_r - nz_s
+    s0 = nz_s - nr  #first soil node exchanging water with the roots
+    hm = hn.copy()
+    kbarplus = np.zeros(nz)
+    kbarminus = np.zeros(nz)
+    deltam = np.zeros(nz)
+    b = np.zeros(nz)
+    x = np.zeros(nz)
+    dmax = np.inf
+
+    it = 0
+    while it < max_iter:
+        it += 1
+
+        #VanGenuchten relationships applied for the soil nodes
+        for i in range(nz_s):
+            psi = hm[i] / (g * Rho)
+            dtheta = theta_S[i] - theta_R[i]
+            if psi < 0:
+                theta[i] = dtheta / ((1 + (alpha[i] * abs(psi)) ** n[i]) ** m[i]) + theta_R[i]
+                Se[i] = (theta[i] - theta_R[i]) / dtheta
+                #Se**(1/m) and (1-Se**(1/m))**m are shared by K and C
+                s = Se[i] ** (1 / m[i])
+                sm = (1 - s) ** m[i]
+                K = Ksat[i] * Se[i] ** (1 / 2) * (1 - sm) ** 2
+                C = ((alpha[i] * m[i] * dtheta) / (1 - m[i])) * s * sm
+            else:
+                theta[i] = theta_S[i]
+                Se[i] = 0.0
+                K = Ksat[i]
+                C = 0.0
+            knp1m[i] = K / (Rho * g)
+            cnp1m[i] = C / (Rho * g)
+
+        #C, K for the root and stem nodes
+        _xylem(hm[nz_s:nz_r], ap, bp, Ksax, Aind_r, p, sat_xylem, Phi_0, cnp1m[nz_s:nz_r], knp1m[nz_s:nz_r], stress_kr)
+        _xylem(hm[nz_r:], ap, bp, kmax, Aind_x, p, sat_xylem, Phi_0, cnp1m[nz_r:], knp1m[nz_r:], stress_kx)
+
+        #interlayer hydraulic conductivity - root/stem and clay/sand transitions
+        knp1m[nz_r] = (knp1m[nz_r - 1] + knp1m[nz_r]) / 2
+        knp1m[nz_clay] = (knp1m[nz_clay] + knp1m[nz_clay + 1]) / 2
+
+        #equations S.16 and S.17
+        for i in range(nz - 1):
+            kbarplus[i] = (1 / 2) * (knp1m[i] + knp1m[i + 1])
+        kbarplus[nz - 1] = 0
+        kbarplus[nz_s - 1] = 0
+        kbarminus[0] = 0
+        for i in range(1, nz):
+            kbarminus[i] = kbarplus[i - 1]
+        kbarminus[nz_s] = 0
+
+        #FEDDES root water uptake stress function and effective root radial conductivity
+        for e in range(nr):
+            th = theta[s0 + e]
+            if th <= theta_1[e]:
+                stress_roots[e] = 0.0
+            elif th <= theta_2[e]:
+                stress_roots[e] = (th - theta_1[e]) / (theta_2[e] - theta_1[e])
+            else:
+                stress_roots[e] = 1.0
+            Kr[e] = stress_roots[e] * Kr_max * r_dist[e]
+
+        #Infiltration - only infiltrates if top soil layer is not saturated, equation S.53
+        if UpperBC == 0:
+            q_inf[0] = min(q_rain_t, (theta_S_top - theta[nz_s - 1]) * (dz / dt))
+
+        #sink/source terms, equation S.22
+        for e in range(nr):
+            flow = Kr[e] * (hm[s0 + e] - hm[nz_s + e])
+            S_S[s0 + e] = -flow
+            S_S[nz_s + e] = flow
+        for i in range(nz_r, nz):
+            S_S[i] = -Pt[i - nz_r]
+
+        #residual of MPFD and the matrix A
+        ab[:, :] = 0.0
+        for i in range(nz):
+            flux = 0.0
+            if i < nz - 1:
+                flux += kbarplus[i] * (hm[i + 1] - hm[i])
+                _band_set(ab, position, i, i + 1, -(1 / (dz ** 2)) * kbarplus[i])
+            if i > 0:
+                flux -= kbarminus[i] * (hm[i] - hm[i - 1])
+                _band_set(ab, position, i, i - 1, -(1 / (dz ** 2)) * kbarminus[i])
+            R[i] = ((1 / (dz ** 2)) * flux + (1 / dz) * Rho * g * (kbarplus[i] - kbarminus[i])
+                    - (1 / dt) * (hm[i] - hn[i]) * cnp1m[i] + S_S[i])
+            _band_set(ab, position, i, i, (1 / dt) * cnp1m[i] + (1 / (dz ** 2)) * (kbarplus[i] + kbarminus[i]))
+        for e in range(nr):
+            _band_add(ab, position, s0 + e, s0 + e, -Kr[e])
+            _band_add(ab, position, nz_s + e, nz_s + e, -Kr[e])
+            _band_add(ab, position, s0 + e, nz_s + e, Kr[e])
+            _band_add(ab, position, nz_s + e, s0 + e, Kr[e])
+
+        #boundary conditions
+        if BottomBC == 0:
+            _band_set(ab, position, 1, 0, 0.0)
+            _band_set(ab, position, 0, 1, 0.0)
+            _band_set(ab, position, 0, 0, 1.0)
+            R[0] = 0
+        if UpperBC == 0:
+            R[nz_s - 1] += q_inf[0] / dz
+        if BottomBC == 2:
+            R[0] -= (kbarplus[0] * Rho * g) / dz
+
+        #Compute deltam for iteration level m+1, in the interleaved order
+        for i in range(nz):
+            b[position[i]] = R[i]
+        _band_solve(ab, b, BAND, BAND, x)
+        for i in range(nz):
+            deltam[i] = x[position[i]]
+
+        dmax = 0.0
+        finite = True
+        for i in range(nz):
+            if not np.isfinite(deltam[i]):
+                finite = False
+            dmax = max(dmax, abs(deltam[i]))
+            hnp1mp1[i] = hm[i] + deltam[i]
+        if not finite:
+            break
+
+        if dmax < stop_tol:  #equation S.42
+            if BottomBC == 0:
+                hnp1mp1[0] = Head_bottom_t
+            return it, True, dmax
+
+        hm[:] = hnp1mp1
+
+    hnp1mp1[:] = hn
+    return it, False, dmax
@@ -0,0 +1,207 @@
+import queue
+import threading
+
+import numpy as np
+
+###############################################################################
+#STREAMING OUTPUT WRITER
+###############################################################################
+#With stream_output = True in model_config, Picard hands every saved snapshot (save_freq)
+#of the output variables to an OutputStream. A background thread appends the
+#snapshots to output/model_out.nc (NetCDF4/HDF5, unlimited time dimension, chunked
+#along time, zlib compressed) while Picard keeps integrating, and save_output no longer writes
+#these variables to csv. Picard then only keeps the snapshot being saved in memory, and
+#format_model_output computes the water balance from the sums of STREAM_SUMMARY, written
+#with every snapshot. Read the file with xarray.open_dataset.
+#With checkpoints, Picard flushes the stream to disk before writing each checkpoint, so
+#the file of a killed run holds all the snapshots of its last checkpoint.
+
+STREAM_FILE = 'model_out.nc'
+
+#variable : (node dimension, units, description)
+STREAM_VARIABLES = {'H': ('z', 'MPa', 'water potential'),
+                    'K': ('z', 'm s-1', 'hydraulic conductivity'),
+                    'Capac': ('z', 'Pa-1', 'capacitance'),
+                    'S_kx': ('z_stem', '-', 'xylem cavitation reduction of the conductivity'),
+                    'S_kr': ('z_root', '-', 'root cavitation reduction of the conductivity'),
+                    'S_sink': ('z_root', '-', 'soil water stress of root water uptake'),
+                    'Kr_sink': ('z_root', 'm s-1 Pa-1', 'soil-to-root radial conductance'),
+                    'EVsink_ts': ('z_root', 's-1', 'root water uptake'),
+                    'THETA': ('z_soil', 'm3 m-3', 'soil water content'),
+                    'trans_2d': ('z_upper', 's-1', 'transpiration'),
+                    'infiltration': (None, 'm s-1', 'infiltration rate')}
+
+#sums of every snapshot used by format_model_output, written in double precision whatever
+#output_variables and output_float32: variable : (units, description)
+STREAM_SUMMARY = {'theta_storage': ('m', 'soil water storage, sum of THETA*dz'),
+                  'EVsink_total': ('m s-1', 'root water uptake, sum of -EVsink_ts*dz'),
+                  'trans_sum': ('s-1', 'sum of trans_2d over the nodes'),
+                  'trans': ('mm s-1', 'transpiration, sum of trans_2d*dz*1000')}
+
+TIME_CHUNK = 48  #snapshots per chunk (one day of half-hourly outputs)
+
+_SYNC = object()  #queued by flush(): the writer thread syncs the file to disk
+
+class OutputStream:
+    """
+    Appends the saved output snapshots to a NetCDF file from a background thread
+
+    Parameters
+    ----------
+    path : Path
+        NetCDF file, overwritten if it exists
+    coords : dict
+        node dimension name : heights [m] (z, z_stem, z_root, z_soil, z_upper)
+    start_time : Timestamp
+        time of t = 0
+    variables : list
+        names of STREAM_VARIABLES to write (all if not given)
+    dtype : str
+        NetCDF type of the variables ('f8' or 'f4')
+    max_pending : int
+        snapshots waiting to be written before write() blocks, bounds the memory of the queue
+    start : int
+        index of the next snapshot in an existing file written by the same run (restart
+        from a checkpoint), the file is created if not given
+    """
+    def __init__(self, path, coords, start_time, variables=None, dtype='f8', max_pending=64, start=None):
+        try:
+            import netCDF4
+        except ImportError:
+            raise ImportError("stream_output requires the netCDF4 package")
+
+        self.path = path
+        self.n = 0 if start is None else start
+        self.error = None
+        self.variables = [name for name in STREAM_VARIABLES if variables is None or name in variables]
+        if start is None:
+            self.ds = netCDF4.Dataset(path, 'w', format='NETCDF4')
+            self._create(coords, start_time, dtype)
+        else:
+            self.ds = netCDF4.Dataset(path, 'a')
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _create(self, coords, start_time, dtype):
+        #dimensions, coordinates and variables of a new file
+        self.ds.createDimension('time', None)
+        time = self.ds.createVariable('time', 'f8', ('time',))
+        time.units = 'seconds since ' + str(start_time)
+        for dim, values in coords.items():
+            self.ds.createDimension(dim, len(values))
+            var = self.ds.createVariable(dim, 'f8', (dim,))
+            var.units = 'm'
+            var[:] = values
+
+        for name in self.variables:
+            dim, units, description = STREAM_VARIABLES[name]
+            dims = ('time',) if dim is None else ('time', dim)
+            chunks = [TIME_CHUNK] if dim is None else [TIME_CHUNK, len(coords[dim])]
+            var = self.ds.createVariable(name, dtype, dims, chunksizes=chunks, zlib=True, complevel=4)
+            var.units = units
+            var.long_name = description
+        for name, (units, description) in STREAM_SUMMARY.items():
+            var = self.ds.createVariable(name, 'f8', ('time',), chunksizes=[TIME_CHUNK], zlib=True, complevel=4)
+            var.units = units
+            var.long_name = description
+
+    def _run(self):
+        #writer thread: appends the queued snapshots until it receives None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                if self.error is not None:
+                    pass
+                elif item is _SYNC:
+                    self.ds.sync()
+                else:
+                    i, t, values = item
+                    self.ds['time'][i] = t
+                    for name, value in values.items():
+                        self.ds[name][i] = value
+            except Exception as e:  #raised in the solver thread by the next write(), flush() or close()
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, t, values):
+        """
+        Queues one snapshot
+
+        Parameters
+        ----------
+        t : [s]
+            time of the snapshot
+        values : dict
+            variable of STREAM_VARIABLES and STREAM_SUMMARY : values at the nodes (float for
+            infiltration and the sums), the variables not written by this stream are ignored;
+            the arrays are copied, so buffers can be reused after the call
+        """
+        if self.error is not None:
+            raise self.error
+        names = self.variables + list(STREAM_SUMMARY)
+        self.queue.put((self.n, t, {name: np.array(values[name], dtype=float) for name in names}))
+        self.n = self.n + 1
+
+    def flush(self):
+        """Writes the pending snapshots and syncs the file to disk, waiting until it is done"""
+        self.queue.put(_SYNC)
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Writes the pending snapshots and closes the file"""
+        self.queue.put(None)
+        self.thread.join()
+        self.ds.close()
+        if self.error is not None:
+            raise self.error
+
+def open_output_stream(sim, start=None):
+    """
+    OutputStream to working_dir/output/model_out.nc with the node heights of sim,
+    writing the variables selected by cfg.output_variables in the precision of
+    cfg.output_float32
+
+    Parameters
+    ----------
+    sim : simulation.Simulation
+    start : int
+        index of the next snapshot when appending to the file of an interrupted run
+
+    Returns
+    -------
+    OutputStream
+    """
+    (sim.working_dir / 'output').mkdir(exist_ok=True)
+    coords = {'z': sim.z,
+              'z_stem': sim.z[sim.nz_r:sim.nz],
+              'z_root': sim.z[sim.nz_s:sim.nz_r],
+              'z_soil': sim.z[0:sim.nz_s],
+              'z_upper': sim.z_upper}
+    from model_functions import output_selection
+    return OutputStream(sim.working_dir / 'output' / STREAM_FILE, coords, sim.start_time,
+                        output_selection(sim.cfg), 'f4' if sim.cfg.output_float32 else 'f8', start=start)
+
+def read_stream_summary(sim):
+    """
+    Sums of STREAM_SUMMARY of every snapshot in working_dir/output/model_out.nc
+
+    Parameters
+    ----------
+    sim : simulation.Simulation
+
+    Returns
+    -------
+    dict
+        variable of STREAM_SUMMARY : array (snapshots)
+    """
+    import netCDF4
+    with netCDF4.Dataset(sim.working_dir / 'output' / STREAM_FILE) as ds:
+        ds.set_auto_mask(False)
+        return {name: ds[name][:] for name in STREAM_SUMMARY}
@@ -0,0 +1,261 @@
+from functools import cached_property
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+
+import numpy as np
+
+import model_config
+
+###############################################################################
+#RUN CONFIGURATION AND SIMULATION
+###############################################################################
+#A Simulation holds the inputs of one model run (discretization, forcing and
+#transpiration inputs), built from its RunConfig the first time they are needed.
+#Nothing is read or computed when the modules are imported, so several
+#configurations can be run one after the other in the same process:
+#
+#    sim = Simulation(dz=0.05, end_time="2007-01-03 00:00:00")
+#    outputs = sim.run()
+#    output_vars, df_waterbal, df_EP = sim.format_output(outputs)
+
+class RunConfig:
+    """
+    Parameters of one model run: the values of model_config, with overrides
+
+    Parameters
+    ----------
+    base : module or RunConfig
+        configuration the values are copied from (model_config by default)
+    nhl : dict
+        overrides of the NHL transpiration parameters (nhl_transpiration.nhl_config)
+    **overrides :
+        model_config values to replace, e.g. RunConfig(dz=0.05, dt0=10)
+
+    Derived parameters (e.g. m_1 = 1-(1/n_1), Kr divided by Rho*g) are copied as
+    they are in base, so they have to be overridden together with the parameters
+    they are computed from.
+    """
+    def __init__(self, base=model_config, nhl=None, **overrides):
+        values = {key: value for key, value in vars(base).items()
+                  if not key.startswith('_') and not isinstance(value, ModuleType)}
+        unknown = set(overrides) - set(values)
+        if unknown:
+            raise AttributeError("Unknown model_config parameters: " + ", ".join(sorted(unknown)))
+        values.update(overrides)
+        values['nhl'] = {**values.get('nhl', {}), **(nhl or {})}
+        self.__dict__.update(values)
+
+    def replace(self, nhl=None, **overrides):
+        """Copy of the configuration with some values replaced"""
+        return RunConfig(self, nhl=nhl, **overrides)
+
+    def nhl_config(self):
+        """
+        Parameters of the NHL transpiration scheme: the defaults of
+        nhl_transpiration.nhl_config, with the values shared with model_config
+        taken from this configuration
+
+        Returns
+        -------
+        types.SimpleNamespace
+        """
+        import nhl_transpiration.nhl_config as ncfg
+
+        values = {key: value for key, value in vars(ncfg).items()
+                  if not key.startswith('_') and not isinstance(value, ModuleType)}
+        values.update(dt0=self.dt0, dz=self.dz, start_time=self.start_time, end_time=self.end_time,
+                      input_fname=self.input_fname, dt=self.dt, Hspec=self.Hspec, LAI=self.LAI,
+                      height_sp=self.Hspec, total_LAI_sp=self.LAI, met_data=self.input_fname, met_dt=self.dt)
+        values.update(self.nhl)
+        return SimpleNamespace(**values)
+
+class Simulation:
+    """
+    Inputs and run of the model for one configuration
+
+    The inputs are attributes with the names of the former module level variables
+    (nz_s, z_upper, soil_params, q_rain, NET_2d, LAD, NHL_modelres, t_num, ...).
+    They are built in groups on first access and then kept:
+        grid         : spatial discretization and soil parameters (model_setup)
+        met          : forcing at model resolution and the time grid (met_data, met_data_nhl)
+        transpiration: LAD and the stomata reductions (canopy, transpiration) or
+                       the NHL transpiration (nhl_transpiration.main)
+
+    Parameters
+    ----------
+    config : RunConfig
+        configuration of the run (model_config if not given)
+    working_dir : str or Path
+        directory with the data/ inputs and the output/ files (current directory if not given)
+    forcing : dict
+        processed forcing arrays (met_data.read_met_data or met_data_nhl.read_met_data_nhl),
+        used instead of reading the input file
+    transpiration : dict
+        transpiration inputs of the same configuration (the transpiration group of
+        another Simulation), used instead of computing them (e.g. running the NHL model)
+    **overrides :
+        model_config values to replace in config
+    """
+
+    _GRID = ('z_soil', 'nz_s', 'z_root', 'nz_r', 'z_Above', 'nz_Above', 'z_upper', 'z', 'nz', 'nz_sand', 'nz_clay',
+             'soil_params')
+    _MET = ('start_time', 'end_time', 'tmax', 't_data', 'q_rain', 'Ta', 'SW_in', 'VPD', 'NET', 'NET_2d', 'delta_2d',
+            'VPD_2d', 'Ta_2d', 'SW_in_2d', 't_num', 'nt')
+    _TRANSPIRATION = ('LAD', 'f_Ta', 'f_d', 'f_s', 'f_Ta_2d', 'f_d_2d', 'f_s_2d', 'NHL_modelres')
+
+    #model_config values each group of inputs is built from (see with_config)
+    _GEOMETRY = ('dz', 'Soil_depth', 'Root_depth', 'Hspec', 'sand_d', 'clay_d')
+    _INPUTS = {'grid': _GEOMETRY + ('theta_S1', 'theta_R1', 'alpha_1', 'n_1', 'm_1', 'Ksat_1',
+                                    'theta_S2', 'theta_R2', 'alpha_2', 'n_2', 'm_2', 'Ksat_2'),
+               'met': _GEOMETRY + ('transpiration_scheme', 'input_fname', 'start_time', 'end_time', 'dt', 'dt0', 'tmin',
+                                   'Rho', 'forcing_cache', 'forcing_cache_dir'),
+               'transpiration': _GEOMETRY + ('transpiration_scheme', 'input_fname', 'start_time', 'end_time', 'dt',
+                                             'dt0', 'tmin', 'Rho', 'kt', 'Topt', 'kd', 'kr', 'z_m', 'L_m', 'LAI', 'nhl')}
+    _INPUTS['ncfg'] = _INPUTS['transpiration']
+
+    def __init__(self, config=None, working_dir=None, forcing=None, transpiration=None, **overrides):
+        config = config if config is not None else RunConfig()
+        self.cfg = config.replace(**overrides) if overrides else config
+        self.working_dir = Path(working_dir) if working_dir is not None else Path.cwd()
+        self.forcing = forcing
+        if transpiration is not None:
+            self.__dict__['transpiration'] = transpiration
+
+    def with_config(self, config):
+        """
+        Simulation of another configuration, sharing the inputs already built by
+        this one whose model_config values are the same in both (e.g. the grid,
+        forcing and transpiration inputs of the runs of a calibration, which only
+        change the hydraulic parameters)
+
+        Parameters
+        ----------
+        config : RunConfig
+
+        Returns
+        -------
+        Simulation
+        """
+        sim = Simulation(config, self.working_dir, forcing=self.forcing)
+        for group, keys in self._INPUTS.items():
+            if group in self.__dict__ and all(repr(getattr(config, key)) == repr(getattr(self.cfg, key)) for key in keys):
+                sim.__dict__[group] = self.__dict__[group]
+        return sim
+
+    def __getattr__(self, name):
+        #called for inputs not built yet: builds their group and keeps the value as an attribute
+        for group, names in (('grid', self._GRID), ('met', self._MET), ('transpiration', self._TRANSPIRATION)):
+            if name in names and name in getattr(self, group):
+                value = getattr(self, group)[name]
+                setattr(self, name, value)
+                return value
+        raise AttributeError("'Simulation' object has no attribute '" + name + "'")
+
+    @cached_property
+    def ncfg(self):
+        return self.cfg.nhl_config()
+
+    @cached_property
+    def grid(self):
+        from model_setup import spatial_discretization, soil_node_parameters
+        cfg = self.cfg
+
+        grid = dict(zip(self._GRID, spatial_discretization(cfg.dz, cfg.Soil_depth, cfg.Root_depth, cfg.Hspec,
+                                                           cfg.sand_d, cfg.clay_d)))
+        grid['soil_params'] = soil_node_parameters(grid['z_soil'], cfg.clay_d, cfg.theta_S1, cfg.theta_R1, cfg.alpha_1,
+                                                   cfg.n_1, cfg.m_1, cfg.Ksat_1, cfg.theta_S2, cfg.theta_R2, cfg.alpha_2,
+                                                   cfg.n_2, cfg.m_2, cfg.Ksat_2)
+        return grid
+
+    @cached_property
+    def met(self):
+        cfg = self.cfg
+
+        if cfg.transpiration_scheme == 0: #0: PM transpiration scheme
+            from met_data import load_met_data
+            met = load_met_data(cfg, self.working_dir, len(self.z_upper), self.forcing)
+        else:                             #1: NHL transpiration scheme
+            from nhl_transpiration.met_data_nhl import load_met_data_nhl
+            met = load_met_data_nhl(cfg, self.working_dir, self.forcing)
+
+        #temporal discretization according to MODEL resolution
+        met['t_num'] = np.arange(0, met['tmax']+cfg.dt0, cfg.dt0)  #[s]
+        met['nt'] = len(met['t_num'])  #number of time steps
+        return met
+
+    @cached_property
+    def transpiration(self):
+        cfg = self.cfg
+
+        if cfg.transpiration_scheme == 0: #0: PM transpiration scheme
+            from canopy import calc_LAD
+            from transpiration import stomata_reductions
+            inputs = stomata_reductions(self.Ta, self.VPD, self.SW_in, cfg.kt, cfg.Topt, cfg.kd, cfg.kr, len(self.z_upper))
+            inputs['LAD'] = calc_LAD(self.z_Above, cfg.dz, cfg.z_m, cfg.Hspec, cfg.L_m)
+        else:                             #1: NHL transpiration scheme
+            from nhl_transpiration.main import run_nhl
+            NHL_modelres, LAD = run_nhl(self.ncfg, self.working_dir)
+            inputs = {'NHL_modelres': NHL_modelres, 'LAD': LAD}
+        return inputs
+
+    def initial_conditions(self):
+        """Initial water potentials and soil bottom potentials [Pa], see initial_conditions.initial_conditions"""
+        from initial_conditions import initial_conditions
+        return initial_conditions(self)
+
+    def run(self, telemetry=None, monitor=None):
+        """
+        Runs the model from the initial conditions
+
+        Parameters
+        ----------
+        telemetry : dict
+            record from model_functions.solver_telemetry, filled with the solver telemetry (optional)
+        monitor : function
+            called after every saved snapshot, see model_functions.Picard (optional)
+
+        Returns
+        -------
+        tuple
+            outputs of model_functions.Picard
+        """
+        from model_functions import Picard
+        H_initial, Head_bottom_H = self.initial_conditions()
+        return Picard(H_initial, Head_bottom_H, telemetry, self, monitor)
+
+    def format_output(self, outputs):
+        """Water balance and formatted outputs of run, see model_functions.format_model_output"""
+        from model_functions import format_model_output
+        return format_model_output(*outputs, self.cfg.save_freq, self.cfg.dz, self)
+
+    def save_output(self, output_vars, df_waterbal, df_EP):
+        """Writes the formatted outputs to working_dir/output"""
+        from model_functions import save_output
+        save_output(output_vars, df_waterbal, df_EP, self)
+
+def read_forcing(config, working_dir=None):
+    """
+    Processed forcing of a configuration (met_data.read_met_data or
+    met_data_nhl.read_met_data_nhl), to be shared by several simulations
+    through their forcing argument
+    """
+    working_dir = Path(working_dir) if working_dir is not None else Path.cwd()
+    if config.transpiration_scheme == 0: #0: PM transpiration scheme
+        from met_data import read_met_data
+        return read_met_data(config, working_dir / 'data' / config.input_fname)
+    else:                                #1: NHL transpiration scheme
+        from nhl_transpiration.met_data_nhl import read_met_data_nhl
+        return read_met_data_nhl(config, working_dir / 'data' / config.input_fname)
+
+_default_simulation = None
+
+def default_simulation():
+    """
+    Simulation of the configuration in model_config, shared by the functions called
+    without a Simulation and by the module level names kept for compatibility
+    (e.g. from model_setup import nz). It is created on first use.
+    """
+    global _default_simulation
+    if _default_simulation is None:
+        _default_simulation = Simulation()
+    return _default_simulation
@@ -0,0 +1,50 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_DIR))
+
+@pytest.fixture
+def working_dir(tmp_path):
+    """Working directory with the data/ inputs of the repository, outputs written to tmp_path/output"""
+    (tmp_path / 'data').symlink_to(REPO_DIR / 'data')
+    return tmp_path
+
+def nhl_met_records(n=48, start='2007-07-01 00:00:00'):
+    """
+    Half-hourly met records of the NHL input file (Timestamp, WS_F, USTAR, PPFD_IN, CO2_F,
+    RH, TA_F, PA_F) for a clear summer day: the NHL input data are not in the repository
+    """
+    timestamp = pd.date_range(start, periods=n, freq='30min')
+    hour = timestamp.hour + timestamp.minute/60
+    day = np.clip(np.sin(np.pi*(hour - 6)/14), 0, None)  #daylight between 6h and 20h
+    return pd.DataFrame({'Timestamp': timestamp,
+                         'WS_F': 1.0 + 2.5*day,
+                         'USTAR': 0.1 + 0.5*day,
+                         'PPFD_IN': 1800*day,
+                         'CO2_F': 390 - 15*day,
+                         'RH': 85 - 40*day,
+                         'TA_F': 18 + 12*day,
+                         'PA_F': 100.5 + 0*day})
+
+def nhl_lad_profile():
+    """Normalized leaf area density at the relative heights z_h, peaking in the upper crown"""
+    z_h = np.linspace(0, 1, 21)
+    return pd.Series(z_h**6*(1 - z_h)**1.5 + 1e-6), pd.Series(z_h)
+
+@pytest.fixture
+def nhl_args():
+    """
+    Positional parameters of calc_NHL_timesteps and calc_NHL_timesteps_batch for one
+    day of met records and the parameters of nhl_config
+    """
+    import nhl_transpiration.nhl_config as ncfg
+
+    LAD_norm, z_h = nhl_lad_profile()
+    return (ncfg.dz, ncfg.height_sp, ncfg.Cd, nhl_met_records(), ncfg.Vcmax25, ncfg.alpha_gs, ncfg.alpha_p,
+            ncfg.total_LAI_sp, ncfg.plot_area, ncfg.total_crown_area_sp, ncfg.mean_crown_area_sp, LAD_norm, z_h,
+            ncfg.latitude, ncfg.longitude)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from simulation import RunConfig, Simulation
+
+class Interrupted(Exception):
+    pass
+
+def test_restart_reproduces_uninterrupted_run(working_dir):
+    config = RunConfig(end_time='2007-01-01 03:00:00', print_run_progress=False, checkpoint=True, checkpoint_freq=3600)
+    reference = Simulation(config, working_dir).run()
+
+    #interrupted between the checkpoints of 1 h and 2 h
+    def interrupt(t, sav, saved):
+        if t == 5400:
+            raise Interrupted
+    with pytest.raises(Interrupted):
+        Simulation(config, working_dir).run(monitor=interrupt)
+
+    #resumes from the checkpoint of 1 h
+    times = []
+    outputs = Simulation(config.replace(restart=True), working_dir).run(monitor=lambda t, sav, saved: times.append(t))
+    assert times[0] == 5400
+    assert len(outputs) == len(reference)
+    for output, expected in zip(outputs, reference):
+        np.testing.assert_array_equal(output, expected)
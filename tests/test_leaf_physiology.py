@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from nhl_transpiration.NHL_functions import calc_NHL_timesteps_batch
+
+@pytest.mark.parametrize('method', ['masked', 'secant'])
+def test_leaf_solvers_agree_with_fixed_point(nhl_args, method):
+    #the methods iterate different maps, which agree at convergence (Ci within 0.01 umol mol-1)
+    reference, _, _ = calc_NHL_timesteps_batch(*nhl_args, leaf_solver='fixed_point')
+    ds, _, _ = calc_NHL_timesteps_batch(*nhl_args, leaf_solver=method)
+
+    assert float(reference.A.max()) > 1  #daytime assimilation
+    for name in ('A', 'gs', 'NHL_trans_sp_stem'):
+        np.testing.assert_allclose(ds[name].values, reference[name].values, rtol=1e-3,
+                                   atol=1e-6*np.abs(reference[name].values).max())
+
+def test_secant_needs_fewer_iterations(nhl_args):
+    fixed_point, _, _ = calc_NHL_timesteps_batch(*nhl_args, leaf_solver='fixed_point')
+    secant, _, _ = calc_NHL_timesteps_batch(*nhl_args, leaf_solver='secant')
+    assert secant.leaf_iterations.max() < fixed_point.leaf_iterations.max()
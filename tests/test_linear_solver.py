@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from linear_solver import dense_from_diagonals, solve_linear_system, solve_linear_system_batch
+
+def mpfd_diagonals(nz_s, nz_r, nz, seed=0):
+    """
+    Diagonals of a diagonally dominant matrix with the structure of A: tridiagonal, no-flux
+    face between the top soil node and the bottom root node, soil-root coupling at offset nr
+    """
+    rng = np.random.default_rng(seed)
+    nr = nz_r - nz_s
+    lower, upper = -rng.uniform(0.1, 1, nz - 1), -rng.uniform(0.1, 1, nz - 1)
+    lower[nz_s - 1] = upper[nz_s - 1] = 0
+    coupling = np.zeros(nz - nr)
+    coupling[nz_s - nr:nz_s] = -rng.uniform(0.1, 1, nr)
+    diag = 3 + rng.uniform(0, 1, nz)
+    return lower, diag, upper, coupling, nr, rng.normal(size=nz)
+
+@pytest.mark.parametrize('nz_s, nz_r, nz', [(12, 17, 25), (12, 13, 20)])
+def test_solvers_agree(nz_s, nz_r, nz):
+    lower, diag, upper, coupling, nr, R = mpfd_diagonals(nz_s, nz_r, nz)
+    expected = np.linalg.solve(dense_from_diagonals(lower, diag, upper, coupling, nr), R)
+
+    for solver in ('dense', 'sparse', 'banded'):
+        np.testing.assert_allclose(solve_linear_system(lower, diag, upper, coupling, nr, R, solver), expected, rtol=1e-10)
+    #reordered to bandwidth 2
+    np.testing.assert_allclose(solve_linear_system(lower, diag, upper, coupling, nr, R, 'banded', nz_s), expected, rtol=1e-12)
+
+def test_batch_solves_each_member():
+    members = [mpfd_diagonals(12, 17, 25, seed) for seed in range(3)]
+    lower, diag, upper, coupling, R = (np.array([member[k] for member in members]) for k in (0, 1, 2, 3, 5))
+
+    deltam = solve_linear_system_batch(lower, diag, upper, coupling, 5, R, 12)
+    for b, member in enumerate(members):
+        np.testing.assert_allclose(deltam[b], solve_linear_system(*member, 'sparse'), rtol=1e-12)
+
+def test_unknown_solver():
+    with pytest.raises(ValueError):
+        solve_linear_system(*mpfd_diagonals(12, 17, 25), 'cholesky')
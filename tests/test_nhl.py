@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from conftest import nhl_met_records
+from nhl_transpiration.NHL_functions import (calc_NHL_timesteps, calc_NHL_timesteps_batch, calc_NHL_timesteps_parallel,
+                                             solve_tridiagonal_batch, thomas_tridiagonal)
+
+@pytest.fixture
+def short_nhl_args(nhl_args):
+    #every third hour of the day: the serial engine takes about 0.1 s per met record
+    return nhl_args[:3] + (nhl_met_records().iloc[::6].reset_index(drop=True),) + nhl_args[4:]
+
+def test_tridiagonal_batch_matches_thomas():
+    rng = np.random.default_rng(0)
+    aa, cc, dd = rng.uniform(-1, 0, (3, 8, 40))
+    bb = 2.5 + rng.uniform(0, 1, (8, 40))
+    expected = np.array([thomas_tridiagonal(*system) for system in zip(aa, bb, cc, dd)])
+
+    np.testing.assert_array_equal(solve_tridiagonal_batch(aa, bb, cc, dd, 'thomas'), expected)
+    np.testing.assert_allclose(solve_tridiagonal_batch(aa, bb, cc, dd, 'banded'), expected, rtol=1e-12)
+
+def test_batch_engine_matches_serial(short_nhl_args):
+    serial, LAD, zenith = calc_NHL_timesteps(*short_nhl_args)
+    batch, LAD_batch, zenith_batch = calc_NHL_timesteps_batch(*short_nhl_args)
+
+    #every time column goes through the iterations of calc_NHL
+    np.testing.assert_array_equal(LAD_batch, LAD)
+    np.testing.assert_array_equal(zenith_batch, zenith)
+    for name in serial.data_vars:
+        np.testing.assert_array_equal(batch[name].values, serial[name].values)
+
+def test_parallel_matches_serial(nhl_args):
+    ds, LAD, zenith = calc_NHL_timesteps_batch(*nhl_args)
+    ds_parallel, LAD_parallel, zenith_parallel = calc_NHL_timesteps_parallel(calc_NHL_timesteps_batch, *nhl_args,
+                                                                             processes=2)
+    xr.testing.assert_identical(ds_parallel, ds)
+    np.testing.assert_array_equal(LAD_parallel, LAD)
+    np.testing.assert_array_equal(zenith_parallel, zenith)
+
+def test_scaled_wind_profile_matches_solved(nhl_args):
+    #the normalized profile is solved to 1e-8 instead of the 1e-4 of each solved profile
+    solved, _, _ = calc_NHL_timesteps_batch(*nhl_args, wind_profile='solve')
+    scaled, _, _ = calc_NHL_timesteps_batch(*nhl_args, wind_profile='scaled')
+
+    trans, trans_solved = scaled.NHL_trans_sp_stem.values, solved.NHL_trans_sp_stem.values
+    np.testing.assert_allclose(trans, trans_solved, atol=1e-5*trans_solved.max())
+    np.testing.assert_allclose(trans.sum(), trans_solved.sum(), rtol=1e-5)
+    for name in ('A', 'gs'):
+        np.testing.assert_allclose(scaled[name].values, solved[name].values, rtol=1e-3)
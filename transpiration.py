@@ -1,8 +1,6 @@
 import numpy as np
 
-import model_config as cfg
-from model_setup import neg2zero
-from met_data import Ta_2d, VPD_2d, SW_in_2d
+from model_setup import neg2zero, interpolate_2d
 
 ###################################################################
 #STOMATA REDUCTIONS FUNCTIONS
@@ -32,7 +30,7 @@ def calc_gc(gs, gb):
     return (gs * gb) / (gs + gb)
 
 def pm_trans(NET, delta, Cp, VPD, lamb, gama, gc, ga):
-    return ((NET * delta + Cp * VPD * ga) / (lamb * (delta * gc + cfg.gama * (ga + gc)))) * gc #[m/s]
+    return ((NET * delta + Cp * VPD * ga) / (lamb * (delta * gc + gama * (ga + gc)))) * gc #[m/s]
 
 def night_trans(Emax, f_Ta, f_d, f_leaf):
     # Eqn S.64
@@ -51,6 +49,19 @@ def calc_transpiration(SW_in, NET, delta, Cp, VPD, lamb, gama, gb, ga, gsmax, Em
 #########################################################################3
 #2D stomata reduction functions and variables for canopy-distributed transpiration
 #############################################################################
-f_Ta_2d = jarvis_fTa(Ta_2d, cfg.kt, cfg.Topt)
-f_d_2d = jarvis_fd(VPD_2d, cfg.kd)
-f_s_2d = jarvis_fs(SW_in_2d, cfg.kr)
\ No newline at end of file
+#the reductions are the same at every canopy node, so they are computed on the time series
+#and the 2D variables are views of them repeated along z
+def stomata_reductions(Ta, VPD, SW_in, kt, Topt, kd, kr, zdim):
+    f_Ta = jarvis_fTa(Ta, kt, Topt)
+    f_d = jarvis_fd(VPD, kd)
+    f_s = jarvis_fs(SW_in, kr)
+    return {'f_Ta': f_Ta, 'f_d': f_d, 'f_s': f_s,
+            'f_Ta_2d': interpolate_2d(f_Ta, zdim), 'f_d_2d': interpolate_2d(f_d, zdim), 'f_s_2d': interpolate_2d(f_s, zdim)}
+
+#stomata reductions of the configuration in model_config, built by simulation.default_simulation
+#when first imported by name
+def __getattr__(name):
+    from simulation import default_simulation
+    if name in ('f_Ta_2d', 'f_d_2d', 'f_s_2d'):
+        return getattr(default_simulation(), name)
+    raise AttributeError("module 'transpiration' has no attribute '" + name + "'")